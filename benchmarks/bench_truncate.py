@@ -0,0 +1,62 @@
+"""Micro-benchmark for label truncation in STATS VALLBLS FROMDATA
+
+Compares the original character-at-a-time utf-8 truncation with the
+cached single-encode truncation used by Mkvls.truncate on Latin,
+Cyrillic and CJK labels, and checks that both give identical results.
+
+Run from the repository root:
+    python benchmarks/bench_truncate.py
+"""
+
+import codecs, os, sys, timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import vallblsengine
+
+ec = codecs.getencoder("utf_8")
+
+def legacytruncate(name, maxlength):
+    """the original Unicode mode algorithm"""
+    
+    newname = []
+    nnlen = 0
+    for c in name:
+        c8 = ec(c)[0]
+        nnlen += len(c8)
+        if nnlen <= maxlength:
+            newname.append(c)
+        else:
+            break
+    name = "".join(newname)
+    if name and name[-1] == "_":
+        name = name[:-1]
+    return name
+
+samples = {
+    "latin": "Strongly agree with the statement_",
+    "cyrillic": "Полностью согласен с утверждением о качестве обслуживания_",
+    "cjk": "非常同意关于服务质量和客户满意度的说法",
+}
+
+def labels(text, distinct, repeats):
+    """a label column with distinct strings each repeated many times, padded like case data"""
+    
+    base = [(text * 8)[:60 + i % 40] + str(i) + " " * 20 for i in range(distinct)]
+    return base * repeats
+
+def main(distinct=300, repeats=200, maxlength=120, number=3):
+    print("%-10s %12s %12s %9s" % ("script", "legacy (s)", "cached (s)", "speedup"))
+    for script, text in samples.items():
+        column = labels(text, distinct, repeats)
+        for lbl in column[:distinct]:
+            if legacytruncate(lbl, maxlength) != vallblsengine.truncatebytes(lbl, maxlength, True):
+                raise AssertionError("results differ for %r" % lbl)
+        vallblsengine.truncatebytes.cache_clear()
+        legacy = min(timeit.repeat(lambda: [legacytruncate(lbl, maxlength) for lbl in column],
+            number=1, repeat=number))
+        cached = min(timeit.repeat(lambda: [vallblsengine.truncatebytes(lbl, maxlength, True) for lbl in column],
+            number=1, repeat=number))
+        print("%-10s %12.4f %12.4f %8.1fx" % (script, legacy, cached, legacy / cached))
+
+if __name__ == "__main__":
+    main()
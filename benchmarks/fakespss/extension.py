@@ -0,0 +1,30 @@
+"""Minimal stand-in for the extension module
+
+Only what STATS_VALLBLS_FROMDATA needs at import time and for calling
+processcmd with an already parsed argument dictionary is provided."""
+
+class Template(object):
+    def __init__(self, kwd="", subc="", var=None, ktype="str", islist=False, vallist=None):
+        self.kwd = kwd
+        self.subc = subc
+        self.var = var if var is not None else kwd.lower()
+        self.ktype = ktype
+        self.islist = islist
+        self.vallist = vallist
+
+class Syntax(object):
+    def __init__(self, templates):
+        self.templates = templates
+
+def processcmd(oobj, args, f, vardict=None):
+    """call f with the keywords in args mapped to its parameters
+
+    args is a dictionary of subcommands, each a dictionary of keyword values,
+    with the unnamed subcommand's keywords at the top level"""
+
+    kwds = {}
+    for t in oobj.templates:
+        sub = args.get(t.subc, {}) if t.subc else args
+        if t.kwd in sub:
+            kwds[t.var] = sub[t.kwd]
+    return f(**kwds)
@@ -0,0 +1,479 @@
+"""Minimal in-process stand-in for the IBM SPSS Statistics spss module
+
+Only the subset of the api and of the command language used by
+STATS VALLBLS FROMDATA is implemented.  Datasets live in memory as lists of
+case lists.  Strings are padded to their declared width as the backend does.
+
+Submit understands DATASET DECLARE/ACTIVATE/CLOSE/COPY/NAME, AGGREGATE with
+MIN, MAX and N functions, VARSTOCASES, COMPUTE of $CASENUM, EXECUTE,
+DELETE VARIABLES, SELECT IF on a blank string or on a variable or $CASENUM
+being greater than a number, and VALUE LABELS and ADD VALUE LABELS.  Anything
+else raises SpssError, so a change that submits new syntax is noticed.
+As in Statistics, $CASENUM in SELECT IF counts only the cases selected so far.
+A data step can set value labels through Dataset().varlist.
+
+Use loaddataset to create the active dataset and reset between runs.
+Every Submit call is recorded in submitted, and pivot tables in output."""
+
+import re
+
+class SpssError(Exception):
+    """raised for syntax or references the stand-in does not understand"""
+
+class _Dataset(object):
+    def __init__(self, names, types, rows, valuelabels=None):
+        self.names = list(names)
+        self.types = list(types)
+        self.rows = rows
+        self.valuelabels = dict((n, dict(valuelabels.get(n, {}))) for n in names) if valuelabels\
+            else dict((n, {}) for n in names)
+        self.datafile = None    # file the dataset was read from, if any
+
+    def copy(self):
+        ds = _Dataset(self.names, self.types, [list(r) for r in self.rows])
+        ds.valuelabels = dict((k, dict(v)) for k, v in self.valuelabels.items())
+        return ds
+
+    def index(self, name):
+        lnames = [n.lower() for n in self.names]
+        try:
+            return lnames.index(name.lower())
+        except ValueError:
+            raise SpssError("Undefined variable: %s" % name)
+
+_datasets = {}
+_active = None
+_utf8 = True
+_filter = None      # (TEMPORARY) function selecting the cases for the next procedure
+_temporary = False
+_datastep = False
+cursors = 0         # cursors opened and not yet closed
+submitted = []      # every Submit call as a list of commands
+output = []         # pivot tables produced
+
+def reset(utf8=True):
+    global _active, _utf8, _filter, _temporary, _datastep, cursors
+    _datasets.clear()
+    del submitted[:]
+    del output[:]
+    _active = None
+    _filter = None
+    _temporary = False
+    _datastep = False
+    cursors = 0
+    _utf8 = utf8
+
+def loaddataset(name, names, types, rows, valuelabels=None, datafile=None):
+    """Create dataset name from columns and make it active (fake only)
+    
+    datafile is the file the dataset is reported as read from"""
+    global _active
+    rows = [[_pad(v, t) for v, t in zip(r, types)] for r in rows]
+    _datasets[name] = _Dataset(names, types, rows, valuelabels)
+    _datasets[name].datafile = datafile
+    _active = name
+
+def _pad(v, t):
+    if t > 0 and v is not None:
+        return v.ljust(t)
+    return v
+
+def activedata():
+    return _datasets[_active]
+
+class PyInvokeSpss(object):
+    @staticmethod
+    def IsUTF8mode():
+        return _utf8
+
+def ActiveDataset():
+    return _active if _active is not None else "*"
+
+def GetVariableCount():
+    return len(activedata().names)
+
+def GetVariableName(i):
+    return activedata().names[i]
+
+def GetVariableType(i):
+    return activedata().types[i]
+
+def GetFileHandles():
+    return []
+
+def GetCaseCount():
+    return len(activedata().rows)
+
+def StartDataStep():
+    global _datastep
+    if _datastep:
+        raise SpssError("A data step is already in progress")
+    _datastep = True
+
+def EndDataStep():
+    global _datastep
+    _datastep = False
+
+class _ValueLabels(object):
+    def __init__(self, labels):
+        self.data = labels
+
+    def __getitem__(self, value):
+        return self.data[value]
+
+    def __setitem__(self, value, label):
+        self.data[value] = label
+
+class _Variable(object):
+    def __init__(self, ds, name):
+        self.ds = ds
+        self.name = name
+
+    @property
+    def valueLabels(self):
+        return _ValueLabels(self.ds.valuelabels[self.name])
+
+    @valueLabels.setter
+    def valueLabels(self, labels):
+        self.ds.valuelabels[self.name] = dict(labels)
+
+class _VariableList(object):
+    def __init__(self, ds):
+        self.ds = ds
+
+    def __getitem__(self, key):
+        if not isinstance(key, int):
+            key = self.ds.index(key)
+        return _Variable(self.ds, self.ds.names[key])
+
+class Dataset(object):
+    def __init__(self, name=None):
+        if not _datastep:
+            raise SpssError("Dataset requires a data step")
+        self.varlist = _VariableList(_datasets[name or _active])
+
+def StartProcedure(procname, omsid=None):
+    pass
+
+def EndProcedure():
+    pass
+
+# ---------------------------------------------------------------- Submit
+
+def _splitcommands(text):
+    """split syntax into commands at a period ending a line outside quotes"""
+    cmds = []
+    cur = []
+    q = None
+    i = 0
+    n = len(text)
+    while i < n:
+        c = text[i]
+        if q:
+            cur.append(c)
+            if c == q:
+                q = None
+        elif c in "'\"":
+            q = c
+            cur.append(c)
+        elif c == "." and (i + 1 == n or text[i+1] in "\r\n"):
+            cmds.append("".join(cur))
+            cur = []
+        else:
+            cur.append(c)
+        i += 1
+    if "".join(cur).strip():
+        cmds.append("".join(cur))
+    return [c.strip() for c in cmds if c.strip()]
+
+def Submit(cmds):
+    if _datastep:
+        raise SpssError("Submit is not allowed in a data step")
+    if cursors:
+        raise SpssError("Submit is not allowed while a cursor is open")
+    if isinstance(cmds, (list, tuple)):
+        cmds = "\n".join(cmds)
+    commands = _splitcommands(cmds)
+    submitted.append(commands)
+    for c in commands:
+        _execute(c)
+
+def _execute(cmd):
+    global _active, _filter, _temporary
+    words = cmd.split()
+    head = " ".join(words[:2]).upper()
+    if head == "DATASET DECLARE":
+        return
+    if head == "DATASET ACTIVATE":
+        name = words[2]
+        if name not in _datasets:
+            raise SpssError("Undefined dataset: %s" % name)
+        _active = name
+    elif head == "DATASET CLOSE":
+        _datasets.pop(words[2], None)
+        if _active == words[2]:
+            _active = None
+    elif head == "DATASET COPY":
+        _datasets[words[2]] = activedata().copy()
+    elif head == "DATASET NAME":
+        _datasets[words[2]] = _datasets.pop(_active)
+        _active = words[2]
+    elif words[0].upper() == "TEMPORARY":
+        _temporary = True
+    elif head == "SELECT IF":
+        select = _selection(cmd)
+        if _temporary:
+            _filter = select
+        else:
+            ds = activedata()
+            ds.rows = select(ds.rows)
+    elif words[0].upper() == "COMPUTE":
+        m = re.match(r"COMPUTE\s+(\S+)\s*=\s*\$CASENUM$", cmd, re.I)
+        if not m or _temporary:
+            raise SpssError("Unsupported COMPUTE: %s" % cmd)
+        ds = activedata()
+        ds.names.append(m.group(1))
+        ds.types.append(0)
+        ds.valuelabels[m.group(1)] = {}
+        for i, r in enumerate(ds.rows):
+            r.append(float(i + 1))
+    elif head == "DELETE VARIABLES":
+        ds = activedata()
+        for name in words[2:]:
+            i = ds.index(name)
+            del ds.names[i], ds.types[i]
+            ds.valuelabels.pop(name, None)
+            for r in ds.rows:
+                del r[i]
+    elif words[0].upper() == "EXECUTE":
+        return
+    elif words[0].upper() == "AGGREGATE":
+        _aggregate(cmd)
+    elif words[0].upper() == "VARSTOCASES":
+        _varstocases(cmd)
+    elif head == "VALUE LABELS":
+        _valuelabels(cmd[len("VALUE LABELS"):], replace=True)
+    elif " ".join(words[:3]).upper() == "ADD VALUE LABELS":
+        _valuelabels(cmd[len("ADD VALUE LABELS"):].lstrip(), replace=False)
+    else:
+        raise SpssError("Unsupported command: %s" % cmd)
+
+def _selection(cmd):
+    """Return a function that selects the rows for a SELECT IF command"""
+    b = re.match(r"SELECT IF\s+(\S+)\s*<>\s*\"\"$", cmd, re.I)
+    if b:
+        def select(rows):
+            i = activedata().index(b.group(1))
+            return [r for r in rows if r[i] is not None and r[i].strip() != ""]
+        return select
+    m = re.match(r"SELECT IF\s*\(?\s*(\S+?)\s*>\s*(\d+)\s*\)?$", cmd, re.I)
+    if not m:
+        raise SpssError("Unsupported SELECT IF: %s" % cmd)
+    n = int(m.group(2))
+    if m.group(1).upper() == "$CASENUM":
+        # the case number only advances for selected cases, so nothing passes once n >= 1
+        def select(rows):
+            selected = []
+            for r in rows:
+                if len(selected) + 1 > n:
+                    selected.append(r)
+            return selected
+        return select
+    def select(rows):
+        i = activedata().index(m.group(1))
+        return [r for r in rows if r[i] is not None and r[i] > n]
+    return select
+
+def _subcommands(cmd):
+    return [s.strip() for s in cmd.split("/")[1:]]
+
+def _sortkey(row):
+    return tuple((v is not None, v) for v in row)
+
+def _aggregate(cmd):
+    global _filter, _temporary
+    ds = activedata()
+    outfile = None
+    brk = []
+    specs = []
+    for sub in _subcommands(cmd):
+        key = re.split(r"[\s=]", sub, 1)[0].upper()
+        if key == "OUTFILE":
+            outfile = re.split(r"\s*=\s*|\s+", sub)[1]
+        elif key == "BREAK":
+            brk = re.sub(r"^BREAK\s*=?", "", sub, flags=re.I).split()
+        elif key == "PRESORTED":
+            continue
+        else:
+            m = re.match(r"(\S+)\s*=\s*(MIN|MAX|N)\s*(?:\((\S+)\))?", sub, re.I)
+            if not m:
+                raise SpssError("Unsupported AGGREGATE spec: %s" % sub)
+            specs.append((m.group(1), m.group(2).upper(), m.group(3)))
+    rows = ds.rows
+    if _filter is not None:
+        rows = _filter(rows)
+        _filter = None
+    _temporary = False
+    bidx = [ds.index(b) for b in brk]
+    groups = {}
+    for r in rows:
+        groups.setdefault(tuple(r[i] for i in bidx), []).append(r)
+    outnames = [ds.names[i] for i in bidx] + [s[0] for s in specs]
+    outtypes = [ds.types[i] for i in bidx]
+    for name, fn, src in specs:
+        outtypes.append(0 if fn == "N" else ds.types[ds.index(src)])
+    outrows = []
+    for key in sorted(groups, key=_sortkey):
+        grp = groups[key]
+        out = list(key)
+        for name, fn, src in specs:
+            if fn == "N":
+                out.append(float(len(grp)))
+                continue
+            si = ds.index(src)
+            vals = [r[si] for r in grp if r[si] is not None]
+            if not vals:
+                out.append(None)
+            else:
+                out.append(min(vals) if fn == "MIN" else max(vals))
+        outrows.append(out)
+    newds = _Dataset(outnames, outtypes, outrows)
+    if outfile == "*":
+        _datasets[_active] = newds
+    else:
+        _datasets[outfile] = newds
+
+def _varstocases(cmd):
+    ds = activedata()
+    makes = []
+    index = None
+    keep = None
+    drop = []
+    for sub in _subcommands(cmd):
+        key = re.split(r"[\s=]", sub, 1)[0].upper()
+        if key == "MAKE":
+            m = re.match(r"MAKE\s+(\S+)\s+FROM\s+(.*)$", sub, re.I | re.S)
+            makes.append((m.group(1), m.group(2).split()))
+        elif key == "INDEX":
+            m = re.match(r"INDEX\s*=\s*(\S+)\s*\((\S+)\)", sub, re.I)
+            index = m.group(1)
+        elif key == "KEEP":
+            keep = re.sub(r"^KEEP\s*=?", "", sub, flags=re.I).split()
+        elif key == "DROP":
+            drop = [d.lower() for d in re.sub(r"^DROP\s*=?", "", sub, flags=re.I).split()]
+        elif key == "NULL":
+            continue
+        else:
+            raise SpssError("Unsupported VARSTOCASES spec: %s" % sub)
+    n = len(makes[0][1])
+    if keep is None:
+        used = set(v.lower() for m in makes for v in m[1])
+        keep = [v for v in ds.names if not v.lower() in used and not v.lower() in drop]
+    kidx = [ds.index(k) for k in keep]
+    srcs = makes[0][1]
+    width = max(len(s) for s in srcs)
+    outnames = [index] + [m[0] for m in makes] + [ds.names[i] for i in kidx]
+    outtypes = [width] + [max(ds.types[ds.index(v)] for v in m[1]) for m in makes] + [ds.types[i] for i in kidx]
+    makeidx = [[ds.index(v) for v in m[1]] for m in makes]
+    rows = []
+    for r in ds.rows:
+        for j in range(n):
+            out = [srcs[j].ljust(width)]
+            for k, idx in enumerate(makeidx):
+                out.append(_pad(r[idx[j]], outtypes[k+1]))
+            out.extend(r[i] for i in kidx)
+            rows.append(out)
+    _datasets[_active] = _Dataset(outnames, outtypes, rows)
+
+_tokenre = re.compile(r"""'(?:[^']|'')*'|"(?:[^"]|"")*"|[^\s'"]+""")
+
+def _unquote(tok):
+    q = tok[0]
+    return tok[1:-1].replace(q + q, q)
+
+def _valuelabels(spec, replace):
+    ds = activedata()
+    tokens = _tokenre.findall(spec)
+    i = 0
+    while i < len(tokens):
+        names = []
+        while i < len(tokens) and tokens[i][0] not in "'\"" and not _isnumber(tokens[i]):
+            if tokens[i] == "/":
+                i += 1
+                continue
+            names.append(tokens[i])
+            i += 1
+        labels = {}
+        while i + 1 < len(tokens) and (tokens[i][0] in "'\"" or _isnumber(tokens[i])):
+            val = _unquote(tokens[i]) if tokens[i][0] in "'\"" else float(tokens[i])
+            labels[val] = _unquote(tokens[i+1])
+            i += 2
+            if i < len(tokens) and tokens[i] == "/":
+                i += 1
+                break
+        for n in names:
+            name = ds.names[ds.index(n)]
+            if replace:
+                ds.valuelabels[name] = dict(labels)
+            else:
+                ds.valuelabels[name].update(labels)
+
+def _isnumber(tok):
+    try:
+        float(tok)
+        return True
+    except ValueError:
+        return False
+
+# ---------------------------------------------------------------- output
+
+class FormatSpec(object):
+    Count = "Count"
+    GeneralStat = "GeneralStat"
+    Coefficient = "Coefficient"
+    Percent = "Percent"
+
+class CellText(object):
+    class Number(object):
+        def __init__(self, value, fmt=None, varIndex=None):
+            self.value = value
+            self.fmt = fmt
+        def __repr__(self):
+            return repr(self.value)
+    class String(object):
+        def __init__(self, value):
+            self.value = value
+        def __repr__(self):
+            return repr(self.value)
+    class VarName(String):
+        pass
+
+class Dimension(object):
+    class Place(object):
+        row = 0
+        column = 1
+        layer = 2
+
+class BasePivotTable(object):
+    def __init__(self, title, templateName, outline="", isSplit=True, caption=""):
+        self.title = title
+        self.templateName = templateName
+        self.caption = caption
+        self.rowlabels = []
+        self.collabels = []
+        self.cells = []
+        output.append(self)
+
+    def Caption(self, caption):
+        self.caption = caption
+
+    def SimplePivotTable(self, rowdim="", rowlabels=[], coldim="", collabels=[], cells=None):
+        self.rowlabels = list(rowlabels)
+        self.collabels = list(collabels)
+        self.cells = cells
+
+    def Append(self, place, dimName, hideName=False, hideLabels=False):
+        return dimName
+
+    def __setitem__(self, key, value):
+        self.cells.append((key, value))
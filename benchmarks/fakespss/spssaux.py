@@ -0,0 +1,87 @@
+"""Minimal stand-in for the spssaux module"""
+
+import re
+import spss
+
+def _smartquote(s, qchar='"'):
+    return qchar + s.replace(qchar, qchar + qchar) + qchar
+
+def getDatasetInfo(Info="DataFile"):
+    if Info != "DataFile":
+        raise ValueError("Unsupported dataset information: %s" % Info)
+    return spss.activedata().datafile
+
+class _Variable(object):
+    def __init__(self, ds, index):
+        self.VariableIndex = index
+        self.VariableName = ds.names[index]
+        self.VariableType = ds.types[index]
+        labels = ds.valuelabels.get(self.VariableName, {})
+        self.ValueLabels = dict((_keystr(k), v) for k, v in labels.items())
+
+def _keystr(k):
+    if isinstance(k, float) and k == int(k):
+        return str(int(k))
+    return str(k)
+
+class VariableDict(object):
+    def __init__(self, namelist=None, variableType=None, caseless=False):
+        self.ds = spss.activedata()
+        self.caseless = caseless
+        self.names = list(self.ds.names)
+        if namelist is not None:
+            if isinstance(namelist, str):
+                namelist = namelist.split()
+            wanted = set(n.lower() for n in namelist)
+            self.names = [n for n in self.names if n.lower() in wanted]
+        self.lookup = dict((n.lower() if caseless else n, n) for n in self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __getitem__(self, name):
+        key = name.lower() if self.caseless else name
+        if key not in self.lookup:
+            raise KeyError(name)
+        return _Variable(self.ds, self.ds.index(self.lookup[key]))
+
+    @property
+    def variables(self):
+        return list(self.names)
+
+    def expand(self, varlist):
+        if isinstance(varlist, str):
+            varlist = varlist.split()
+        out = []
+        i = 0
+        while i < len(varlist):
+            v = varlist[i]
+            if i + 2 < len(varlist) and varlist[i+1].upper() == "TO":
+                a = self.ds.index(varlist[i])
+                b = self.ds.index(varlist[i+2])
+                out.extend(self.ds.names[a:b+1])
+                i += 3
+            else:
+                key = v.lower() if self.caseless else v
+                if key not in self.lookup:
+                    raise ValueError("Undefined variable: %s" % v)
+                out.append(self.lookup[key])
+                i += 1
+        return out
+
+    def variablesf(self, variableType=None, pattern=None, **kwds):
+        flags = re.I if self.caseless else 0
+        out = []
+        for n in self.names:
+            t = self.ds.types[self.ds.index(n)]
+            if variableType == "string" and t == 0:
+                continue
+            if variableType == "numeric" and t > 0:
+                continue
+            if pattern and not re.match(pattern, n, flags):
+                continue
+            out.append(n)
+        return out
@@ -0,0 +1,49 @@
+"""Minimal stand-in for the spssdata cursor module"""
+
+import spss
+
+class Spssdata(object):
+    """Read-only cursor over the active dataset"""
+
+    def __init__(self, indexes=None, names=True, convertUserMissing=True, omitmissing=False, **kwds):
+        self.ds = spss.activedata()
+        if indexes is None:
+            self.idx = list(range(len(self.ds.names)))
+        else:
+            if isinstance(indexes, str):
+                indexes = indexes.split()
+            self.idx = [i if isinstance(i, int) else self.ds.index(i) for i in indexes]
+        self.pos = 0
+        spss.cursors += 1
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+    def fetchone(self):
+        if self.pos >= len(self.ds.rows):
+            return None
+        r = self.ds.rows[self.pos]
+        self.pos += 1
+        return tuple(r[i] for i in self.idx)
+
+    def fetchmany(self, size):
+        rows = self.ds.rows[self.pos:self.pos+size]
+        self.pos += len(rows)
+        idx = self.idx
+        return [tuple(r[i] for i in idx) for r in rows]
+
+    def fetchall(self):
+        return self.fetchmany(len(self.ds.rows))
+
+    def CClose(self):
+        if self.ds is not None:
+            spss.cursors -= 1
+        self.ds = None
+
+    close = CClose
@@ -0,0 +1,111 @@
+"""Benchmark suite for STATS VALLBLS FROMDATA
+
+The extension command is run against the SPSS stand-in in benchmarks/fakespss,
+so no Statistics license is needed.  Starting from a base configuration, one
+factor at a time is varied: the number of variables, their cardinality, the
+label length, VARSPERPASS, and the engine.  Each configuration runs in a
+fresh process so that peak resident memory is measured separately.
+Results are reported as cases per second and peak RSS in MB.
+
+The stand-in emulates AGGREGATE and VARSTOCASES in Python, so absolute
+times are not those of a Statistics backend, but the extension's own work
+(cursor loops, tallying, truncation, syntax generation) is measured as is,
+and the relative cost of configurations is meaningful.
+
+Usage, from the repository root:
+    python benchmarks/run_benchmarks.py [--cases N] [--quick] [--csv results.csv]
+"""
+
+import argparse, json, os, random, subprocess, sys, time
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+BASE = {"nvars": 20, "ncases": 20000, "card": 5, "lbllen": 20, "varsperpass": 20, "engine": "wide"}
+SWEEPS = [
+    ("nvars", [5, 20, 50]),
+    ("card", [2, 10, 50]),
+    ("lbllen", [10, 60, 200]),
+    ("varsperpass", [5, 10, 20]),
+    ("engine", ["wide", "long", "stream"]),
+]
+FILLER = "lorem ipsum dolor sit amet consectetur adipiscing elit " * 5
+
+def makedata(nvars, ncases, card, lbllen, seed=20130120):
+    """Return names, types, and rows for a file of coded variables and their label variables"""
+
+    rnd = random.Random(seed)
+    names = ["x%d" % i for i in range(nvars)] + ["lbl%d" % i for i in range(nvars)]
+    types = nvars * [0] + nvars * [lbllen]
+    labels = [("code %d %s" % (k, FILLER))[:lbllen] for k in range(card)]
+    rows = []
+    for c in range(ncases):
+        values = [rnd.randrange(card) for i in range(nvars)]
+        rows.append([float(v) for v in values] + [labels[v] for v in values])
+    return names, types, rows
+
+def runone(config):
+    """Run the command once in this process and return the measurements"""
+
+    sys.path[:0] = [os.path.join(here, "fakespss"), os.path.join(here, "..", "src")]
+    import spss
+    import STATS_VALLBLS_FROMDATA as vallbls
+    vallbls._ = lambda msg: msg
+
+    nvars = config["nvars"]
+    spss.reset()
+    spss.loaddataset("bench", *makedata(nvars, config["ncases"], config["card"], config["lbllen"]))
+    start = time.perf_counter()
+    vallbls.dolabels(variables=["x0", "TO", "x%d" % (nvars - 1)],
+        lblvars=["lbl0", "TO", "lbl%d" % (nvars - 1)],
+        varsperpass=config["varsperpass"], engine=config["engine"])
+    elapsed = time.perf_counter() - start
+    return {"seconds": elapsed, "casespersec": config["ncases"] / elapsed,
+        "peakrss": vallbls.peakmemory(),
+        "commands": sum(len(cmds) for cmds in spss.submitted)}
+
+def configurations(ncases, quick):
+    """Return the list of distinct configurations to run"""
+
+    base = dict(BASE, ncases=ncases)
+    configs = []
+    for factor, levels in SWEEPS:
+        if quick and factor != "engine":
+            levels = levels[:1] + levels[-1:]
+        for level in levels:
+            config = dict(base, **{factor: level})
+            if not config in configs:
+                configs.append(config)
+    return configs
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark STATS VALLBLS FROMDATA with the SPSS stand-in")
+    parser.add_argument("--cases", type=int, default=BASE["ncases"], help="number of cases")
+    parser.add_argument("--quick", action="store_true", help="run only the extreme levels of the numeric factors")
+    parser.add_argument("--csv", help="also write the results to this file")
+    parser.add_argument("--one", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.one:
+        print(json.dumps(runone(json.loads(args.one))))
+        return
+
+    keys = ["engine", "nvars", "card", "lbllen", "varsperpass", "ncases"]
+    print("%-7s %6s %5s %7s %12s %7s %10s %12s %10s" % tuple(keys[:5] + ["cases", "seconds", "cases/sec", "peak MB"]))
+    results = []
+    for config in configurations(args.cases, args.quick):
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--one", json.dumps(config)],
+            stdout=subprocess.PIPE, universal_newlines=True, check=True)
+        result = dict(config, **json.loads(proc.stdout.splitlines()[-1]))
+        results.append(result)
+        print("%-7s %6d %5d %7d %12d %7d %10.3f %12.0f %10s" % (result["engine"], result["nvars"], result["card"],
+            result["lbllen"], result["varsperpass"], result["ncases"], result["seconds"], result["casespersec"],
+            result["peakrss"] is None and "n/a" or "%.1f" % result["peakrss"]))
+    if args.csv:
+        import csv
+        with open(args.csv, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=keys + ["seconds", "casespersec", "peakrss", "commands"])
+            writer.writeheader()
+            writer.writerows(results)
+
+if __name__ == "__main__":
+    main()
@@ -9,7 +9,7 @@
 # * restricted by GSA ADP Schedule Contract with IBM Corp.
 # ************************************************************************/
 
-import random, os, tempfile, textwrap, codecs, re, locale
+import random, os, sys, tempfile, textwrap, re, locale, time, json, contextlib, hashlib, collections
 import spss, spssaux, spssdata, textwrap
 
 """STATS VALLBLS FROMDATA extension command"""
@@ -38,8 +38,30 @@ STATS VALLBLS FROMDATA
     LBLVARS = string variable list or LBLPATTERN = "regular expression"
 OPTIONS
     VARSPERPASS = integer
+    ENGINE = WIDE* or LONG or STREAM
+    PLAN = FIXED* or ADAPTIVE
+    CELLBUDGET = integer
+    SAMPLESIZE = integer
+    MAXDISTINCT = integer
+    HIGHCARD = SKIP* or ISOLATE
+    STABLECASES = integer
+    MAXSAMPLE = integer
+    CACHE = "filespec"
+    MEMORYBUDGET = integer
+    CHECKPOINT = "filespec"
+    PROGRESS = "filespec"
+    CONFLICTRULE = FIRST* or MOSTFREQUENT or LONGEST
+    MAXCONFLICTS = integer
+    REPORTDUPS = YES* or NO
+    MAXDUPS = integer
 
 OUTPUT SYNTAX = "filespec"
+    EXECUTE = YES* or NO
+    APPLY = DATASTEP* or SYNTAX
+    DELTA = NO* or YES
+    EXPORT = "filespec"
+
+/DIAGNOSTICS JSONFILE = "filespec"
 
 /HELP displays this help and does nothing else.
 
@@ -68,24 +90,164 @@ on a single data pass.  The default is 20.  The size of the
 intermediate dataset created by this procedure grows exponentially
 with the number of variables.
 
+PLAN=ADAPTIVE replaces the fixed number of variables per pass with
+a plan based on the estimated number of distinct values of each
+variable.  The estimate is the larger of the number of value labels
+already defined and the number of distinct values in the first
+SAMPLESIZE cases (default 1000), extrapolated to the whole file
+when the sample values hardly repeat.  Consecutive variables are
+packed into a pass as long as the estimated size of the
+intermediate dataset stays within CELLBUDGET cases (default 1000000).
+With ADAPTIVE, VARSPERPASS, if specified, is the maximum number
+of variables in a pass.  The plan is displayed in the output.
+
+ENGINE specifies how the data are summarized.  WIDE, the default,
+aggregates all the variables of a pass together, so the intermediate
+dataset has a case for every combination of values that occurs.
+LONG restacks the variables into cases of variable name, value, and
+label and aggregates once by variable name and value, so the intermediate
+dataset is no larger than the total number of distinct values across
+the variables.  STREAM reads the variables to label and the label
+variables case by case in a single data pass with no aggregation,
+however many variables there are.  It is usually fastest when the
+variables have few distinct values.  VARSPERPASS applies only to WIDE.
+The labels generated are the same with any engine, including the
+label chosen for a value with conflicting labels.
+
+MAXDISTINCT requests a preliminary data pass that estimates the
+number of distinct values of each variable to label and each label
+variable with a HyperLogLog sketch, which is accurate to a few percent.
+Variables to label with more estimated distinct values than MAXDISTINCT,
+such as identifiers matched by mistake, are skipped with HIGHCARD=SKIP,
+the default, or given a data pass of their own with HIGHCARD=ISOLATE.
+Isolation matters only for ENGINE=WIDE.  The estimates are displayed,
+and with PLAN=ADAPTIVE they replace the sample-based estimates.
+
+STABLECASES and MAXSAMPLE read only a sample from the start of the
+file and imply ENGINE=STREAM.  A variable is stable once STABLECASES
+cases have been read since a new value or a new label for a value last
+appeared in it.  With CONFLICTRULE=FIRST, a label that sorts before
+the label a value already has is not counted, since it cannot change
+the result, unless it is the value's first conflict.  Reading stops as
+soon as every variable is stable or MAXSAMPLE cases have been read,
+whichever comes first.  Stability is checked after each block of 1000
+cases.  Values or labels that first occur later in the file are not
+seen.  The output shows which variables were decided early.  These
+cannot be combined with CACHE.
+
+CACHE names a file in which the accumulated labels and conflicts
+are kept between runs, for data to which new cases are appended.
+The cache is keyed by the file the active dataset was read from, or
+by the dataset name if that is not known.  Each variable is keyed by
+its name and type, by the name and type of its label variable, and
+by a checksum of the values and labels of the first 100 cases, so the
+cache is not used for a different file with the same variables.  On a
+later run, variables that match the cache are tallied only over the
+cases added since then, and ADD VALUE LABELS is generated for just the
+values that are new or whose label changed.  Variables that do not match, or all
+variables if the case count has gone down, are processed in full.
+The labels from the previous run are assumed to have been applied.
+
+MEMORYBUDGET is the approximate number of megabytes the tallies of
+values and labels may use.  When it is exceeded, the tallies of the
+variables with the most distinct values are moved to a temporary
+SQLite file, and conflicts and duplicates for those variables are
+found when the data have been read.  Their labels are then read back
+from the file in value order, one variable at a time.  This is for
+variables with millions of distinct values and is slower than keeping
+everything in memory.  It cannot be used with CACHE.
+
+CHECKPOINT names a file to which the tallies are saved as each data
+pass finishes.  If the run is cancelled or fails, running the same
+command again resumes from the last finished pass: the variables
+already done are restored from the file rather than read again, as
+long as the data file, case count, and variable specifications are
+unchanged.  The file is deleted when the run completes.  CHECKPOINT
+cannot be used with MEMORYBUDGET.
+
+PROGRESS names a text file to which a line is written after each block
+of rows and each data pass, giving the variables done, the rows
+tallied, the time elapsed, and an estimate of the time remaining.
+The file can be watched while the command runs.  When dolabels is
+called from Python, PROGRESS can instead be a function, which is
+called with a dictionary for each event.  The function can cancel the
+run by returning False or by raising Cancelled.  Nothing more is read,
+no labels are applied, the active dataset is restored, and dolabels
+raises Cancelled.  With CHECKPOINT, the passes already finished are
+kept, so running the command again resumes from there.
+
 Value labels are checked for conflicts, i.e., two different labels
 for the same value of a variable.  MAXCONFLICTS specifies the
 maximum number of conflicts to report across all the variables.
 The default value is 100.
 
+CONFLICTRULE decides which label a value with conflicting labels gets.
+FIRST, the default, uses the label that sorts last, which is the
+label the WIDE aggregate has always chosen.  It does not depend on the
+engine or the order in which the data are read.  MOSTFREQUENT uses the label with
+the most cases, and LONGEST the longest label.  Ties go to the longest
+or the most frequent label, respectively, and then to the label that
+sorts first.  The cases for each label are counted in the same data
+pass: the label variables are added to the AGGREGATE break variables,
+so the aggregate datasets can be larger.  The conflict details show
+the share of the cases with the value that had the winning label.
+CONFLICTRULE cannot be combined with MEMORYBUDGET.
+
 REPORTDUPS specifies whether or not to report whether
 two or more value labels for a variable are identical.
 
 MAXDUPS specifies the number of duplicates reported.  The
 default is 100.
+
+Conflicts and duplicates are counted in full for each variable, but
+only the first ones found are kept and listed in detail tables, so
+memory use does not depend on how many there are.
+
+APPLY=DATASTEP writes the labels directly into the dictionary in a
+single data step, so no syntax has to be generated or parsed.  Syntax
+is then generated only for a SYNTAX file.  APPLY=SYNTAX generates
+VALUE LABELS commands and runs them instead.
+Variables that receive identical labels share a single command.
+
+DELTA=YES compares the generated labels with those the variables
+already have in the dictionary.  Only new or changed labels are added,
+with ADD VALUE LABELS, so other existing labels, including hand-edited
+labels for values not in the data, are kept.  Variables with no
+differences are skipped.  The default, NO, replaces all the labels.
+
+EXPORT names a file for the final value label map, for loading into
+other systems.  Each row has the variable, value, label, and flags for
+whether the value had conflicting labels and whether the label is a
+duplicate.  The format comes from the file extension: .jsonl for JSON
+Lines, .csv, or .parquet, which requires the pyarrow package.  In
+Parquet, values are stored as text.  The map is written directly from
+the tallies, so it does not depend on APPLY or DELTA, and it is written
+even if EXECUTE=NO.
+
+/DIAGNOSTICS adds a table with the time taken by each phase of each
+data pass: creating the aggregate, tallying its cases, including
+label truncation, and closing it, along with the number of aggregate
+cases and the rate at which they were tallied.  The caption gives the
+time to generate and apply the labels, the size of the syntax, and
+the number of times commands were submitted to the backend.  Commands
+are queued and submitted together when their results are needed, so
+closing an aggregate is timed with the aggregate of the next pass.
+JSONFILE optionally writes the same information to a JSON file,
+including each submitted batch and its latency.
 """
 
 import spss, spssaux, spssdata
 from extension import Template, Syntax, processcmd
+import vallblsengine
+from vallblsengine import VarTally
 
 def dolabels(variables=None, varpattern=None,
     lblvars=None, lblpattern=None, execute=True,
-    varsperpass=20, syntax=None):
+    varsperpass=None, engine="wide", plan="fixed", cellbudget=1000000,
+    samplesize=1000, maxdistinct=None, highcard="skip", stablecases=None, maxsample=None,
+    cache=None, memorybudget=None, checkpoint=None, progress=None,
+    conflictrule="first", maxconflicts=100, reportdups=True, maxdups=100,
+    syntax=None, apply="datastep", delta=False, export=None, diagnostics=False, diagjson=None):
     """Execute STATS VALLBLS FROMDATA"""
     
 # debugging
@@ -103,12 +265,10 @@ def dolabels(variables=None, varpattern=None,
         ###    ###SpssClient._heartBeat(False)
     #except:
         #pass
-    try:
-        vardict = spssaux.VariableDict(caseless=True)
-    except:
-        raise ValueError(_("""This command requires a  newer version the spssaux module.  \n
-It can be obtained from the SPSS Community website (www.ibm.com/developerworks/spssdevcentral)"""))
-    
+    dsname = spss.ActiveDataset()
+    if dsname == "*":
+        raise ValueError(_("""The active dataset must have a dataset name in order to use this procedure"""))
+    vardict = VariableInfo()
     varstolabel = resolve(vardict, _("variables to label"), variables, varpattern, stringonly=False)
     labelvars = resolve(vardict, _("label variables"), lblvars, lblpattern, stringonly=True)
     if len(varstolabel) == 0 or len(labelvars) == 0:
@@ -116,39 +276,248 @@ It can be obtained from the SPSS Community website (www.ibm.com/developerworks/s
 If a pattern was used, it may not have matched any variables."""))
     if len(labelvars) > 1 and len(labelvars) != len(varstolabel):
         raise ValueError(_("The number of label variables is different from the number of variables to label"))
-    if min([vardict[item].VariableType for item in labelvars]) == 0:
+    if not min([vardict.isstring(item) for item in labelvars]):
         raise ValueError(_("""The label variables must all have type string"""))
-    dsname = spss.ActiveDataset()
-    if dsname == "*":
-        raise ValueError(_("""The active dataset must have a dataset name in order to use this procedure"""))
+    vardict.select(varstolabel + labelvars)
+    if varsperpass is not None and varsperpass < 1:
+        raise ValueError(_("""VARSPERPASS must be a positive integer"""))
+    if cellbudget < 1 or samplesize < 1:
+        raise ValueError(_("""CELLBUDGET and SAMPLESIZE must be positive integers"""))
+    if maxconflicts < 0 or maxdups < 0:
+        raise ValueError(_("""MAXCONFLICTS and MAXDUPS cannot be negative"""))
+    if maxdistinct is not None and maxdistinct < 1:
+        raise ValueError(_("""MAXDISTINCT must be a positive integer"""))
+    if (stablecases is not None and stablecases < 1) or (maxsample is not None and maxsample < 1):
+        raise ValueError(_("""STABLECASES and MAXSAMPLE must be positive integers"""))
+    if stablecases or maxsample:
+        if cache:
+            raise ValueError(_("""CACHE cannot be used with STABLECASES or MAXSAMPLE"""))
+        engine = "stream"
+    if memorybudget is not None:
+        if memorybudget < 1:
+            raise ValueError(_("""MEMORYBUDGET must be a positive integer"""))
+        if cache:
+            raise ValueError(_("""CACHE cannot be used with MEMORYBUDGET"""))
+        if conflictrule != "first":
+            raise ValueError(_("""MEMORYBUDGET can only be used with CONFLICTRULE=FIRST"""))
+        if checkpoint:
+            raise ValueError(_("""CHECKPOINT cannot be used with MEMORYBUDGET"""))
     if syntax:
         syntax = syntax.replace("\\", "/")
         syntax = FileHandles().resolve(syntax)
+    if diagjson:
+        diagjson = FileHandles().resolve(diagjson.replace("\\", "/"))
+    if cache:
+        cache = FileHandles().resolve(cache.replace("\\", "/"))
+    if checkpoint:
+        checkpoint = FileHandles().resolve(checkpoint.replace("\\", "/"))
+    if export:
+        export = FileHandles().resolve(export.replace("\\", "/"))
+        if vallblsengine.exportformat(export) == "parquet":
+            vallblsengine.optionalimport("pyarrow.parquet")
+    if progress and not callable(progress):
+        progress = FileHandles().resolve(progress.replace("\\", "/"))
         
-    mkvl = Mkvls(varstolabel, labelvars, varsperpass, execute, syntax, vardict)
+    diag = Diagnostics(diagnostics or diagjson is not None)
+    if maxdistinct:
+        with diag.timer("preflight"):
+            preflight = Preflight(vardict, varstolabel, labelvars, maxdistinct, highcard)
+        if highcard == "skip":
+            varstolabel, labelvars = preflight.keep(varstolabel, labelvars)
+    mkvl = Mkvls(varstolabel, labelvars, varsperpass, execute, syntax, vardict,
+        diag, maxconflicts, maxdups if reportdups else None, conflictrule)
+    if maxdistinct:
+        mkvl.preflight = preflight
+    
+    if memorybudget:
+        mkvl.store = vallblsengine.SpillStore(memorybudget * 2**20)
+    try:
+        if cache or checkpoint:
+            datakey = cachekey(dsname)
+        if cache:
+            workgroups = mkvl.loadcache(cache, datakey)
+        else:
+            workgroups = [(varstolabel, 0)]
+        if checkpoint:
+            finished = mkvl.resume(checkpoint, datakey)
+            workgroups = [([v for v in vtl if not v in finished], firstcase) for vtl, firstcase in workgroups]
+            workgroups = [(vtl, firstcase) for vtl, firstcase in workgroups if vtl]
+        if progress:
+            mkvl.progress = Progress(progress, sum(len(vtl) for vtl, firstcase in workgroups))
+        if engine != "stream" and any(firstcase for vtl, firstcase in workgroups):
+            mkvl.numbercases(dsname)
+        try:
+            for vtl, firstcase in workgroups:
+                work = mkvl.subset(vtl, firstcase)
+                if engine == "long":
+                    work.dolong(dsname)
+                elif engine == "stream":
+                    work.dostream(stablecases, maxsample)
+                else:
+                    for start, count in work.planpasses(plan, cellbudget, samplesize):
+                        mkvl.commands.add("""DATASET ACTIVATE %s""" % dsname)
+                        work.doaggr(start, count)
+        except Cancelled:
+            # a cancelled pass leaves its aggregate active
+            mkvl.commands.add("""DATASET ACTIVATE %s""" % dsname)
+            if engine != "stream":
+                mkvl.commands.add("""DATASET CLOSE %s""" % work.aggrdsname)
+            mkvl.dropcasenumber()
+            mkvl.commands.flush()
+            raise
+        mkvl.commands.add("""DATASET ACTIVATE %s""" % dsname)
+        mkvl.dropcasenumber()
+        if mkvl.store is not None:
+            mkvl.store.finish(mkvl.tallies)
+        mkvl.resolveconflicts()
+        if cache:
+            mkvl.savecache(cache, datakey)
+        if export:
+            with diag.timer("export"):
+                mkvl.exported = (export, vallblsengine.exportmap(export, mkvl.tallies, mkvl.isstring))
+        if delta:
+            mkvl.readexisting()
+        if execute and apply == "datastep":
+            ncommands = applydatastep(mkvl, syntax, diag)
+        else:
+            ncommands = emitsyntax(mkvl.dolabels(), syntax, execute, mkvl.unicodemode, diag, mkvl.commands)
+        mkvl.report(ncommands)
+        if diagjson:
+            diag.writejson(diagjson)
+
+        if checkpoint:
+            # the run is complete, so there is nothing to resume
+            os.remove(checkpoint)
+    finally:
+        if mkvl.store is not None:
+            mkvl.store.close()
+        if mkvl.progress is not None:
+            mkvl.progress.close()
+
+SUBMITBATCH = 1000000   # approximate maximum characters of label syntax per Submit
+HEADCASES = 100         # leading cases checksummed to recognize the data of a cached variable
+
+def cachekey(dsname):
+    """Return the key identifying the active dataset in a label cache or checkpoint
+    
+    dsname is the name of the active dataset
+    This is the file the dataset was read from, if known, since the dataset name
+    is usually just the default one.  Otherwise it is the dataset name."""
+    
+    try:
+        datafile = spssaux.getDatasetInfo("DataFile")
+    except Exception:
+        datafile = None
+    if datafile:
+        return os.path.normcase(os.path.abspath(datafile))
+    return dsname
+
+def emitsyntax(labelsyntax, syntax, execute, unicodemode, diag, queue):
+    """Write and run label syntax as it is generated and return the number of commands
+    
+    labelsyntax is an iterable of commands
+    syntax is a file for the syntax or None
+    execute is True if the syntax is to be run
+    unicodemode is True if Statistics is in Unicode mode
+    diag is the Diagnostics object
+    queue is the CommandQueue, which may already hold commands
     
-    for i in range(0, len(varstolabel), varsperpass):
-        spss.Submit("""DATASET ACTIVATE %s""" % dsname)
-        mkvl.doaggr(i)
-    spss.Submit("""DATASET ACTIVATE %s""" % dsname)    
-    labelsyntax = mkvl.dolabels()
-    if labelsyntax and execute:
-        spss.Submit(labelsyntax)
-    mkvl.report(labelsyntax)
-    if labelsyntax and syntax:
-        writesyntax(labelsyntax, syntax, mkvl)
+    Commands are submitted in batches of about SUBMITBATCH characters,
+    so the whole label program is never held in memory."""
+    
+    ncommands = 0
+    with contextlib.ExitStack() as stack:
+        if syntax:
+            f = stack.enter_context(opensyntax(syntax, unicodemode))
+        commands = iter(labelsyntax)
+        while True:
+            with diag.timer("makevls"):
+                cmd = next(commands, None)
+            if cmd is None:
+                break
+            ncommands += 1
+            if diag.enabled:
+                diag.run["syntaxbytes"] = diag.run.get("syntaxbytes", 0) + len(cmd.encode("utf_8")) + 1
+            if syntax:
+                f.write(cmd + "\n")
+            if execute:
+                queue.add(cmd)
+                if queue.size >= SUBMITBATCH:
+                    with diag.timer("submit"):
+                        queue.flush()
+        with diag.timer("submit"):
+            queue.flush()
+    diag.run["commands"] = ncommands
+    return ncommands
+
+def applydatastep(mkvl, syntax, diag):
+    """Apply the labels through the Dataset api and return the number of label sets
+    
+    mkvl is the Mkvls object holding the tallies
+    syntax is a file for the equivalent syntax, which is not run, or None
+    diag is the Diagnostics object"""
+    
+    ncommands = 0
+    with contextlib.ExitStack() as stack:
+        if syntax:
+            f = stack.enter_context(opensyntax(syntax, mkvl.unicodemode))
+        mkvl.commands.flush()
+        spss.StartDataStep()
+        stack.callback(spss.EndDataStep)
+        varlist = spss.Dataset().varlist
+        labelsets = mkvl.labelsets()
+        while True:
+            with diag.timer("makevls"):
+                item = next(labelsets, None)
+            if item is None:
+                break
+            varnames, vlinfo, command = item
+            ncommands += 1
+            with diag.timer("submit"):
+                if not isinstance(vlinfo, tuple):
+                    # a set streamed from disk is for a single variable and can be read only once,
+                    # so each label is set as it is read rather than collecting the set first
+                    if command == "VALUE LABELS":
+                        varlist[varnames[0]].valueLabels = {}
+                    vlinfo = setlabels(varlist[varnames[0]].valueLabels, vlinfo)
+                    if not syntax:
+                        collections.deque(vlinfo, maxlen=0)
+                elif command == "VALUE LABELS":
+                    labels = dict(vlinfo)
+                    for vname in varnames:
+                        varlist[vname].valueLabels = labels
+                else:
+                    for vname in varnames:
+                        collections.deque(setlabels(varlist[vname].valueLabels, vlinfo), maxlen=0)
+            if syntax:
+                cmd = vallblsengine.makevls(varnames, vlinfo, mkvl.isstring(varnames[0]), command)
+                f.write(cmd + "\n")
+                if diag.enabled:
+                    diag.run["syntaxbytes"] = diag.run.get("syntaxbytes", 0) + len(cmd.encode("utf_8")) + 1
+    diag.run["commands"] = ncommands
+    return ncommands
 
+def setlabels(vls, vlinfo):
+    """Set each value label of vlinfo in vls and generate the (value, label) pairs as they are set
+    
+    vls is the valueLabels object of a variable
+    vlinfo is an iterable of (value, label) pairs"""
+    
+    for value, label in vlinfo:
+        vls[value] = label
+        yield value, label
 
-def writesyntax(labelsyntax, syntax, mkvl):
-    if mkvl.unicodemode:
-        inputencoding = "unicode_internal"
-        outputencoding = "utf_8_sig"
+def opensyntax(syntax, unicodemode):
+    """Return a buffered file object for writing label syntax
+    
+    The file is UTF-8 with a byte order mark in Unicode mode and
+    uses the locale encoding otherwise."""
+    
+    if unicodemode:
+        encoding = "utf_8_sig"
     else:
-        inputencoding = locale.getlocale()[1]
-        outputencoding = inputencoding
-    with codecs.EncodedFile(codecs.open(syntax, "wb"), inputencoding, outputencoding) as f:            
-        for line in labelsyntax:
-            f.write(line + "\n")
+        encoding = locale.getlocale()[1] or locale.getpreferredencoding()
+    return open(syntax, "w", encoding=encoding, buffering=2**16)
 
 def resolve(vardict, itemtype, varlist, pattern, stringonly):
     """Return validated list of variables
@@ -156,25 +525,12 @@ def resolve(vardict, itemtype, varlist, pattern, stringonly):
     itemtype identifies the input description for error message purposes
     varlist is a sequence of variable names or None
     pattern is a regular expression or None
-    vardict is a variable dictionary
+    vardict is a VariableInfo object
     stringonly = True excludes numeric variables from pattern matches
     
     If pattern is used, list is returned in SPSS dictionary order"""
     
-    if (varlist is None and pattern is None) or\
-       (varlist is not None and pattern is not None):
-        raise ValueError(_("Either a variable list or a pattern must be specified but not both: %s") % itemtype)
-    
-    if varlist:
-        return vardict.expand(varlist)
-    else:
-        if stringonly:
-            selectedvars = vardict.variablesf(pattern=pattern, variableType="string")
-        else:
-            selectedvars = vardict.variablesf(pattern=pattern)
-        varsinorder = sorted([(vardict[vname].VariableIndex, vname)\
-            for vname in selectedvars])
-        return [vname for (index, vname) in varsinorder]    
+    return vallblsengine.resolve(vardict.varinfo(), itemtype, varlist, pattern, stringonly)
 
 
 
@@ -184,47 +540,138 @@ class Mkvls(object):
     aggrtemplate = """DATASET DECLARE %s.
 AGGREGATE /OUTFILE=%s /BREAK %s"""
 
+    longtemplate = """DATASET COPY %(copyname)s.
+DATASET ACTIVATE %(copyname)s.
+%(select)s
+VARSTOCASES %(make)s
+/INDEX=%(indexname)s(%(valname)s) /NULL=KEEP
+%(keep)s.
+SELECT IF %(lblname)s <> "".
+DATASET DECLARE %(aggrdsname)s.
+AGGREGATE /OUTFILE=%(aggrdsname)s /BREAK %(indexname)s %(valname)s%(lblbreak)s
+%(outvars)s."""
+
     def __init__(self, varstolabel, labelvars, varsperpass, execute, 
-        syntax, vardict):
+        syntax, vardict, diagnostics=None, maxconflicts=100, maxdups=100, rule="first"):
         
+        # maxdups is None if duplicate labels are not reported
         attributesFromDict(locals())
-        self.conflicts = {}   # a dictionary of sets of conflicts keyed  by varname
-        self.duplabels = {}   # a dictionary of sets of duplicate labels keyed by varname
-        self.vlabels = {}     # a dictionary of sets of value label/value pairs keyed by varname
-        self.values = {}      # a dictionary of sets of values keyed by varname
-        self.labelusage = {}  # a dictionary of dictionaries indexed by varnme and label text
-        
         # results are accumulated across data passes
-        for v in varstolabel:
-            self.conflicts[v] = set()
-            #self.duplabels[v] = 0
-            self.duplabels[v] = set()
-            self.vlabels[v] = set()
-            self.values[v] = set()
-            self.labelusage[v] = {}
+        self.tallies = dict((v, VarTally(maxconflicts, maxdups, rule)) for v in varstolabel)   # keyed by varname
+        self.counting = rule != "first"   # labels are aggregated with case counts rather than MIN and MAX
+        if diagnostics is None:
+            self.diagnostics = Diagnostics(False)
+        self.commands = CommandQueue(self.diagnostics)   # backend commands not yet submitted
+        self.passplan = []    # (first, last, count, estimated cells) for each pass if planned adaptively
+        self.firstcase = 0    # cases before this one have already been tallied
+        self.casenumber = None    # variable holding the case number, for selecting the later cases
+        self.digests = None   # (cases, checksums of the leading cases of each variable) from headdigests
+        self.baseline = {}    # labels already applied according to the label cache, keyed by varname
+        self.cacheinfo = None
+        self.samples = []     # vallblsengine.Sample objects if the cases were sampled
+        self.preflight = None # Preflight object if distinct values were estimated
+        self.store = None     # vallblsengine.SpillStore if tallies may be moved to disk
+        self.existing = None  # value labels already in the dictionary, keyed by varname, if labelling the changes
+        self.changed = set()  # variables for which labels were generated
+        self.progress = None  # Progress object if progress is reported
+        self.checkpoint = None  # checkpoint file to which each finished pass is appended
+        self.resumed = []     # variables restored from the checkpoint
+        self.exported = None  # (file, values written) if the label map was exported
         self.aggrdsname = mkrandomname(sav=False)
         self.unicodemode = spss.PyInvokeSpss.IsUTF8mode()
-        if self.unicodemode:
-            self.ec = codecs.getencoder("utf_8")   # must figure string length in bytes of utf-8
         
-    def doaggr(self, doindex):
+    def planpasses(self, plan, cellbudget, samplesize):
+        """Return a list of (start, count) duples defining the data passes
+        
+        plan is "fixed" to use VARSPERPASS variables per pass or "adaptive"
+        to pack variables into passes according to their estimated cardinality
+        cellbudget is the maximum estimated number of aggregate cases in a pass
+        samplesize is the number of cases used to estimate cardinality"""
+        
+        # variables isolated by the preflight split the list into segments planned separately
+        nvars = len(self.varstolabel)
+        isolated = self.preflight and self.preflight.high or []
+        segments = []
+        start = 0
+        for i in [i for i, vname in enumerate(self.varstolabel) if vname in isolated] + [nvars]:
+            if i > start:
+                segments.append((start, i))
+            if i < nvars:
+                segments.append((i, i + 1))
+            start = i + 1
+        
+        if plan == "fixed":
+            varsperpass = self.varsperpass or 20
+            return [(i, min(varsperpass, end - i)) for start, end in segments for i in range(start, end, varsperpass)]
+        
+        self.commands.flush()
+        cards = self.estimatecardinality(samplesize)
+        passes = []
+        for start, end in segments:
+            passes.extend([(start + i, count, cells) for i, count, cells in\
+                packpasses(cards[start:end], cellbudget, self.varsperpass, spss.GetCaseCount())])
+        self.passplan.extend([(self.varstolabel[start], self.varstolabel[start + count - 1], count, cells)\
+            for start, count, cells in passes])
+        return [(start, count) for start, count, cells in passes]
+    
+    def estimatecardinality(self, samplesize):
+        """Return a list of the estimated number of distinct values of each variable to label
+        
+        samplesize is the number of cases to read from the start of the file
+        
+        The estimate is the larger of the number of value labels already defined
+        and the number of distinct values in the sample.  If the values in the sample
+        hardly repeat, the count is extrapolated to the whole file.
+        If there was a preflight, its estimates are used instead."""
+        
+        if self.preflight:
+            return [max(self.preflight.estimates[vname], 1) for vname in self.varstolabel]
+        curs = spssdata.Spssdata(indexes=self.varstolabel, names=False, convertUserMissing=False)
+        sample = curs.fetchmany(samplesize)
+        curs.CClose()
+        nsample = len(sample)
+        ncases = spss.GetCaseCount()
+        cards = []
+        for v, vname in enumerate(self.varstolabel):
+            distinct = len(set([case[v] for case in sample]))
+            if distinct > nsample // 2 and ncases > nsample:
+                distinct = distinct * ncases // nsample
+            cards.append(max(distinct, len(self.vardict[vname].ValueLabels), 1))
+        return cards
+        
+    def doaggr(self, doindex, count):
         """create an aggregate dataset and tally values
         
-        doindex is the index into varstolabel at which to start"""
+        doindex is the index into varstolabel at which to start
+        count is the number of variables to process"""
         
-        vtl = self.varstolabel[doindex:doindex+self.varsperpass]
+        vtl = self.varstolabel[doindex:doindex+count]
         vtllen = len(vtl)
+        diag = self.diagnostics
+        diag.startpass(vtl)
         if len(self.labelvars) == 1:
             lbls = self.labelvars
             lastlbl = vtllen + 1
         else:
-            lbls = self.labelvars[doindex:doindex+self.varsperpass]
+            lbls = self.labelvars[doindex:doindex+count]
             lastlbl = 3 * vtllen - 1
-        brkvarlist = "\n".join(textwrap.wrap(" ".join(vtl), width=100))
-        outvars = ["/min_%s=MIN(%s)/max_%s=MAX(%s)" % (mkrandomname(), v, mkrandomname(), v) for v in lbls]
+        if self.counting:
+            # the label variables are break variables too, so each label is counted
+            pairs = vallblsengine.pairlabels(vtl, lbls)
+            brkvars = vtl + [lbl for lbl in dict.fromkeys(pairs) if not lbl in vtl]
+            lblpos = [brkvars.index(lbl) for lbl in pairs]
+            brkvarlist = "\n".join(textwrap.wrap(" ".join(brkvars), width=100))
+            outvars = ["/%s=N" % mkrandomname()]
+        else:
+            brkvarlist = "\n".join(textwrap.wrap(" ".join(vtl), width=100))
+            outvars = ["/min_%s=MIN(%s)/max_%s=MAX(%s)" % (mkrandomname(), v, mkrandomname(), v) for v in lbls]
         aggrcmd = Mkvls.aggrtemplate % (self.aggrdsname, self.aggrdsname, brkvarlist) + "\n".join(outvars)
-        spss.Submit(aggrcmd)
-        spss.Submit("DATASET ACTIVATE %s" % self.aggrdsname)
+        if self.firstcase:
+            aggrcmd = "TEMPORARY.\nSELECT IF %s > %s.\n" % (self.casenumber, self.firstcase) + aggrcmd
+        with diag.timer("aggregate"):
+            self.commands.add([aggrcmd, "DATASET ACTIVATE %s" % self.aggrdsname])
+            self.commands.flush()
+        self.startpass(vtl)
         
         # for each variable, build label information based on data
         # AGGREGATE dataset structure:
@@ -232,65 +679,423 @@ AGGREGATE /OUTFILE=%s /BREAK %s"""
         # but if only one label set, only one pair of label aggregates is produced
         # user missing values are exposed and subject to labelling
         
-        curs = spssdata.Spssdata(names=False, convertUserMissing=False)
-        for case in curs:
+        with diag.timer("tally"):
+            curs = spssdata.Spssdata(names=False, convertUserMissing=False)
+            rows = 0
+            try:
+                if self.counting:
+                    rows = self.tallycounts(curs, vtl, lblpos, len(brkvars))
+                elif vallblsengine.numpy is None:
+                    for case in curs:
+                        rows += 1
+                        if rows % 10000 == 0:
+                            self.blockdone(rows)
+                        for v, vname in enumerate(vtl):
+                            self.tally(vname, case[v],
+                                self.truncate(case[min(vtllen + v*2, lastlbl-1)], 120).rstrip(),
+                                self.truncate(case[min(vtllen + v*2 + 1, lastlbl)], 120).rstrip())
+                else:
+                    # only the first occurrence of each distinct row pattern in a block is tallied
+                    while True:
+                        block = curs.fetchmany(50000)
+                        if not block:
+                            break
+                        rows += len(block)
+                        columns = vallblsengine.BlockColumns(block)
+                        for v, vname in enumerate(vtl):
+                            minpos, maxpos = min(vtllen + v*2, lastlbl-1), min(vtllen + v*2 + 1, lastlbl)
+                            for i in columns.firstdistinct(v, self.isstring(vname), minpos, maxpos):
+                                case = block[i]
+                                self.tally(vname, case[v],
+                                    self.truncate(case[minpos], 120).rstrip(),
+                                    self.truncate(case[maxpos], 120).rstrip())
+                        # after the block, so the budget also covers the last one
+                        self.blockdone(rows)
+            finally:
+                curs.CClose()
+        diag.addrows(rows)
+        self.passdone(vtl, rows)
+        with diag.timer("close"):
+            # submitted with the commands for whatever comes next
+            self.commands.add("DATASET CLOSE %s" % self.aggrdsname)
+        
+    def tallycounts(self, curs, vtl, lblpos, npos):
+        """tally an aggregate of values, labels, and case counts and return the number of rows
+        
+        curs is a cursor on the aggregate
+        vtl is the list of variables to label, which come first
+        lblpos is the position of the label variable of each
+        npos is the position of the case count"""
+        
+        rows = 0
+        while True:
+            block = curs.fetchmany(50000)
+            if not block:
+                break
+            rows += len(block)
+            self.blockdone(rows)
+            if vallblsengine.numpy is None:
+                distinct = [(range(len(block)), [case[npos] for case in block])] * len(vtl)
+            else:
+                columns = vallblsengine.BlockColumns(block)
+                distinct = [columns.distinctcounts(v, self.isstring(vname), lblpos[v], npos)\
+                    for v, vname in enumerate(vtl)]
             for v, vname in enumerate(vtl):
-                value = case[v]
-                minlbl = self.truncate(case[min(vtllen + v*2, lastlbl-1)], 120).rstrip()
-                maxlbl = self.truncate(case[min(vtllen + v*2 + 1, lastlbl)], 120).rstrip()
-                # more than one label for the same value?
-                if minlbl != maxlbl and (minlbl != "" and minlbl is not None):
-                    self.conflicts[vname].add(value)
-                # ignore empty or missing labels
-                if maxlbl != "" and maxlbl is not None:
-                    # if the value has already been seen but with a different label, it's a conflict
-                    if value in self.values[vname] and not (value, maxlbl) in self.vlabels[vname]:
-                        self.conflicts[vname].add(value)
+                for i, n in zip(*distinct[v]):
+                    label = self.truncate(block[i][lblpos[v]], 120).rstrip()
+                    self.tally(vname, block[i][v], label, label, n)
+        return rows
+        
+    def dolong(self, dsname):
+        """restack and aggregate all the variables in long format and tally values
+        
+        dsname is the name of the input dataset
+        Variables to label are restacked separately by type, since a
+        restacked value variable must be all numeric or all string"""
+        
+        if len(self.labelvars) == 1:
+            lbls = len(self.varstolabel) * self.labelvars
+        else:
+            lbls = self.labelvars
+        for wantstring in [False, True]:
+            pairs = [(v, lbl) for v, lbl in zip(self.varstolabel, lbls)\
+                if self.vardict.isstring(v) == wantstring]
+            if pairs:
+                self.commands.add("""DATASET ACTIVATE %s""" % dsname)
+                self.doaggrlong([v for v, lbl in pairs], [lbl for v, lbl in pairs])
+        
+    def doaggrlong(self, vtl, lbls):
+        """create a long-format aggregate dataset and tally values
+        
+        vtl is the list of variables to label.  They must all have the same type.
+        lbls is the list of corresponding label variables
+        
+        The active dataset is copied and restacked into cases of
+        (variable name, value, label), and that is aggregated by variable name and value,
+        so the aggregate size is the sum of the variable cardinalities rather than their product.
+        Cases with a blank label are dropped before aggregating, since they can
+        neither supply a label nor hide a conflict."""
+        
+        copyname = mkrandomname(sav=False)
+        indexname, valname, lblname, minname, maxname = [mkrandomname("V", sav=False) for i in range(5)]
+        make = "/MAKE %s FROM %s" % (valname, " ".join(vtl))
+        if len(set(lbls)) == 1:
+            # a single label variable is carried along unchanged
+            lblname = lbls[0]
+            keep = "/KEEP=%s" % lblname
+        else:
+            make = make + " /MAKE %s FROM %s" % (lblname, " ".join(lbls))
+            needed = set(v.lower() for v in vtl + lbls)
+            others = [v for v in self.vardict.variables if not v.lower() in needed]
+            if self.casenumber:
+                others.append(self.casenumber)
+            keep = others and "/DROP=%s" % " ".join(others) or ""
+        cmd = Mkvls.longtemplate % {
+            "copyname": copyname, "aggrdsname": self.aggrdsname,
+            "make": "\n".join(textwrap.wrap(make, width=100)), "keep": "\n".join(textwrap.wrap(keep, width=100)),
+            "indexname": indexname, "valname": valname, "lblname": lblname,
+            "lblbreak": self.counting and " " + lblname or "",
+            "outvars": self.counting and "/%s=N" % minname or
+                "/%s=MIN(%s) /%s=MAX(%s)" % (minname, lblname, maxname, lblname),
+            "select": self.firstcase and "SELECT IF %s > %s." % (self.casenumber, self.firstcase) or ""}
+        diag = self.diagnostics
+        diag.startpass(vtl)
+        with diag.timer("aggregate"):
+            self.commands.add([cmd, "DATASET ACTIVATE %s" % self.aggrdsname, "DATASET CLOSE %s" % copyname])
+            self.commands.flush()
+        self.startpass(vtl)
+        
+        # AGGREGATE dataset structure:
+        # variable name, value, min(text lbl), max(text lbl)
+        # or, if counting, variable name, value, text lbl, count
+        with diag.timer("tally"):
+            curs = spssdata.Spssdata(names=False, convertUserMissing=False)
+            rows = 0
+            try:
+                for vname, value, minlbl, maxlbl in curs:
+                    rows += 1
+                    if rows % 10000 == 0:
+                        self.blockdone(rows)
+                    if self.counting:
+                        label = self.truncate(minlbl, 120).rstrip()
+                        self.tally(vname.rstrip(), value, label, label, maxlbl)
                     else:
-                        self.vlabels[vname].add((value, maxlbl))  # first one wins
-                        self.values[vname].add(value)
-                        # tally instances where the same label used for different value
-                        # need to see whether labels has been assigned to a different value
-                        previousvalue =  self.labelusage[vname].get(maxlbl, None)
-                        if previousvalue is not None and value != previousvalue:
-                            ###self.duplabels[vname] = self.duplabels[vname] + 1
-                            self.duplabels[vname].add(maxlbl)
-                        self.labelusage[vname][maxlbl] = value
-
-        curs.CClose()
-        spss.Submit("DATASET CLOSE %s" % self.aggrdsname)
+                        self.tally(vname.rstrip(), value,
+                            self.truncate(minlbl, 120).rstrip(), self.truncate(maxlbl, 120).rstrip())
+            finally:
+                curs.CClose()
+        diag.addrows(rows)
+        self.passdone(vtl, rows)
+        with diag.timer("close"):
+            # submitted with the commands for whatever comes next
+            self.commands.add("DATASET CLOSE %s" % self.aggrdsname)
+        
+    def dostream(self, stablecases=None, maxsample=None):
+        """tally values and labels directly from the active dataset in a single data pass
+        
+        stablecases and maxsample, if either is given, limit reading to a sample of the cases
+        as in vallblsengine.Sample
+        
+        Only the variables to label and the label variables are read.  Each case
+        is tallied as it is read, so no aggregate dataset is created."""
+        
+        self.commands.flush()
+        source = SpssSource(self.vardict, self.firstcase)
+        diag = self.diagnostics
+        diag.startpass(self.varstolabel)
+        if stablecases or maxsample:
+            sample = vallblsengine.Sample(self.tallies, self.varstolabel, stablecases, maxsample)
+            self.samples.append(sample)
+            blocksize = 1000
+        else:
+            sample = None
+            blocksize = 10000
+        if self.progress is not None:
+            ncases = spss.GetCaseCount() - self.firstcase
+            self.progress.startpass(len(self.varstolabel), maxsample and min(maxsample, ncases) or ncases)
+            onblock = self.progress.rows
+        else:
+            onblock = None
+        with diag.timer("tally"):
+            vallblsengine.tallycases(source, self.varstolabel, self.labelvars,
+                self.tallies, self.unicodemode, blocksize, sample, self.store, onblock)
+        diag.addrows(source.rows)
+        self.passdone(self.varstolabel, source.rows)
+        
+    def subset(self, vtl, firstcase):
+        """Return a Mkvls for some of the variables, starting at firstcase
+        
+        The new object shares the tallies, plan, and diagnostics of this one"""
+        
+        if len(self.labelvars) == 1:
+            lbls = self.labelvars
+        else:
+            lbls = [self.labelvars[self.varstolabel.index(v)] for v in vtl]
+        work = Mkvls(vtl, lbls, self.varsperpass, self.execute, self.syntax, self.vardict, self.diagnostics,
+            self.maxconflicts, self.maxdups, self.rule)
+        work.tallies = self.tallies
+        work.passplan = self.passplan
+        work.samples = self.samples
+        work.preflight = self.preflight
+        work.store = self.store
+        work.commands = self.commands
+        work.progress = self.progress
+        work.checkpoint = self.checkpoint
+        work.firstcase = firstcase
+        work.casenumber = self.casenumber
+        work.digests = self.digests
+        return work
+        
+    def fingerprint(self, vname, digests):
+        """Return a string identifying a variable to label and its label source
+        
+        digests is the dictionary of checksums of their leading cases from headdigests"""
+        
+        lbl = vallblsengine.pairlabels(self.varstolabel, self.labelvars)[self.varstolabel.index(vname)]
+        return "%s %s %s %s %s %s %s %s" % (vname, self.vardict.vartype(vname),
+            lbl, self.vardict.vartype(lbl), self.unicodemode, self.maxdups is not None, self.rule, digests[vname])
+        
+    def headdigests(self, cases):
+        """Return a dictionary of checksums of the leading cases of each variable to label and its label variable
+        
+        cases is the number of cases to include, up to HEADCASES.  A different file
+        with the same variables will almost always differ in these.  Appending cases
+        does not change them, as long as the same number of cases is checked.
+        The active dataset must be the input.  The checksums are kept and shared with
+        subsets, so the data are read again only for a different number of cases."""
+        
+        cases = min(max(cases, 0), HEADCASES)
+        if self.digests is None or self.digests[0] != cases:
+            self.commands.flush()
+            names = list(dict.fromkeys(self.varstolabel + self.labelvars))
+            rows = []
+            if cases:
+                curs = spssdata.Spssdata(indexes=names, names=False, convertUserMissing=False)
+                rows = curs.fetchmany(cases)
+                curs.CClose()
+            columns = dict((name, [row[i] for row in rows]) for i, name in enumerate(names))
+            self.digests = (cases, dict((v, hashlib.sha1(json.dumps([columns[v], columns[lbl]]).encode("utf_8")).hexdigest())
+                for v, lbl in zip(self.varstolabel, vallblsengine.pairlabels(self.varstolabel, self.labelvars))))
+        return self.digests[1]
+        
+    def loadcache(self, cachefile, key):
+        """seed the tallies from the label cache and return the work to do
+        
+        cachefile is the cache file, which need not exist yet
+        key identifies the dataset within the cache
+        
+        Returns a list of (variables, first case) duples.  Variables whose fingerprint
+        matches the cache need only the cases added since the cache was saved.
+        Cases are assumed to have been appended, so if the case count is unknown or has
+        decreased, everything is processed from the start."""
+        
+        self.commands.flush()
+        ncases = spss.GetCaseCount()
+        cachedcases, cached = vallblsengine.loadcache(cachefile, key, self.maxconflicts, self.maxdups, self.rule)
+        if ncases < 0 or cachedcases > ncases:
+            cached = {}
+        digests = self.headdigests(cachedcases)
+        for vname in self.varstolabel:
+            fingerprint, tally = cached.get(vname, (None, None))
+            if fingerprint == self.fingerprint(vname, digests):
+                self.tallies[vname] = tally
+                self.baseline[vname] = dict(tally.labels)
+        full = [v for v in self.varstolabel if not v in self.baseline]
+        incremental = [v for v in self.varstolabel if v in self.baseline]
+        self.cacheinfo = (cachefile, len(incremental), cachedcases)
+        workgroups = []
+        if full:
+            workgroups.append((full, 0))
+        if incremental and cachedcases < ncases:
+            workgroups.append((incremental, cachedcases))
+        return workgroups
+    
+    def numbercases(self, dsname):
+        """add a variable holding the case number to the input dataset dsname
+        
+        Aggregate passes over just the cases added since the cache was saved select
+        them with it.  $CASENUM cannot be used in SELECT IF, since it counts only
+        the cases selected so far, so it is copied to a variable in a pass of its own.
+        dropcasenumber deletes the variable."""
+        
+        self.casenumber = mkrandomname("V", sav=False)
+        self.commands.add(["DATASET ACTIVATE %s" % dsname, "COMPUTE %s = $CASENUM" % self.casenumber, "EXECUTE"])
+        
+    def dropcasenumber(self):
+        """delete the case number variable, if any, from the active dataset"""
+        
+        if self.casenumber:
+            self.commands.add("DELETE VARIABLES %s" % self.casenumber)
+            self.casenumber = None
+        
+    def savecache(self, cachefile, key):
+        """save the tallies to the label cache"""
+        
+        self.commands.flush()
+        ncases = spss.GetCaseCount()
+        digests = self.headdigests(ncases)
+        vallblsengine.savecache(cachefile, key, ncases,
+            dict((v, (self.fingerprint(v, digests), self.tallies[v])) for v in self.varstolabel))
+        
+    def tally(self, vname, value, minlbl, maxlbl, n=1):
+        """accumulate the label information for one value of one variable
+        
+        vname is the variable name
+        value is the value
+        minlbl and maxlbl are the smallest and largest labels observed for it
+        n is the number of cases, which matters only if counting"""
+        
+        if isinstance(value, str):
+            value = value.rstrip()   # restacking may pad string values
+        self.tallies[vname].add(value, minlbl, maxlbl, n)
+    
+    def resolveconflicts(self):
+        """choose the labels of conflicting values by the conflict rule"""
+        
+        vallblsengine.resolvetallies(self.tallies)
+    
+    def startpass(self, vtl):
+        """start reporting the progress of a data pass over vtl
+        
+        The active dataset must be the one the pass reads."""
+        
+        if self.progress is not None:
+            self.progress.startpass(len(vtl), spss.GetCaseCount())
+    
+    def blockdone(self, rows):
+        """check the memory budget and report progress after a block of rows of a pass"""
+        
+        self.checkmemory()
+        if self.progress is not None:
+            self.progress.rows(rows)
+    
+    def passdone(self, vtl, rows):
+        """checkpoint the tallies of a finished pass over vtl and report progress"""
+        
+        if self.checkpoint is not None:
+            vallblsengine.appendcheckpoint(self.checkpoint,
+                dict((v, (self.fingerprint(v, self.digests[1]), self.tallies[v])) for v in vtl))
+        if self.progress is not None:
+            self.progress.passdone(rows)
+    
+    def resume(self, checkpoint, key):
+        """restore the tallies of the variables finished by an earlier run and return their names
+        
+        checkpoint is the checkpoint file, which need not exist yet.  It is restarted
+        with just the restored tallies, and each pass is then appended to it.
+        key identifies the dataset
+        
+        The tallies of a variable are restored only if its fingerprint matches
+        and the case count has not changed."""
+        
+        self.commands.flush()
+        ncases = spss.GetCaseCount()
+        saved = vallblsengine.loadcheckpoint(checkpoint, key, ncases, self.maxconflicts, self.maxdups, self.rule)
+        digests = self.headdigests(ncases)
+        self.resumed = [v for v in self.varstolabel if saved.get(v, (None, None))[0] == self.fingerprint(v, digests)]
+        for vname in self.resumed:
+            self.tallies[vname] = saved[vname][1]
+        vallblsengine.startcheckpoint(checkpoint, key, ncases, 
+            dict((v, (self.fingerprint(v, digests), self.tallies[v])) for v in self.resumed))
+        self.checkpoint = checkpoint
+        return self.resumed
+    
+    def checkmemory(self):
+        """move tallies to disk if they exceed the memory budget"""
+        
+        if self.store is not None:
+            self.store.check(self.tallies)
+                    
+    def readexisting(self):
+        """read the value labels the variables to label already have
+        
+        Only labels that are new or differ from these are then generated."""
+        
+        self.commands.flush()
+        self.existing = {}
+        spss.StartDataStep()
+        try:
+            varlist = spss.Dataset().varlist
+            for vname in self.varstolabel:
+                labels = varlist[vname].valueLabels.data
+                if self.isstring(vname):
+                    # string values may be padded to the variable width
+                    labels = dict((value.rstrip(), label) for value, label in labels.items())
+                self.existing[vname] = dict(labels)
+        finally:
+            spss.EndDataStep()
                     
     def dolabels(self):
-        """generate, save, and run labelling syntax and write reports"""
+        """Return a generator of the labelling syntax commands"""
+        
+        for varnames, vlinfo, command in self.labelsets():
+            yield vallblsengine.makevls(varnames, vlinfo, self.isstring(varnames[0]), command)
+    
+    def labelsets(self):
+        """Return a generator of (varnames, value label pairs, command) triples"""
         
-        vlsyntax = []
-        for k,v in sorted(self.vlabels.items()):
-            vlsyntax.append(self.makevls(k,v))
-        return vlsyntax
+        for varnames, vlinfo, command in vallblsengine.labelsets(self.tallies, self.baseline, self.existing,
+                self.vardict.vartype):
+            self.changed.update(varnames)
+            yield varnames, vlinfo, command
             
-    def makevls(self, varname, vlinfo):
-        """Return value label syntax
+    def isstring(self, varname):
+        """Return True if varname is a string variable"""
         
-        varname is the variable to which the syntax applies
-        vlinfo is the set of duples of (value, label)"""
+        return self.vardict.isstring(varname)
         
-        isstring = self.vardict[varname].VariableType > 0
-        vls = []
-        for value, label in sorted(vlinfo):
-            if isstring:
-                value = spssaux._smartquote(value)
-            else:
-                if value == int(value):
-                    value = int(value)
-            label = spssaux._smartquote(label)
-            vls.append("%s %s" % (value, label))
-        return "VALUE LABELS " + varname + "\n   " + "\n   ".join(vls) + "."
-        
-    def report(self, labelsyntax):
+    def report(self, ncommands):
         # write report
         
-        if not labelsyntax:
-            print(_("""No value labels were generated."""))
+        if not ncommands:
+            if self.existing is not None:
+                print(_("""The variables already have all the generated labels.  No value labels were changed."""))
+            else:
+                print(_("""No value labels were generated."""))
+            if self.diagnostics.enabled:
+                StartProcedure(_("""Generate Value Labels"""), "STATSVALLBLSFROMDATA")
+                self.diagnostics.report()
+                spss.EndProcedure()
             return
         
         if len(self.labelvars) > 1:
@@ -299,27 +1104,122 @@ AGGREGATE /OUTFILE=%s /BREAK %s"""
             labelvars = len(self.varstolabel) * [self.labelvars][0]
         spss.StartProcedure("Generate Value Labels", "STATSVALLBLSFROMDATA")            
         cells = [[labelvars[i], 
-            spss.CellText.Number(len(self.conflicts[vname]), spss.FormatSpec.Count), 
-            #spss.CellText.Number(self.duplabels[vname], spss.FormatSpec.Count)]\
-            spss.CellText.Number(len(self.duplabels[vname]), spss.FormatSpec.Count)]\
+            spss.CellText.Number(self.tallies[vname].nconflicts, spss.FormatSpec.Count)]\
             for i,vname in enumerate(self.varstolabel)]
+        collabels = [_("""Label Source"""), _("""Label Conflicts""")]
+        if self.maxdups is not None:
+            for i, vname in enumerate(self.varstolabel):
+                cells[i].append(spss.CellText.Number(self.tallies[vname].nduplabels, spss.FormatSpec.Count))
+            collabels.append(_("""Duplicate Labels"""))
+        if self.samples:
+            early = set()
+            for sample in self.samples:
+                early.update(sample.decidedearly())
+            for i, vname in enumerate(self.varstolabel):
+                cells[i].append(vname in early and _("""Yes""") or _("""No"""))
+            collabels.append(_("""Decided Early"""))
         caption = []
         if self.syntax:
             caption.append(_("""Generated label syntax: %s""" % self.syntax))
+        if self.exported:
+            caption.append(_("""Label map exported to %s: %s values""") % self.exported)
         if self.execute:
-            caption.append(_("""Generated label syntax was applied"""))
+            caption.append(_("""The generated labels were applied"""))
         else:
-            caption.append(_("""Generated label syntax was not applied"""))
+            caption.append(_("""The generated labels were not applied"""))
         caption.append(_("""A conflict means that different labels would be applied to the same value."""))
-        caption.append(_("""A duplicate means that the same label was used for different values."""))
+        if self.rule == "mostfrequent":
+            caption.append(_("""Conflicts were resolved by using the most frequent label."""))
+        elif self.rule == "longest":
+            caption.append(_("""Conflicts were resolved by using the longest label."""))
+        if self.maxdups is not None:
+            caption.append(_("""A duplicate means that the same label was used for different values."""))
+        for sample in self.samples:
+            if sample.stopped:
+                caption.append(_("""Reading stopped after %s cases.  Variables decided early were stable for at least %s cases.""")
+                    % (sample.cases, sample.stablecases or "-"))
+            else:
+                caption.append(_("""All %s cases were read""") % sample.cases)
+        if self.cacheinfo:
+            caption.append(_("""Label cache: %s.  %s variables were updated from the cases after case %s with ADD VALUE LABELS""")
+                % self.cacheinfo)
+        if self.existing is not None:
+            caption.append(_("""Only new or changed labels were added.  %s variables needed no changes""")
+                % len([v for v in self.varstolabel if not v in self.changed]))
+        if self.resumed:
+            caption.append(_("""Checkpoint: %s.  %s variables finished by an earlier run were restored""")
+                % (self.checkpoint, len(self.resumed)))
+        if self.store is not None and self.store.spilled:
+            caption.append(_("""Tallies for %s variables were moved to disk to stay within MEMORYBUDGET: %s""")
+                % (len(self.store.spilled), " ".join(self.store.spilled)))
+        peak = peakmemory()
+        if peak is not None:
+            caption.append(_("""Peak memory use: %.1f MB""") % peak)
             
         tbl = spss.BasePivotTable(_("""Value Label Generation"""), "VALLBLSFROMDATA",
             caption="\n".join(caption))
         tbl.SimplePivotTable(rowdim= _("""Variable"""), rowlabels=self.varstolabel, 
-            collabels=[_("""Label Source"""), _("""Label Conflicts"""), _("""Duplicate Labels""")],
-            cells=cells)
+            collabels=collabels, cells=cells)
+        self.reportexamples()
+        if self.preflight:
+            self.preflight.report()
+        if self.passplan:
+            self.reportplan()
+        if self.diagnostics.enabled:
+            self.diagnostics.report()
         spss.EndProcedure()
         
+    def reportexamples(self):
+        """display the retained examples of conflicts and duplicate labels
+        
+        At most MAXCONFLICTS conflicts and MAXDUPS duplicates are listed
+        across all the variables, taken in variable order"""
+        
+        nconflicts = sum(self.tallies[v].nconflicts for v in self.varstolabel)
+        cells = []
+        for vname in self.varstolabel:
+            tally = self.tallies[vname]
+            for value, label, other in tally.conflicts[:self.maxconflicts - len(cells)]:
+                cells.append([vname, showvalue(value), label, other])
+                if self.counting:
+                    cells[-1].append(spss.CellText.Number(100. * tally.shares[value], spss.FormatSpec.Percent))
+        if cells:
+            collabels = [_("""Variable"""), _("""Value"""), _("""Label Used"""), _("""Other Label""")]
+            if self.counting:
+                collabels.append(_("""Winning Share"""))
+            tbl = spss.BasePivotTable(_("""Label Conflicts"""), "VALLBLSFROMDATACONFLICTS",
+                caption=_("""%s of %s conflicts are listed""") % (len(cells), nconflicts))
+            tbl.SimplePivotTable(rowdim=_("""Conflict"""), rowlabels=[str(i+1) for i in range(len(cells))],
+                collabels=collabels, cells=cells)
+            
+        if self.maxdups is None:
+            return
+        ndups = sum(self.tallies[v].nduplabels for v in self.varstolabel)
+        cells = []
+        for vname in self.varstolabel:
+            for label, first, other in self.tallies[vname].duplabels[:self.maxdups - len(cells)]:
+                cells.append([vname, label, showvalue(first), showvalue(other)])
+        if cells:
+            tbl = spss.BasePivotTable(_("""Duplicate Labels"""), "VALLBLSFROMDATADUPS",
+                caption=_("""%s of %s duplicate labels are listed""") % (len(cells), ndups))
+            tbl.SimplePivotTable(rowdim=_("""Duplicate"""), rowlabels=[str(i+1) for i in range(len(cells))],
+                collabels=[_("""Variable"""), _("""Label"""), _("""First Value"""), _("""Other Value""")],
+                cells=cells)
+        
+    def reportplan(self):
+        """display the adaptive data pass plan"""
+        
+        cells = []
+        for first, last, count, estcells in self.passplan:
+            cells.append([first, last,
+                spss.CellText.Number(count, spss.FormatSpec.Count),
+                spss.CellText.Number(estcells, spss.FormatSpec.Count)])
+        tbl = spss.BasePivotTable(_("""Data Pass Plan"""), "VALLBLSFROMDATAPLAN",
+            caption=_("""Variables were packed into passes according to their estimated number of distinct values"""))
+        tbl.SimplePivotTable(rowdim=_("""Pass"""), rowlabels=[str(i+1) for i in range(len(cells))],
+            collabels=[_("""First Variable"""), _("""Last Variable"""), _("""Variables"""), _("""Estimated Cases""")],
+            cells=cells)
+        
     def truncate(self, name, maxlength):
         """Return a name truncated to no more than maxlength BYTES.
         
@@ -332,24 +1232,77 @@ AGGREGATE /OUTFILE=%s /BREAK %s"""
         
         if name is None:
             return None
-        if not self.unicodemode:
-            name =  name[:maxlength]
-        else:
-            newname = []
-            nnlen = 0
-            
-            # In Unicode mode, length must be calculated in terms of utf-8 bytes
-            for c in name:
-                c8 = self.ec(c)[0]   # one character in utf-8
-                nnlen += len(c8)
-                if nnlen <= maxlength:
-                    newname.append(c)
-                else:
-                    break
-            name = "".join(newname)
-        if name[-1] == "_":
-            name = name[:-1]
-        return name    
+        if not self.diagnostics.enabled:
+            return vallblsengine.truncatebytes(name, maxlength, self.unicodemode)
+        start = time.perf_counter()
+        name = vallblsengine.truncatebytes(name, maxlength, self.unicodemode)
+        self.diagnostics.passes[-1]["truncate"] += time.perf_counter() - start
+        return name
+    
+def showvalue(value):
+    """Return a variable value as text for a report"""
+    
+    if isinstance(value, float) and value == int(value):
+        value = int(value)
+    return str(value)
+
+def peakmemory():
+    """Return the peak memory use of this process in MB or None if it cannot be determined"""
+    
+    try:
+        if sys.platform == "win32":
+            import ctypes
+            from ctypes import wintypes
+            class ProcessMemoryCounters(ctypes.Structure):
+                _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                    ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                    ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                    ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+            counters = ProcessMemoryCounters()
+            counters.cb = ctypes.sizeof(counters)
+            if not ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(),
+                ctypes.byref(counters), counters.cb):
+                return None
+            return counters.PeakWorkingSetSize / 1048576.
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == "darwin":
+            return peak / 1048576.   # bytes
+        return peak / 1024.          # kilobytes
+    except:
+        return None
+
+def packpasses(cards, cellbudget, maxvars=None, ncases=-1):
+    """Return a list of (start, count, cells) triples packing variables into data passes
+    
+    cards is a list of estimated cardinalities in variable order
+    cellbudget is the maximum estimated number of aggregate cases for a pass
+    maxvars, if not None, limits the number of variables in a pass
+    ncases is the number of cases in the file or -1 if unknown
+    
+    Consecutive variables are added to a pass as long as the product of their
+    cardinalities, which bounds the aggregate size, stays within the budget.
+    The aggregate can never have more cases than the file, so the product is
+    capped at the case count when that is known.  A variable that exceeds the budget
+    on its own gets a pass to itself."""
+    
+    passes = []
+    start = 0
+    cells = 1
+    for i, card in enumerate(cards):
+        newcells = cells * card
+        if ncases > 0:
+            newcells = min(newcells, ncases)
+        count = i - start
+        if count > 0 and (newcells > cellbudget or (maxvars and count >= maxvars)):
+            passes.append((start, count, cells))
+            start = i
+            newcells = card if ncases <= 0 else min(card, ncases)
+        cells = newcells
+    if cards:
+        passes.append((start, len(cards) - start, cells))
+    return passes
 
 def mkrandomname(prefix="D", sav=True):
     res = prefix + str(random.uniform(.01,1.0))
@@ -357,56 +1310,210 @@ def mkrandomname(prefix="D", sav=True):
         res = res + ".sav"
     return res
 
-    def __init__(self):
-        self.wdsname = mkrandomname("D", sav=False)
-        
-    def getsav(self, filespec, delete=True):
-        """Open sav file and return all contents
-        
-        filespec is the file path
-        filespec is deleted after the contents are read unless delete==False"""
-     
-        item = self.wdsname
-        spss.Submit(r"""get file="%(filespec)s".
-DATASET NAME %(item)s.
-DATASET ACTIVATE %(item)s.""" % locals())
-        contents = spssdata.Spssdata(names=False).fetchall()
-        spss.Submit("""DATASET CLOSE %(item)s.
-        NEW FILE.""" % locals())
-        if delete:
-            os.remove(filespec)
-        return contents
-
-    """return list of syntax specs
-    
-    root is the root of the name for the left hand variable
-    setn is the set number
-    setvars is the list of variables in the set
-    data is the table of unstandardized canconical coefficients
-        - one column per canonical correlation
-    ndims can trim the number of correlations used."""
-    
-    syntax = []
-    nvars = len(setvars)
-    ncor = len(data[0])
-    if not ndims is None:
-        ncor = min(ncor, ndims)
-    newnames = set()
-    for i in range(ncor):
-        cname = root + "_set" + str(setn) + "_" + str(i+1)
-        newnames.add(cname)
-        if len(cname) > 64:
-            raise ValueError(_("The specified root name is too long: %s") % root)
-        s = ["COMPUTE " + cname + " = "]
-        for j in range(nvars):
-            s.append(str(data[j][i]) + " * " + setvars[j])
-        syntax.append(s[0] + " + ".join(s[1:]))
-        syntax[i] = "\n".join(textwrap.wrap(syntax[i])) +"."
-
-    return "\n".join(syntax), newnames
+class Cancelled(Exception):
+    """raised to stop a run when a progress function asks for it"""
 
+class Progress(object):
+    """Progress of a run, reported after each block of rows and each data pass
+    
+    Each event is a dictionary with the event ("block" or "pass"), the number of
+    variables done and in all, the rows tallied in the current pass and the rows
+    in it, if known, the seconds elapsed, and the estimated seconds remaining or None.
+    The estimate assumes every variable takes as long as those done so far.
+    
+    A progress function cancels the run by returning False or by raising Cancelled.
+    Nothing more is tallied, and Cancelled is raised out of dolabels once the
+    active dataset is restored.  A checkpoint keeps every pass finished so far,
+    including one whose "pass" event cancelled the run, so the run can be resumed."""
+    
+    def __init__(self, target, total):
+        """target is a function to call with each event or a file to which events are written
+        total is the number of variables to process"""
+        
+        self.total = max(total, 1)
+        self.done = 0
+        self.passvars = 0
+        self.passrows = None
+        self.started = time.perf_counter()
+        if callable(target):
+            self.callback = target
+            self.file = None
+        else:
+            self.callback = None
+            self.file = open(target, "w", encoding="utf_8", buffering=1)
+            
+    def startpass(self, nvars, passrows):
+        """start a pass over nvars variables that will read passrows rows if known or None"""
+        
+        self.passvars = nvars
+        self.passrows = passrows
+        
+    def rows(self, rows):
+        """report that rows rows of the current pass have been tallied"""
+        
+        fraction = self.passrows and min(rows / self.passrows, 1.) or 0.
+        self.event("block", rows, self.done + fraction * self.passvars)
+        
+    def passdone(self, rows):
+        """report that the current pass is finished after tallying rows rows"""
+        
+        self.done += self.passvars
+        self.event("pass", rows, self.done)
+        self.passvars = 0
+        
+    def event(self, kind, rows, done):
+        """send one event.  done is the number of variables done, which may be fractional"""
+        
+        elapsed = time.perf_counter() - self.started
+        remaining = elapsed * (self.total - done) / done if done > 0 else None
+        event = {"event": kind, "variablesdone": self.done, "variables": self.total,
+            "rows": rows, "passrows": self.passrows, "elapsed": elapsed, "remaining": remaining}
+        if self.callback is not None:
+            if self.callback(event) is False:
+                raise Cancelled(_("""The run was cancelled by the progress function"""))
+        else:
+            line = _("""%s: %s of %s variables done, %s rows tallied in this pass, %.1f seconds elapsed""") %\
+                (time.strftime("%H:%M:%S"), self.done, self.total, rows, elapsed)
+            if remaining is not None:
+                line += _(""", about %.0f seconds remaining""") % remaining
+            self.file.write(line + "\n")
+            
+    def close(self):
+        """close the progress file, if any"""
+        
+        if self.file is not None:
+            self.file.close()
 
+class CommandQueue(object):
+    """Commands waiting to be submitted together
+    
+    Each Submit is a round trip to the backend, so commands are queued and
+    sent as a single Submit when their results are needed: before a cursor
+    is opened, the case count is read, or a data step is started."""
+    
+    def __init__(self, diagnostics):
+        """diagnostics is the Diagnostics object, which logs each batch if enabled"""
+        
+        self.diagnostics = diagnostics
+        self.pending = []
+        self.size = 0         # characters pending
+        
+    def add(self, cmds):
+        """queue a command or a list of commands
+        
+        A command without a terminating period gets one, since the
+        next command in the batch must not be read as its continuation."""
+        
+        if isinstance(cmds, str):
+            cmds = [cmds]
+        for cmd in cmds:
+            cmd = cmd.rstrip()
+            if not cmd.endswith("."):
+                cmd = cmd + "."
+            self.pending.append(cmd)
+            self.size += len(cmd)
+        
+    def flush(self):
+        """submit the pending commands, if any"""
+        
+        if self.pending:
+            start = time.perf_counter()
+            spss.Submit(self.pending)
+            self.diagnostics.addbatch(self.pending, time.perf_counter() - start)
+            self.pending = []
+            self.size = 0
 
+class Diagnostics(object):
+    """Timings and sizes for each data pass and for the run as a whole"""
+    
+    phases = ["aggregate", "tally", "truncate", "close"]
+    
+    def __init__(self, enabled):
+        """enabled indicates whether the diagnostics will be displayed.
+        Phase timings are cheap and are always collected, but label truncation is
+        timed call by call only when enabled."""
+        
+        self.enabled = enabled
+        self.passes = []
+        self.run = {}
+        self.batches = []     # (commands, first command, seconds) for each Submit if enabled
+        self.started = time.perf_counter()
+        
+    def startpass(self, variables):
+        """start measuring a new data pass over the listed variables"""
+        
+        self.passes.append(dict([("variables", len(variables)), ("first", variables[0]), 
+            ("last", variables[-1]), ("rows", 0)] + [(phase, 0.) for phase in Diagnostics.phases]))
+        
+    @contextlib.contextmanager
+    def timer(self, phase):
+        """time a phase of the current pass or, for a phase not in phases, of the run"""
+        
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            target = phase in Diagnostics.phases and self.passes[-1] or self.run
+            target[phase] = target.get(phase, 0.) + time.perf_counter() - start
+            
+    def addrows(self, rows):
+        """record the number of cases tallied in the current pass"""
+        
+        self.passes[-1]["rows"] += rows
+        
+    def addbatch(self, cmds, seconds):
+        """log a batch of submitted commands and its latency"""
+        
+        if self.enabled:
+            self.batches.append((len(cmds), cmds[0].split("\n", 1)[0][:60], seconds))
+        
+    def rowrate(self, p):
+        """Return the rows per second tallied in pass p or None"""
+        
+        if p["tally"] > 0:
+            return p["rows"] / p["tally"]
+        return None
+        
+    def report(self):
+        """display the diagnostics table.  A procedure must be active"""
+        
+        self.run["total"] = time.perf_counter() - self.started
+        cells = []
+        for p in self.passes:
+            row = [p["first"], p["last"],
+                spss.CellText.Number(p["variables"], spss.FormatSpec.Count),
+                spss.CellText.Number(p["rows"], spss.FormatSpec.Count)]
+            row.extend([spss.CellText.Number(p[phase], spss.FormatSpec.GeneralStat) for phase in Diagnostics.phases])
+            rate = self.rowrate(p)
+            row.append(rate is None and spss.CellText.String("") or spss.CellText.Number(rate, spss.FormatSpec.Count))
+            cells.append(row)
+        caption = [_("""Times are in seconds.  Truncate time is included in tally time and is not measured separately for ENGINE=STREAM.""")]
+        caption.append(_("""Syntax generation: %.3f seconds, %s commands, %s bytes""") %
+            (self.run.get("makevls", 0.), self.run.get("commands", 0), self.run.get("syntaxbytes", 0)))
+        caption.append(_("""Applying labels: %.3f seconds""") % self.run.get("submit", 0.))
+        if "export" in self.run:
+            caption.append(_("""Label map export: %.3f seconds""") % self.run["export"])
+        caption.append(_("""Submits: %s batches of %s commands, %.3f seconds""") % (len(self.batches),
+            sum(b[0] for b in self.batches), sum(b[2] for b in self.batches)))
+        caption.append(_("""Total time: %.3f seconds""") % self.run["total"])
+        tbl = spss.BasePivotTable(_("""Value Label Generation Diagnostics"""), "VALLBLSFROMDATADIAG",
+            caption="\n".join(caption))
+        tbl.SimplePivotTable(rowdim=_("""Pass"""), rowlabels=[str(i+1) for i in range(len(self.passes))],
+            collabels=[_("""First Variable"""), _("""Last Variable"""), _("""Variables"""), _("""Aggregate Cases"""),
+                _("""Aggregate Time"""), _("""Tally Time"""), _("""Truncate Time"""), _("""Close Time"""),
+                _("""Rows per Second""")],
+            cells=cells)
+        
+    def writejson(self, filespec):
+        """write the diagnostics to filespec as JSON"""
+        
+        self.run.setdefault("total", time.perf_counter() - self.started)
+        for p in self.passes:
+            p["rowspersec"] = self.rowrate(p)
+        with open(filespec, "w") as f:
+            json.dump({"passes": self.passes, "run": self.run, "peakmemory": peakmemory(),
+                "batches": [{"commands": n, "first": first, "seconds": seconds} for n, first, seconds in self.batches]},
+                f, indent=1)
         
 class NonProcPivotTable(object):
     """Accumulate an object that can be turned into a basic pivot table once a procedure state can be established"""
@@ -490,6 +1597,134 @@ def StartProcedure(procname, omsid):
     except TypeError:  #older version
         spss.StartProcedure(omsid)
 
+class SpssSource(vallblsengine.DataSource):
+    """The active dataset as a data source for the labelling engine"""
+    
+    def __init__(self, vardict, skip=0):
+        """vardict is a VariableInfo for the active dataset
+        skip is the number of cases at the start of the file to skip"""
+        
+        self.vardict = vardict
+        self.skip = skip
+        self.rows = 0   # cases read so far
+        
+    def variables(self):
+        return self.vardict.varinfo()
+    
+    def isstring(self, name):
+        return self.vardict.isstring(name)
+    
+    def blocks(self, names, blocksize):
+        curs = spssdata.Spssdata(indexes=names, names=False, convertUserMissing=False)
+        try:
+            skip = self.skip
+            while skip > 0:
+                skipped = len(curs.fetchmany(min(skip, blocksize)))
+                if not skipped:
+                    break
+                skip -= skipped
+            while True:
+                block = curs.fetchmany(blocksize)
+                if not block:
+                    break
+                self.rows += len(block)
+                yield block
+        finally:
+            curs.CClose()
+
+class Preflight(object):
+    """Estimated distinct value counts from a preliminary data pass"""
+    
+    def __init__(self, vardict, varstolabel, labelvars, maxdistinct, highcard):
+        """vardict is the VariableInfo for the active dataset
+        varstolabel and labelvars are the selected variables
+        maxdistinct is the largest acceptable estimate for a variable to label
+        highcard is "skip" or "isolate" for the variables above that"""
+        
+        attributesFromDict(locals())
+        names = varstolabel + [v for v in labelvars if not v in varstolabel]
+        self.estimates = vallblsengine.estimatedistinct(SpssSource(vardict), names)
+        self.high = [v for v in varstolabel if self.estimates[v] > maxdistinct]
+        
+    def keep(self, varstolabel, labelvars):
+        """Return the variables to label and label variables without the high-cardinality variables"""
+        
+        if len(self.high) == len(varstolabel):
+            raise ValueError(_("""All the variables to label have more than MAXDISTINCT estimated distinct values"""))
+        pairs = [(v, lbl) for v, lbl in zip(varstolabel, vallblsengine.pairlabels(varstolabel, labelvars))\
+            if not v in self.high]
+        if len(labelvars) > 1:
+            labelvars = [lbl for v, lbl in pairs]
+        return [v for v, lbl in pairs], labelvars
+    
+    def report(self):
+        """display the estimates"""
+        
+        action = self.highcard == "skip" and _("""Skipped""") or _("""Isolated""")
+        rows = []
+        cells = []
+        for vname in self.varstolabel:
+            rows.append(vname)
+            cells.append([_("""Variable to Label"""), spss.CellText.Number(self.estimates[vname], spss.FormatSpec.Count),
+                vname in self.high and action or ""])
+        for vname in self.labelvars:
+            if not vname in rows:
+                rows.append(vname)
+                cells.append([_("""Label Variable"""), spss.CellText.Number(self.estimates[vname], spss.FormatSpec.Count), ""])
+        tbl = spss.BasePivotTable(_("""Estimated Distinct Values"""), "VALLBLSFROMDATAPREFLIGHT",
+            caption=_("""Variables to label with more than %s estimated distinct values are skipped or isolated""")
+                % self.maxdistinct)
+        tbl.SimplePivotTable(rowdim=_("""Variable"""), rowlabels=rows,
+            collabels=[_("""Role"""), _("""Estimated Distinct Values"""), _("""Action""")], cells=cells)
+
+class VariableInfo(object):
+    """Names and types of the variables in the active dataset
+    
+    These are fetched with the low-level api rather than by building a VariableDict,
+    which is slow for very wide files.  They are read again on every run, since
+    the dictionary or the file in a dataset can change between runs.  Full VariableDict
+    metadata is loaded only when it is needed and only for the selected variables."""
+    
+    def __init__(self):
+        nvars = spss.GetVariableCount()
+        self.variables = [spss.GetVariableName(i) for i in range(nvars)]
+        self.types = [spss.GetVariableType(i) for i in range(nvars)]
+        self.index = dict((name.lower(), i) for i, name in enumerate(self.variables))
+        self.selected = None
+        self.vardict = None
+        
+    def varinfo(self):
+        """Return a list of (name, isstring) duples in dictionary order"""
+        
+        return [(name, vartype > 0) for name, vartype in zip(self.variables, self.types)]
+    
+    def vartype(self, name):
+        """Return the type of a variable: 0 for numeric or the string length"""
+        
+        return self.types[self.index[name.lower()]]
+    
+    def isstring(self, name):
+        """Return True if name is a string variable"""
+        
+        return self.vartype(name) > 0
+    
+    def select(self, names):
+        """Limit the full metadata to the listed variables"""
+        
+        self.selected = names
+        self.vardict = None
+        
+    def __getitem__(self, name):
+        """Return the VariableDict entry for a selected variable, loading the metadata if necessary"""
+        
+        if self.vardict is None:
+            try:
+                self.vardict = spssaux.VariableDict(self.selected, caseless=True)
+            except:
+                raise ValueError(_("""This command requires a  newer version the spssaux module.  \n
+It can be obtained from the SPSS Community website (www.ibm.com/developerworks/spssdevcentral)"""))
+        return self.vardict[name]
+
 class FileHandles(object):
     """manage and replace file handles in filespecs.
     
@@ -561,9 +1796,35 @@ def Run(args):
         Template("LBLPATTERN", subc="",  ktype="literal", var="lblpattern", islist=False),
 
         Template("VARSPERPASS", subc="OPTIONS", ktype="int", var="varsperpass"),
+        Template("ENGINE", subc="OPTIONS", ktype="str", var="engine",
+            vallist=["wide", "long", "stream"]),
+        Template("PLAN", subc="OPTIONS", ktype="str", var="plan",
+            vallist=["fixed", "adaptive"]),
+        Template("CELLBUDGET", subc="OPTIONS", ktype="int", var="cellbudget"),
+        Template("SAMPLESIZE", subc="OPTIONS", ktype="int", var="samplesize"),
+        Template("MAXDISTINCT", subc="OPTIONS", ktype="int", var="maxdistinct"),
+        Template("HIGHCARD", subc="OPTIONS", ktype="str", var="highcard",
+            vallist=["skip", "isolate"]),
+        Template("STABLECASES", subc="OPTIONS", ktype="int", var="stablecases"),
+        Template("MAXSAMPLE", subc="OPTIONS", ktype="int", var="maxsample"),
+        Template("CACHE", subc="OPTIONS", ktype="literal", var="cache"),
+        Template("MEMORYBUDGET", subc="OPTIONS", ktype="int", var="memorybudget"),
+        Template("CHECKPOINT", subc="OPTIONS", ktype="literal", var="checkpoint"),
+        Template("PROGRESS", subc="OPTIONS", ktype="literal", var="progress"),
+        Template("CONFLICTRULE", subc="OPTIONS", ktype="str", var="conflictrule",
+            vallist=["first", "mostfrequent", "longest"]),
+        Template("MAXCONFLICTS", subc="OPTIONS", ktype="int", var="maxconflicts"),
+        Template("REPORTDUPS", subc="OPTIONS", ktype="bool", var="reportdups"),
+        Template("MAXDUPS", subc="OPTIONS", ktype="int", var="maxdups"),
 
         Template("SYNTAX", subc="OUTPUT", ktype="literal", var="syntax"),
         Template("EXECUTE", subc="OUTPUT", ktype="bool", var="execute"),
+        Template("APPLY", subc="OUTPUT", ktype="str", var="apply",
+            vallist=["datastep", "syntax"]),
+        Template("DELTA", subc="OUTPUT", ktype="bool", var="delta"),
+        Template("EXPORT", subc="OUTPUT", ktype="literal", var="export"),
+        
+        Template("JSONFILE", subc="DIAGNOSTICS", ktype="literal", var="diagjson"),
         
         Template("HELP", subc="", ktype="bool")])
     
@@ -579,7 +1840,9 @@ def Run(args):
         #print helptext
         helper()
     else:
-        processcmd(oobj, args, dolabels)
+        # DIAGNOSTICS may be given with no keywords
+        diagnostics = "DIAGNOSTICS" in args
+        processcmd(oobj, args, lambda **kwds: dolabels(diagnostics=diagnostics, **kwds))
 
 def helper():
     """open html help in default browser window
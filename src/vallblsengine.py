@@ -0,0 +1,1427 @@
+#/***********************************************************************
+# * Licensed Materials - Property of IBM
+# *
+# * IBM SPSS Products: Statistics Common
+# *
+# * (C) Copyright IBM Corp. 1989, 2020
+# *
+# * US Government Users Restricted Rights - Use, duplication or disclosure
+# * restricted by GSA ADP Schedule Contract with IBM Corp.
+# ************************************************************************/
+
+"""Value label derivation engine for STATS VALLBLS FROMDATA
+
+This module does not depend on SPSS Statistics.  It holds the tallying,
+conflict and duplicate detection, and VALUE LABELS syntax generation used
+by the extension command, along with data sources for reading case data
+outside of Statistics and a driver that spreads the variables over
+worker processes.  If NumPy is installed, each block of cases is reduced to
+its distinct combinations of value and labels before it is tallied.
+
+It can also be run as a script, e.g.,
+    python vallblsengine.py data.csv --variables x1 TO x5 --lblvars lbl --syntax labels.sps
+or on a batch of files, writing one syntax file for each and a combined summary,
+    python vallblsengine.py monthly/ --variables x1 TO x5 --lblvars lbl --outdir syntax --summary summary.csv
+"""
+
+import contextlib, csv, functools, hashlib, heapq, itertools, json, math, os, re, sqlite3, sys, tempfile, textwrap
+from concurrent.futures import ProcessPoolExecutor
+try:
+    import numpy    # optional.  Blocks of cases are reduced to their distinct combinations
+except ImportError:
+    numpy = None
+
+__author__ =  'IBM SPSS, JKP'
+__version__=  '1.0.0'
+
+# enable localization when not running inside Statistics
+try:
+    _("---")
+except NameError:
+    def _(msg):
+        return msg
+
+LABELLENGTH = 120   # maximum value label length in bytes
+EXPORTBATCH = 65536 # rows per Parquet record batch in a label map export
+CACHEVERSION = 2    # label cache layout.  Caches with another version are ignored
+ENTRYBYTES = 200    # approximate memory used by one value and its label in a VarTally
+
+
+class _Conflicted(str):
+    """a label whose value has also been given a different label"""
+
+    __slots__ = ()
+
+class _Duplicate(object):
+    """firstvalue entry for a label already counted as a duplicate"""
+
+
+class VarTally(object):
+    """Accumulated value label information for one variable
+
+    Conflicts and duplicates are counted exactly, but only the first few
+    examples of each are kept, so memory does not grow with the number of them.
+    A conflicting value is marked by its label, and a duplicated label by its
+    firstvalue entry, rather than in separate collections.
+
+    With the first rule, a conflicting value gets the label that sorts last, which
+    is the maximum that AGGREGATE gives the original passes, so the result does not
+    depend on the engine or the order in which the cases are read.
+    With a conflict rule other than first, the number of cases with each value
+    and label is also kept, and resolve chooses the label of each conflicting
+    value from those counts once everything has been tallied."""
+
+    __slots__ = ["labels", "firstvalue", "nconflicts", "nduplabels", "conflicts", "duplabels",
+        "maxconflicts", "maxdups", "rule", "counts", "shares", "changes"]
+
+    RULES = ["first", "mostfrequent", "longest"]
+
+    def __init__(self, maxconflicts=100, maxdups=100, rule="first"):
+        """maxconflicts is the number of conflict examples to keep
+        maxdups is the number of duplicate examples to keep or None not to check for duplicates
+        rule is first, mostfrequent, or longest, deciding which label a conflicting value gets"""
+
+        self.labels = {}        # value -> label.  A conflicting value keeps its largest label
+        self.firstvalue = {}    # label -> first value given that label
+        self.nconflicts = 0     # number of values with more than one label
+        self.nduplabels = 0     # number of labels used for more than one value
+        self.conflicts = []     # examples as (value, label, other label)
+        self.duplabels = []     # examples as (label, first value, other value)
+        self.maxconflicts = maxconflicts
+        self.maxdups = maxdups
+        self.rule = rule
+        self.counts = {} if rule != "first" else None   # (value, label) -> cases, if the rule needs them
+        self.shares = {}        # winning label share of each conflict example after resolve
+        self.changes = 0        # number of times a value, its label, or a counted (value, label) pair was new
+
+    def add(self, value, minlbl, maxlbl, n=1):
+        """tally one value
+
+        value is the value
+        minlbl and maxlbl are the smallest and largest labels observed for it.
+        Empty or missing labels are ignored.
+        n is the number of cases.  It is used only if counts are kept, and then
+        minlbl and maxlbl must be the same, since each label is counted separately."""
+
+        if not maxlbl:
+            return
+        if self.counts is not None:
+            key = (value, maxlbl)
+            if not key in self.counts:
+                self.changes += 1
+            self.counts[key] = self.counts.get(key, 0) + n
+        current = self.labels.get(value)
+        if current is None:
+            self.labels[value] = current = maxlbl
+            self.changes += 1
+            # the same label already used for a different value?
+            if self.maxdups is not None:
+                first = self.firstvalue.setdefault(maxlbl, value)
+                if first != value and first is not _Duplicate:
+                    self.firstvalue[maxlbl] = _Duplicate
+                    self.nduplabels += 1
+                    if len(self.duplabels) < self.maxdups:
+                        self.duplabels.append((maxlbl, first, value))
+        # more than one label for the same value?
+        if (minlbl and minlbl != maxlbl) or current != maxlbl:
+            if not isinstance(current, _Conflicted):
+                self.labels[value] = _Conflicted(max(current, maxlbl))
+                self.nconflicts += 1
+                self.changes += 1
+                if len(self.conflicts) < self.maxconflicts:
+                    self.conflicts.append((value, current, current != maxlbl and maxlbl or minlbl))
+            elif maxlbl > current:
+                self.labels[value] = _Conflicted(maxlbl)
+                self.changes += 1
+
+    def signature(self):
+        """Return a quantity that changes when a new value or a new label for a value is tallied
+
+        With the first rule, a label that sorts before the one the value already has
+        cannot change the result and is not counted unless it makes the value conflict."""
+
+        return self.changes
+
+    def flaggeditems(self):
+        """Generate (value, label, conflict, duplicate) in value order, skipping missing values
+
+        conflict is True if the value had more than one label and duplicate if
+        its label was also given to another value.  Duplicates are flagged even
+        if they are not being counted."""
+
+        if self.maxdups is None:
+            uses = {}
+            for label in self.labels.values():
+                uses[label] = uses.get(label, 0) + 1
+            isdup = lambda label: uses[label] > 1
+        else:
+            isdup = lambda label: self.firstvalue.get(label) is _Duplicate
+        for value, label in sorted((value, label) for value, label in self.labels.items() if value is not None):
+            yield value, str(label), isinstance(label, _Conflicted), isdup(label)
+
+    def resolve(self):
+        """Give each conflicting value its label according to the rule
+
+        mostfrequent takes the label with the most cases and longest the longest label.
+        Ties go to the longest or the most frequent, respectively, and then to the label
+        that sorts first, so the result does not depend on the order of the cases.
+        The conflict examples show the label chosen, the runner-up and the winning share.
+        With the first rule, the examples are brought up to date with the largest label,
+        which may have arrived after they were recorded.
+        Duplicates are recounted for the chosen labels.  Without conflicts, nothing changes."""
+
+        if self.counts is None:
+            if not self.nconflicts:
+                return
+            for i, (value, label, other) in enumerate(self.conflicts):
+                winner = str(self.labels[value])
+                self.conflicts[i] = (value, winner, other if label == winner else label)
+        else:
+            self.resolvecounts()
+        if self.maxdups is not None:
+            self.firstvalue = {}
+            self.nduplabels = 0
+            self.duplabels = []
+            for value, label in self.labels.items():
+                label = str(label)
+                first = self.firstvalue.setdefault(label, value)
+                if first != value and first is not _Duplicate:
+                    self.firstvalue[label] = _Duplicate
+                    self.nduplabels += 1
+                    if len(self.duplabels) < self.maxdups:
+                        self.duplabels.append((label, first, value))
+
+    def resolvecounts(self):
+        """Choose the labels of conflicting values from the counts by the rule and record the shares"""
+
+        candidates = {}     # conflicting value -> list of (label, cases)
+        for (value, label), n in self.counts.items():
+            if isinstance(self.labels[value], _Conflicted):
+                candidates.setdefault(value, []).append((label, n))
+        if self.rule == "mostfrequent":
+            rank = lambda item: (-item[1], -len(item[0]), item[0])
+        else:
+            rank = lambda item: (-len(item[0]), -item[1], item[0])
+        for value, labels in candidates.items():
+            labels.sort(key=rank)
+            self.labels[value] = _Conflicted(labels[0][0])
+        self.shares = {}
+        for i, (value, label, other) in enumerate(self.conflicts):
+            labels = candidates[value]
+            self.conflicts[i] = (value, labels[0][0], len(labels) > 1 and labels[1][0] or other)
+            self.shares[value] = labels[0][1] / sum(n for label, n in labels)
+
+    def todict(self):
+        """Return the tally as a dictionary of lists that can be saved as JSON"""
+
+        d = {"labels": [[value, label] for value, label in self.labels.items()],
+            "conflicted": [value for value, label in self.labels.items() if isinstance(label, _Conflicted)],
+            "nconflicts": self.nconflicts, "nduplabels": self.nduplabels,
+            "conflicts": self.conflicts, "duplabels": self.duplabels}
+        if self.counts is not None:
+            d["counts"] = [[value, label, n] for (value, label), n in self.counts.items()]
+        return d
+
+    @staticmethod
+    def fromdict(d, maxconflicts=100, maxdups=100, rule="first"):
+        """Return a VarTally rebuilt from the todict form"""
+
+        tally = VarTally(maxconflicts, maxdups, rule)
+        if tally.counts is not None:
+            tally.counts = dict(((value, label), n) for value, label, n in d.get("counts", []))
+        for value, label in d["labels"]:
+            tally.labels[value] = label
+            if maxdups is not None and tally.firstvalue.setdefault(label, value) != value:
+                tally.firstvalue[label] = _Duplicate
+        for value in d["conflicted"]:
+            tally.labels[value] = _Conflicted(tally.labels[value])
+        tally.nconflicts = d["nconflicts"]
+        tally.nduplabels = d["nduplabels"]
+        tally.conflicts = [tuple(c) for c in d["conflicts"][:maxconflicts]]
+        tally.duplabels = [tuple(c) for c in d["duplabels"][:maxdups or 0]]
+        return tally
+
+class SpillStore(object):
+    """SQLite file holding the tallies of variables moved out of memory
+
+    When the VarTally objects together hold more than the budget, the largest
+    are replaced by SpillTally objects that keep their values and labels in a
+    temporary database file.  The file is removed by close."""
+
+    def __init__(self, budget):
+        """budget is the approximate number of bytes of tallies to keep in memory"""
+
+        self.budget = budget
+        self.spilled = []       # names of the variables moved to disk
+        fd, self.path = tempfile.mkstemp(suffix=".db", prefix="vallbls")
+        os.close(fd)
+        self.db = sqlite3.connect(self.path)
+        # the file is scratch space, so nothing needs to survive a crash
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+
+    def check(self, tallies):
+        """Move the largest in-memory tallies to disk until the budget is met
+
+        tallies is the dictionary of tallies keyed by variable name.  Its entries are replaced.
+        Return True if anything was moved, since references to the old tallies are then stale."""
+
+        sizes = sorted([(len(tally.labels), vname) for vname, tally in tallies.items()\
+            if isinstance(tally, VarTally)], reverse=True)
+        used = sum(n for n, vname in sizes) * ENTRYBYTES
+        if used <= self.budget:
+            return False
+        for n, vname in sizes:
+            tallies[vname] = SpillTally(self, len(self.spilled), tallies[vname])
+            self.spilled.append(vname)
+            used -= n * ENTRYBYTES
+            if used <= self.budget:
+                break
+        return True
+
+    def finish(self, tallies):
+        """Complete the counts and examples of every spilled tally in tallies"""
+
+        for tally in tallies.values():
+            if isinstance(tally, SpillTally):
+                tally.finish()
+
+    def close(self):
+        """Close and remove the database file"""
+
+        self.db.close()
+        with contextlib.suppress(OSError):
+            os.remove(self.path)
+
+class SpillTally(object):
+    """Tally for one variable kept in the database of a SpillStore
+
+    Each distinct (value, min label, max label) triple is stored once with the
+    sequence number of its first occurrence, so disk use grows with the number
+    of distinct triples rather than with the number of cases.  finish does the
+    equivalent of VarTally.add for all of them at once as an external merge in
+    SQL, giving the same labels, counts, and examples as VarTally would have."""
+
+    NONE = b""      # stored in place of a missing value, which SQL would not group as a value
+    BATCH = 10000   # triples buffered before writing
+
+    def __init__(self, store, number, tally):
+        """store is the SpillStore
+        number distinguishes the tables of this tally from the others in the store
+        tally is the VarTally to be replaced.  Its contents are copied in."""
+
+        self.db = store.db
+        self.triples, self.winners, self.flagged = ["%s%d" % (t, number) for t in ("triples", "winners", "flagged")]
+        self.maxconflicts = tally.maxconflicts
+        self.maxdups = tally.maxdups
+        self.nconflicts = tally.nconflicts
+        self.nduplabels = tally.nduplabels
+        self.conflicts = list(tally.conflicts)
+        self.duplabels = list(tally.duplabels)
+        self.pending = []
+        self.seq = 0            # sequence number of the next triple
+        self.stored = 0         # distinct triples written
+        self.db.execute("CREATE TABLE %s (value, minlbl TEXT, maxlbl TEXT, seq INTEGER, "
+            "PRIMARY KEY (value, minlbl, maxlbl)) WITHOUT ROWID" % self.triples)
+        # values already found to be in conflict before the tally was moved
+        self.db.execute("CREATE TABLE %s (value PRIMARY KEY) WITHOUT ROWID" % self.flagged)
+        # the labels dictionary is in order of first occurrence, which is all later steps need
+        for value, label in tally.labels.items():
+            self.add(value, str(label), str(label))
+        self.db.executemany("INSERT INTO %s VALUES (?)" % self.flagged,
+            [(self.key(value),) for value, label in tally.labels.items() if isinstance(label, _Conflicted)])
+        self.flush()
+
+    @staticmethod
+    def key(value):
+        """Return value as stored"""
+
+        return SpillTally.NONE if value is None else value
+
+    @staticmethod
+    def unkey(value):
+        """Return a stored value as the original value"""
+
+        return None if value == SpillTally.NONE else value
+
+    def add(self, value, minlbl, maxlbl, n=1):
+        """tally one value as for VarTally.add
+
+        n is ignored, since spilled tallies do not count cases"""
+
+        if not maxlbl:
+            return
+        self.pending.append((self.key(value), minlbl or "", maxlbl, self.seq))
+        self.seq += 1
+        if len(self.pending) >= SpillTally.BATCH:
+            self.flush()
+
+    def flush(self):
+        """Write buffered triples.  A triple already stored keeps its first sequence number."""
+
+        if self.pending:
+            self.stored += self.db.executemany("INSERT OR IGNORE INTO %s VALUES (?, ?, ?, ?)" % self.triples,
+                self.pending).rowcount
+            self.pending = []
+
+    def signature(self):
+        """Return a quantity that changes when a new value or a new label for a value is tallied"""
+
+        self.flush()
+        return self.stored
+
+    def resolve(self):
+        """Do nothing.  Spilled tallies are only used with the first rule, which finish applies."""
+
+    def finish(self):
+        """Compute the labels, conflicts and duplicates from the stored triples"""
+
+        self.flush()
+        names = {"triples": self.triples, "winners": self.winners, "flagged": self.flagged}
+        # the largest label of each value wins, as in VarTally.  first is the label the value
+        # was first given, which decides where VarTally found a conflict, and seq where that was.
+        # SQLite takes the bare column first from the MIN row.
+        self.db.execute("""CREATE TABLE %(winners)s AS
+            SELECT f.value AS value, m.label AS label, f.first AS first, f.seq AS seq
+            FROM (SELECT value, maxlbl AS first, MIN(seq) AS seq FROM %(triples)s GROUP BY value) f
+            JOIN (SELECT value, MAX(maxlbl) AS label FROM %(triples)s GROUP BY value) m ON f.value = m.value""" % names)
+        self.db.execute("CREATE UNIQUE INDEX %(winners)sx ON %(winners)s (value)" % names)
+        # the first triple of each value that disagrees with its first label or has differing min and max
+        conflicting = """SELECT t.value AS value, w.label AS label, w.first AS first,
+                CASE WHEN t.maxlbl <> w.first THEN t.maxlbl ELSE t.minlbl END AS other, MIN(t.seq) AS seq
+            FROM %(triples)s t JOIN %(winners)s w ON t.value = w.value
+            WHERE t.maxlbl <> w.first OR (t.minlbl <> '' AND t.minlbl <> t.maxlbl)
+            GROUP BY t.value""" % names
+        self.nconflicts = self.db.execute("SELECT COUNT(*) FROM (SELECT value FROM (%s) UNION SELECT value FROM %s)"
+            % (conflicting, self.flagged)).fetchone()[0]
+        # conflicts found before spilling came first and are already in the examples.
+        # All the examples are brought up to date with the winning label as VarTally.resolve does.
+        for i, (value, first, other) in enumerate(self.conflicts):
+            label = self.db.execute("SELECT label FROM %(winners)s WHERE value = ?" % names,
+                (self.key(value),)).fetchone()[0]
+            self.conflicts[i] = (value, label, other if first == label else first)
+        more = self.db.execute("""SELECT value, label, first, other FROM (%s)
+            WHERE value NOT IN (SELECT value FROM %s) ORDER BY seq LIMIT ?""" % (conflicting, self.flagged),
+            (max(self.maxconflicts - len(self.conflicts), 0),))
+        self.conflicts.extend((self.unkey(value), label, other if first == label else first)
+            for value, label, first, other in more)
+
+        if self.maxdups is not None:
+            duplicated = "SELECT label FROM %(winners)s GROUP BY label HAVING COUNT(*) > 1" % names
+            self.nduplabels = self.db.execute("SELECT COUNT(*) FROM (%s)" % duplicated).fetchone()[0]
+            # an example is a label with its first two values, in the order the second value appeared.
+            # Duplicates found before spilling are recomputed, since the stored order is the original.
+            rows = self.db.execute("""SELECT label, value, seq FROM %(winners)s
+                WHERE label IN (%(duplicated)s) ORDER BY label, seq""" % dict(names, duplicated=duplicated))
+            self.duplabels = [(label, self.unkey(first), self.unkey(value)) for seq, label, first, value in
+                heapq.nsmallest(self.maxdups, self.firsttwo(rows))]
+
+    @staticmethod
+    def firsttwo(rows):
+        """Generate (second seq, label, first value, second value) from rows ordered by label and seq"""
+
+        current, first, count = None, None, 0
+        for label, value, seq in rows:
+            if label != current:
+                current, first, count = label, value, 1
+            else:
+                count += 1
+                if count == 2:
+                    yield seq, label, first, value
+
+    def haslabels(self):
+        """Return True if any value other than missing has a label"""
+
+        return self.db.execute("SELECT EXISTS (SELECT 1 FROM %s WHERE value <> ?)" % self.winners,
+            (SpillTally.NONE,)).fetchone()[0] == 1
+
+    def items(self):
+        """Generate (value, label) pairs ordered by value, skipping missing values
+
+        SQLite orders text by its utf-8 bytes, which is the same as code point order."""
+
+        for row in self.db.execute("SELECT value, label FROM %s WHERE value <> ? ORDER BY value" % self.winners,
+                (SpillTally.NONE,)):
+            yield row
+
+    def flaggeditems(self):
+        """Generate (value, label, conflict, duplicate) ordered by value, skipping missing values
+
+        The flags are as for VarTally.flaggeditems and are computed in SQL as the rows are read."""
+
+        names = {"triples": self.triples, "winners": self.winners, "flagged": self.flagged}
+        for value, label, conflict, duplicate in self.db.execute("""SELECT w.value, w.label,
+                w.value IN (SELECT value FROM %(flagged)s) OR EXISTS (SELECT 1 FROM %(triples)s t
+                    WHERE t.value = w.value AND (t.maxlbl <> w.label OR (t.minlbl <> '' AND t.minlbl <> t.maxlbl))),
+                w.label IN (SELECT label FROM %(winners)s GROUP BY label HAVING COUNT(*) > 1)
+            FROM %(winners)s w WHERE w.value <> ? ORDER BY w.value""" % names, (SpillTally.NONE,)):
+            yield value, label, bool(conflict), bool(duplicate)
+
+@functools.lru_cache(maxsize=10000)
+def truncatebytes(name, maxlength, unicodemode):
+    """Return name truncated to no more than maxlength bytes with a trailing underscore removed
+
+    In Unicode mode the string is encoded once, and the utf-8 bytes are cut at maxlength.
+    Decoding ignores a partial character at the cut, so the result always ends on
+    a character boundary.  Label variables repeat the same few strings over and over,
+    so results are cached."""
+
+    if not unicodemode:
+        name = name[:maxlength]
+    else:
+        name8 = name.encode("utf_8")
+        if len(name8) > maxlength:
+            name = name8[:maxlength].decode("utf_8", "ignore")
+    if name and name[-1] == "_":
+        name = name[:-1]
+    return name
+
+def labeltext(label, unicodemode):
+    """Return label value prepared for use as a value label or None"""
+
+    if label is None:
+        return None
+    return truncatebytes(label, LABELLENGTH, unicodemode).rstrip()
+
+def smartquote(s, qchar='"'):
+    """Return s enclosed in qchar with any embedded qchar doubled"""
+
+    return qchar + s.replace(qchar, qchar + qchar) + qchar
+
+def makevls(varnames, vlinfo, isstring, command="VALUE LABELS"):
+    """Return value label syntax
+
+    varnames is the list of variables to which the syntax applies
+    vlinfo is an iterable of duples of (value, label) with no repeated values in the order
+    to be written.  It is read once, so it can be a stream from a SpillTally.
+    isstring is True if the variable is a string
+    command is VALUE LABELS or ADD VALUE LABELS
+
+    System-missing values cannot be labelled and are skipped"""
+
+    return command + " " + "\n   ".join(textwrap.wrap(" ".join(varnames), 70)) +\
+        "\n   " + "\n   ".join(valuelabel(value, label, isstring) for value, label in vlinfo if value is not None) + "."
+
+def valuelabel(value, label, isstring):
+    """Return one value and label as written in VALUE LABELS"""
+
+    if isstring:
+        value = smartquote(value)
+    else:
+        if value == int(value):
+            value = int(value)
+    return "%s %s" % (value, smartquote(label))
+
+def labelsets(tallies, baseline=None, existing=None, vartype=None):
+    """Generate (varnames, value label pairs, command) triples in name order
+
+    tallies is a dictionary of VarTally or finished SpillTally objects keyed by variable name
+    baseline optionally maps variable names to dictionaries of the value labels already applied
+    from the label cache.
+    existing optionally maps variable names to dictionaries of the value labels they already have.
+    For the variables in either, the command is ADD VALUE LABELS and only the values whose
+    label differs from the one in both is included.
+    vartype optionally returns the type of a named variable, 0 for numeric or the string width.
+    Variables with nothing to label are skipped.  Variables with identical sets of pairs,
+    the same command, and the same type are grouped, in the position of the first of them,
+    since string variables listed together in VALUE LABELS must have the same width.
+    The pairs of a SpillTally are not grouped but streamed in order from disk."""
+
+    existing = existing or {}
+    groups = {}
+    for k, vlinfo, command in _labelsets(tallies, baseline, existing):
+        if command is None:
+            groups[(None, None, k)] = [k]
+        else:
+            groups.setdefault((command, vartype and vartype(k), tuple(vlinfo)), []).append(k)
+    for (command, width, vlinfo), varnames in groups.items():
+        if command is None:
+            pairs = tallies[vlinfo].items()
+            if not vlinfo in existing:
+                yield varnames, pairs, "VALUE LABELS"
+                continue
+            current = existing[vlinfo]
+            pairs = ((value, label) for value, label in pairs if current.get(value) != label)
+            first = next(pairs, None)
+            if first is not None:
+                yield varnames, itertools.chain([first], pairs), "ADD VALUE LABELS"
+        else:
+            yield varnames, vlinfo, command
+
+def _labelsets(tallies, baseline, existing):
+    """Generate (varname, sorted value label pairs, command) triples for single variables
+
+    For a SpillTally with something to label, the pairs and command are None."""
+
+    baseline = baseline or {}
+    for k,v in sorted(tallies.items()):
+        if isinstance(v, SpillTally):
+            if v.haslabels():
+                yield k, None, None
+            continue
+        if k in baseline or k in existing:
+            done = baseline.get(k, {})
+            current = existing.get(k, {})
+            vlinfo = [(value, label) for value, label in v.labels.items()\
+                if value is not None and done.get(value) != label and current.get(value) != label]
+            command = "ADD VALUE LABELS"
+        else:
+            vlinfo = [(value, label) for value, label in v.labels.items() if value is not None]
+            command = "VALUE LABELS"
+        if vlinfo:
+            yield k, sorted(vlinfo), command
+
+def labelsyntax(tallies, isstring, baseline=None, existing=None, vartype=None):
+    """Generate VALUE LABELS commands, one per group of identically labelled variables
+
+    tallies is a dictionary of VarTally objects keyed by variable name
+    isstring is a function returning True if the named variable is a string
+    baseline, existing and vartype are as for labelsets"""
+
+    for varnames, vlinfo, command in labelsets(tallies, baseline, existing, vartype):
+        yield makevls(varnames, vlinfo, isstring(varnames[0]), command)
+
+EXPORTFORMATS = {"jsonl": "jsonl", "ndjson": "jsonl", "json": "jsonl", "csv": "csv", "parquet": "parquet"}
+
+def exportformat(filespec):
+    """Return the label map export format, jsonl, csv, or parquet, for filespec based on its extension"""
+
+    ext = filespec.lower().rsplit(".", 1)[-1]
+    if not ext in EXPORTFORMATS:
+        raise ValueError(_("""The label map export file must have an extension of .jsonl, .csv, or .parquet: %s""")
+            % filespec)
+    return EXPORTFORMATS[ext]
+
+def maprows(tallies, isstring):
+    """Generate (variable, value, label, conflict, duplicate) for the final label map
+
+    tallies is a dictionary of VarTally or finished SpillTally objects keyed by variable name
+    isstring is a function returning True if the named variable is a string
+    Variables are in name order and values in value order.  Numeric values with no
+    fractional part are returned as integers, as they are written in VALUE LABELS."""
+
+    for vname, tally in sorted(tallies.items()):
+        numeric = not isstring(vname)
+        for value, label, conflict, duplicate in tally.flaggeditems():
+            if numeric and value == int(value):
+                value = int(value)
+            yield vname, value, label, conflict, duplicate
+
+def exportmap(filespec, tallies, isstring, fmt=None):
+    """Write the final value label map and return the number of values written
+
+    filespec is the output file
+    tallies and isstring are as for maprows
+    fmt is jsonl, csv, or parquet.  By default, it comes from the extension of filespec.
+
+    Each row has the variable, value, label, and whether the value had conflicting
+    labels and whether the label is a duplicate.  Rows are written as they are generated,
+    so a spilled tally is streamed from disk.  In Parquet, values are stored as text,
+    since the values of numeric and string variables share the column."""
+
+    fmt = fmt or exportformat(filespec)
+    columns = ["variable", "value", "label", "conflict", "duplicate"]
+    count = 0
+    if fmt == "jsonl":
+        with open(filespec, "w", encoding="utf_8") as f:
+            for row in maprows(tallies, isstring):
+                f.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n")
+                count += 1
+    elif fmt == "csv":
+        with open(filespec, "w", newline="", encoding="utf_8_sig") as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for vname, value, label, conflict, duplicate in maprows(tallies, isstring):
+                writer.writerow([vname, value, label, int(conflict), int(duplicate)])
+                count += 1
+    else:
+        pa = optionalimport("pyarrow")
+        pq = optionalimport("pyarrow.parquet")
+        schema = pa.schema([("variable", pa.string()), ("value", pa.string()), ("label", pa.string()),
+            ("conflict", pa.bool_()), ("duplicate", pa.bool_())])
+        with pq.ParquetWriter(filespec, schema) as writer:
+            rows = maprows(tallies, isstring)
+            while True:
+                batch = list(itertools.islice(rows, EXPORTBATCH))
+                if not batch:
+                    break
+                data = [list(column) for column in zip(*batch)]
+                data[1] = [str(value) for value in data[1]]
+                writer.write_batch(pa.record_batch(data, schema=schema))
+                count += len(batch)
+    return count
+
+def loadcache(filespec, key, maxconflicts=100, maxdups=100, rule="first"):
+    """Return the case count and tallies saved in a label cache
+
+    filespec is the cache file.  If it does not exist or has another version, the cache is empty.
+    key identifies the dataset within the cache.
+    maxconflicts, maxdups and rule are as for VarTally.
+    The tallies are a dictionary of (fingerprint, VarTally) duples keyed by variable name"""
+
+    try:
+        with open(filespec, encoding="utf_8") as f:
+            cache = json.load(f)
+    except FileNotFoundError:
+        return 0, {}
+    entry = cache.get("datasets", {}).get(key)
+    if entry is None or cache.get("version") != CACHEVERSION:
+        return 0, {}
+    return entry["cases"], dict((vname, (v["fingerprint"], VarTally.fromdict(v, maxconflicts, maxdups, rule)))\
+        for vname, v in entry["variables"].items())
+
+def savecache(filespec, key, cases, tallies):
+    """Save tallies in a label cache, replacing any earlier entry for the dataset
+
+    cases is the number of cases tallied
+    tallies is a dictionary of (fingerprint, VarTally) duples keyed by variable name"""
+
+    try:
+        with open(filespec, encoding="utf_8") as f:
+            cache = json.load(f)
+    except FileNotFoundError:
+        cache = {}
+    if cache.get("version") != CACHEVERSION:
+        cache = {"version": CACHEVERSION, "datasets": {}}
+    variables = {}
+    for vname, (fingerprint, tally) in tallies.items():
+        variables[vname] = tally.todict()
+        variables[vname]["fingerprint"] = fingerprint
+    cache["datasets"][key] = {"cases": cases, "variables": variables}
+    with open(filespec, "w", encoding="utf_8") as f:
+        json.dump(cache, f)
+
+def loadcheckpoint(filespec, key, cases, maxconflicts=100, maxdups=100, rule="first"):
+    """Return the tallies saved in a checkpoint file
+
+    filespec is the checkpoint file.  It holds a header line and then one line
+    of tallies for each finished data pass, so saving a pass is just an append.
+    key identifies the dataset, and cases is its case count.  If the file does not
+    exist or was written for another dataset, case count, or version, there are no tallies.
+    A partly written last line, from a run that stopped while saving, is ignored.
+    maxconflicts, maxdups and rule are as for VarTally.
+    The tallies are a dictionary of (fingerprint, VarTally) duples keyed by variable name"""
+
+    tallies = {}
+    try:
+        with open(filespec, encoding="utf_8") as f:
+            header = json.loads(f.readline())
+            if header != {"version": CACHEVERSION, "dataset": key, "cases": cases}:
+                return {}
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                for vname, v in entry.items():
+                    tallies[vname] = (v["fingerprint"], VarTally.fromdict(v, maxconflicts, maxdups, rule))
+    except (FileNotFoundError, ValueError):
+        return {}
+    return tallies
+
+def startcheckpoint(filespec, key, cases, tallies):
+    """Start a checkpoint file holding the tallies already finished
+
+    tallies is a dictionary of (fingerprint, VarTally) duples keyed by variable name"""
+
+    with open(filespec, "w", encoding="utf_8") as f:
+        f.write(json.dumps({"version": CACHEVERSION, "dataset": key, "cases": cases}) + "\n")
+    if tallies:
+        appendcheckpoint(filespec, tallies)
+
+def appendcheckpoint(filespec, tallies):
+    """Append the tallies of a finished data pass to a checkpoint file
+
+    tallies is a dictionary of (fingerprint, VarTally) duples keyed by variable name.
+    The file is synced to disk, so the pass survives a crash right after it."""
+
+    entry = {}
+    for vname, (fingerprint, tally) in tallies.items():
+        entry[vname] = tally.todict()
+        entry[vname]["fingerprint"] = fingerprint
+    with open(filespec, "a", encoding="utf_8") as f:
+        f.write(json.dumps(entry) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def pairlabels(varstolabel, labelvars):
+    """Return the label variable for each variable to label
+
+    A single label variable applies to all the variables"""
+
+    if len(labelvars) == 1:
+        return len(varstolabel) * labelvars
+    return labelvars
+
+def tallycases(source, varstolabel, labelvars, tallies=None, unicodemode=True, blocksize=10000, sample=None,
+        store=None, onblock=None):
+    """Tally the values and labels of a data source case by case and return the tallies
+
+    source is a DataSource
+    varstolabel is the list of variables to label
+    labelvars is the list of label variables
+    tallies is a dictionary of VarTally objects keyed by variable name to accumulate into.
+    If None, a new one is created.
+    unicodemode indicates whether label lengths are measured in utf-8 bytes
+    sample is an optional Sample for the same tallies that decides when to stop reading
+    store is an optional SpillStore checked after each block
+    onblock is an optional function called with the number of cases read so far after each block
+    Call resolvetallies once all the cases have been tallied."""
+
+    if tallies is None:
+        tallies = dict((v, VarTally()) for v in varstolabel)
+    lblvars = []
+    for lbl in labelvars:
+        if not lbl in lblvars:
+            lblvars.append(lbl)
+    nvtl = len(varstolabel)
+    pairs = list(zip(varstolabel, pairlabels(varstolabel, labelvars)))
+    makelayout = lambda: [(tallies[vname].add, v, nvtl + lblvars.index(lbl), source.isstring(vname))\
+        for v, (vname, lbl) in enumerate(pairs)]
+    layout = makelayout()
+    counting = any(getattr(tallies[vname], "counts", None) is not None for vname in varstolabel)
+    ncases = 0
+
+    with contextlib.closing(source.blocks(varstolabel + lblvars, blocksize)) as blocks:
+        for block in blocks:
+            if sample is not None:
+                block = block[:sample.remaining()]
+            if numpy is None:
+                for case in block:
+                    for add, v, lblpos, isstring in layout:
+                        label = labeltext(case[lblpos], unicodemode)
+                        value = case[v]
+                        if isstring and value is not None:
+                            value = value.rstrip()
+                        add(value, label, label)
+            elif counting:
+                columns = BlockColumns(block)
+                for add, v, lblpos, isstring in layout:
+                    for i, n in zip(*columns.distinctcounts(v, isstring, lblpos)):
+                        case = block[i]
+                        label = labeltext(case[lblpos], unicodemode)
+                        value = case[v]
+                        if isstring and value is not None:
+                            value = value.rstrip()
+                        add(value, label, label, n)
+            else:
+                columns = BlockColumns(block)
+                for add, v, lblpos, isstring in layout:
+                    for i in columns.firstdistinct(v, isstring, lblpos, lblpos):
+                        case = block[i]
+                        label = labeltext(case[lblpos], unicodemode)
+                        value = case[v]
+                        if isstring and value is not None:
+                            value = value.rstrip()
+                        add(value, label, label)
+            if sample is not None and sample.update(len(block)):
+                break
+            if store is not None and store.check(tallies):
+                layout = makelayout()
+            ncases += len(block)
+            if onblock is not None:
+                onblock(ncases)
+    return tallies
+
+def resolvetallies(tallies):
+    """Resolve the conflicts of every tally in the dictionary tallies once all the cases have been tallied"""
+
+    for tally in tallies.values():
+        tally.resolve()
+
+class BlockColumns(object):
+    """Columns of a block of cases encoded with NumPy for finding distinct combinations
+
+    VarTally.add has no further effect for a (value, min label, max label) triple
+    it has already seen, so tallying only the first occurrence of each distinct triple
+    in a block, in case order, gives exactly the same result as tallying every case.
+    A VarTally that counts cases instead gets each combination once with its total.
+    Each column is encoded once as integer codes into its distinct values."""
+
+    def __init__(self, block):
+        """block is a list of cases"""
+
+        self.block = block
+        self.columns = list(zip(*block))
+        self.codes = {}     # column position -> (codes, distinct values)
+
+    def encode(self, pos, isstring=True):
+        """Return an array of codes and the sequence of distinct values for a column"""
+
+        if not pos in self.codes:
+            column = self.columns[pos]
+            arr = None
+            if not isstring:
+                # numeric None (sysmis) becomes nan.  That is safe only if no actual nan is present
+                arr = numpy.array(column, dtype=float)
+                nans = numpy.flatnonzero(numpy.isnan(arr))
+                if len(nans) and any([column[i] is not None for i in nans]):
+                    arr = None
+            if arr is not None:
+                distinct, codes = numpy.unique(arr, return_inverse=True)
+                codes = codes.ravel().astype(numpy.int64)
+            else:
+                # dictionary hashing is faster than sorting strings
+                distinct = dict.fromkeys(column)
+                index = dict((value, i) for i, value in enumerate(distinct))
+                codes = numpy.fromiter(map(index.__getitem__, column), dtype=numpy.int64, count=len(column))
+                distinct = list(distinct)
+            self.codes[pos] = (codes, distinct)
+        return self.codes[pos]
+
+    def firstdistinct(self, valuepos, isstring, minpos, maxpos):
+        """Return the case positions of the first occurrence of each distinct combination
+        of value, min label and max label whose max label is not blank, in case order
+
+        valuepos, minpos and maxpos are the column positions in the block
+        isstring is True if the values are strings.  Labels are always strings.
+        If most values in the block are distinct, every position is returned."""
+
+        valuecodes, values = self.encode(valuepos, isstring)
+        if len(values) > len(self.block) // 2:
+            return range(len(self.block))
+        (mincodes, minlbls), (maxcodes, maxlbls) = self.encode(minpos), self.encode(maxpos)
+        # a label that is blank before truncation is blank after it, and VarTally.add ignores it
+        blank = numpy.array([not label or not label.rstrip() for label in maxlbls], dtype=bool)
+        positions = numpy.flatnonzero(~blank[maxcodes])
+        keys = (valuecodes[positions] * len(minlbls) + mincodes[positions]) * len(maxlbls) + maxcodes[positions]
+        keys, first = numpy.unique(keys, return_index=True)
+        return numpy.sort(positions[first]).tolist()
+
+    def distinctcounts(self, valuepos, isstring, lblpos, weightpos=None):
+        """Return the case positions of the first occurrence of each distinct combination
+        of value and label whose label is not blank, in case order, and the total weight of each
+
+        This is for tallies that count cases, for which repeating a combination is not idempotent.
+        weightpos is the column position of case counts or None if each case counts once."""
+
+        if weightpos is None:
+            weights = numpy.ones(len(self.block), dtype=numpy.int64)
+        else:
+            weights = numpy.array(self.columns[weightpos])
+        valuecodes, values = self.encode(valuepos, isstring)
+        if len(values) > len(self.block) // 2:
+            return range(len(self.block)), weights.tolist()
+        lblcodes, lbls = self.encode(lblpos)
+        blank = numpy.array([not label or not label.rstrip() for label in lbls], dtype=bool)
+        positions = numpy.flatnonzero(~blank[lblcodes])
+        keys = valuecodes[positions] * len(lbls) + lblcodes[positions]
+        keys, first, inverse = numpy.unique(keys, return_index=True, return_inverse=True)
+        totals = numpy.zeros(len(keys), dtype=weights.dtype)
+        numpy.add.at(totals, inverse.ravel(), weights[positions])
+        order = numpy.argsort(first)
+        return positions[first[order]].tolist(), totals[order].tolist()
+
+class Sample(object):
+    """Early stopping rule for tallying a sample of the cases
+
+    A variable is stable once stablecases cases have been read since a new value
+    or a new label for a value last appeared in it, as VarTally.signature defines it.  Reading stops when every
+    variable is stable or maxcases cases have been read.  Stability is checked
+    after each block of cases, so a change is dated to the end of its block."""
+
+    def __init__(self, tallies, varstolabel, stablecases=None, maxcases=None):
+        """tallies is the dictionary of VarTally objects being accumulated
+        stablecases and maxcases are positive integers or None for no limit"""
+
+        self.tallies = tallies
+        self.varstolabel = varstolabel
+        self.stablecases = stablecases
+        self.maxcases = maxcases
+        self.cases = 0          # cases read so far
+        self.stopped = False    # True if reading stopped before the end of the data
+        self.lastnew = dict((v, 0) for v in varstolabel)        # case count at the last change
+        self.signatures = dict((v, None) for v in varstolabel)  # tally signatures at the last check
+
+    def remaining(self):
+        """Return the number of cases still allowed or None"""
+
+        if self.maxcases is None:
+            return None
+        return self.maxcases - self.cases
+
+    def update(self, ncases):
+        """record that ncases more cases were tallied and return True if reading should stop"""
+
+        self.cases += ncases
+        for vname in self.varstolabel:
+            tally = self.tallies[vname]
+            signature = tally.signature()
+            if signature != self.signatures[vname]:
+                self.signatures[vname] = signature
+                self.lastnew[vname] = self.cases
+        self.stopped = bool(self.stablecases and all(self.isstable(v) for v in self.varstolabel)) or\
+            (self.maxcases is not None and self.cases >= self.maxcases)
+        return self.stopped
+
+    def isstable(self, vname):
+        """Return True if vname has had no new values or labels for stablecases cases"""
+
+        return bool(self.stablecases) and self.cases - self.lastnew[vname] >= self.stablecases
+
+    def decidedearly(self):
+        """Return the list of variables that were stable when reading stopped early"""
+
+        if not self.stopped:
+            return []
+        return [v for v in self.varstolabel if self.isstable(v)]
+
+class HyperLogLog(object):
+    """HyperLogLog sketch estimating the number of distinct values added
+
+    Memory is fixed at 2**precision registers whatever the number of values.
+    The relative standard error is about 1.04 / sqrt(2**precision), 1.6% for
+    the default.  Values are hashed with the built-in hash, so estimates for
+    strings can differ slightly between processes."""
+
+    __slots__ = ["precision", "registers"]
+    MASK = 2**64 - 1
+
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.registers = bytearray(2**precision)
+
+    def add(self, value):
+        """add one value to the sketch"""
+
+        # a 64-bit mix of the hash, since the hash of a small number is the number itself
+        x = (hash(value) + 0x9E3779B97F4A7C15) & HyperLogLog.MASK
+        x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & HyperLogLog.MASK
+        x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & HyperLogLog.MASK
+        x ^= x >> 31
+        bits = 64 - self.precision
+        rest = x & ((1 << bits) - 1)
+        rank = bits - rest.bit_length() + 1
+        index = x >> bits
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, values):
+        """add each of an iterable of values"""
+
+        for value in values:
+            self.add(value)
+
+    def estimate(self):
+        """Return the estimated number of distinct values as an integer"""
+
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / sum([2.0 ** -r for r in self.registers])
+        zeros = self.registers.count(0)
+        if raw <= 2.5 * m and zeros:
+            # linear counting is more accurate for small cardinalities
+            return int(round(m * math.log(m / zeros)))
+        return int(round(raw))
+
+def estimatedistinct(source, names, blocksize=10000):
+    """Return a dictionary of the estimated number of distinct values of each named variable
+
+    source is a DataSource.  All the cases are read, but each block of cases
+    is reduced to its distinct values before they are added to the sketches."""
+
+    sketches = [HyperLogLog() for name in names]
+    for block in source.blocks(names, blocksize):
+        for v, sketch in enumerate(sketches):
+            sketch.update(set([case[v] for case in block]))
+    return dict((name, sketch.estimate()) for name, sketch in zip(names, sketches))
+
+def _tallyshard(source, varstolabel, labelvars, unicodemode):
+    """worker process entry point: tally one shard of the variables"""
+
+    return tallycases(source, varstolabel, labelvars, unicodemode=unicodemode)
+
+def tallyparallel(source, varstolabel, labelvars, workers=None, unicodemode=True):
+    """Tally the values and labels with the variables spread over worker processes
+
+    source is a DataSource.  It must be picklable, and each worker reads
+    only the columns for its own variables.
+    workers is the number of processes.  The default is the number of processors.
+    Returns a dictionary of VarTally objects keyed by variable name.
+
+    Each variable is tallied entirely within one worker, so merging the
+    shard results is just combining the dictionaries."""
+
+    lbls = pairlabels(varstolabel, labelvars)
+    nshards = min(workers or os.cpu_count() or 1, len(varstolabel))
+    with ProcessPoolExecutor(max_workers=nshards) as executor:
+        futures = []
+        for shard in range(nshards):
+            svars = varstolabel[shard::nshards]
+            slbls = lbls[shard::nshards]
+            futures.append(executor.submit(_tallyshard, source, svars, slbls, unicodemode))
+        tallies = {}
+        for f in futures:
+            tallies.update(f.result())
+    return tallies
+
+
+class DataSource(object):
+    """Interface for case data read by the engine
+
+    A data source provides the variable names and types and reads the
+    values of selected variables in blocks of cases.  Numeric values are
+    floats, or None if missing, and string values are str."""
+
+    def variables(self):
+        """Return a list of (name, isstring) duples in file order"""
+
+        raise NotImplementedError
+
+    def blocks(self, names, blocksize):
+        """Yield lists of up to blocksize case tuples holding the values of the named variables"""
+
+        raise NotImplementedError
+
+    def isstring(self, name):
+        """Return True if the named variable is a string"""
+
+        if not hasattr(self, "_types"):
+            self._types = dict(self.variables())
+        return self._types[name]
+
+    def vartype(self, name):
+        """Return 0 for a numeric variable and the string width, or 1 if the format has none, for a string"""
+
+        return int(self.isstring(name))
+
+
+class CsvSource(DataSource):
+    """A delimited text file with variable names in the first line
+
+    Columns listed in numeric, or, if numeric is None, columns whose non-blank
+    fields all read as numbers, are numeric.  A blank numeric field is missing."""
+
+    def __init__(self, path, encoding="utf_8_sig", delimiter=",", numeric=None):
+        self.path = path
+        self.encoding = encoding
+        self.delimiter = delimiter
+        self.numeric = numeric
+        self._varinfo = None
+
+    def _reader(self, f):
+        return csv.reader(f, delimiter=self.delimiter)
+
+    def variables(self):
+        if self._varinfo is None:
+            with open(self.path, newline="", encoding=self.encoding) as f:
+                reader = self._reader(f)
+                header = next(reader)
+                if self.numeric is not None:
+                    numeric = set(n.lower() for n in self.numeric)
+                    isnum = [n.lower() in numeric for n in header]
+                else:
+                    isnum = len(header) * [True]
+                    for row in reader:
+                        for i, field in enumerate(row):
+                            if isnum[i] and field.strip():
+                                try:
+                                    float(field)
+                                except ValueError:
+                                    isnum[i] = False
+            self._varinfo = [(name, not num) for name, num in zip(header, isnum)]
+        return self._varinfo
+
+    def blocks(self, names, blocksize):
+        varinfo = self.variables()
+        header = [name for name, isstring in varinfo]
+        idx = [header.index(name) for name in names]
+        isnum = [not varinfo[i][1] for i in idx]
+        with open(self.path, newline="", encoding=self.encoding) as f:
+            reader = self._reader(f)
+            next(reader)
+            block = []
+            for row in reader:
+                case = []
+                for i, num in zip(idx, isnum):
+                    field = row[i]
+                    if num:
+                        field = float(field) if field.strip() else None
+                    case.append(field)
+                block.append(tuple(case))
+                if len(block) >= blocksize:
+                    yield block
+                    block = []
+            if block:
+                yield block
+
+
+class SavSource(DataSource):
+    """An SPSS Statistics sav file read with the pyreadstat package"""
+
+    def __init__(self, path):
+        self.path = path
+        self._varinfo = None
+
+    def variables(self):
+        if self._varinfo is None:
+            pyreadstat = optionalimport("pyreadstat")
+            df, meta = pyreadstat.read_sav(self.path, metadataonly=True)
+            self._varinfo = [(name, meta.readstat_variable_types[name] == "string")\
+                for name in meta.column_names]
+            self._widths = meta.variable_storage_width
+        return self._varinfo
+
+    def vartype(self, name):
+        self.variables()
+        return self.isstring(name) and self._widths[name] or 0
+
+    def blocks(self, names, blocksize):
+        pyreadstat = optionalimport("pyreadstat")
+        for df, meta in pyreadstat.read_file_in_chunks(pyreadstat.read_sav, self.path,
+                chunksize=blocksize, usecols=names, apply_value_formats=False):
+            columns = [[None if value != value else value for value in df[name].tolist()]\
+                for name in names]
+            yield list(zip(*columns))
+
+
+class ParquetSource(DataSource):
+    """A Parquet file read with the pyarrow package"""
+
+    def __init__(self, path):
+        self.path = path
+        self._varinfo = None
+
+    def variables(self):
+        if self._varinfo is None:
+            pq = optionalimport("pyarrow.parquet")
+            pa = optionalimport("pyarrow")
+            schema = pq.read_schema(self.path)
+            self._varinfo = [(field.name, pa.types.is_string(field.type) or pa.types.is_large_string(field.type))\
+                for field in schema]
+        return self._varinfo
+
+    def blocks(self, names, blocksize):
+        pq = optionalimport("pyarrow.parquet")
+        pf = pq.ParquetFile(self.path)
+        for batch in pf.iter_batches(batch_size=blocksize, columns=names):
+            columns = []
+            for name in names:
+                values = batch.column(name).to_pylist()
+                if not self.isstring(name):
+                    values = [None if value is None else float(value) for value in values]
+                columns.append(values)
+            yield list(zip(*columns))
+
+def optionalimport(name):
+    """Return the named module or raise ValueError if it is not installed"""
+
+    import importlib
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        raise ValueError(_("""This file type requires the %s package, which is not installed""") % name)
+
+def opensource(path, **kwds):
+    """Return a DataSource for path based on its extension"""
+
+    ext = path.lower().rsplit(".", 1)[-1]
+    if ext == "sav" or ext == "zsav":
+        return SavSource(path)
+    if ext == "parquet":
+        return ParquetSource(path)
+    if ext in ["csv", "txt", "dat"]:
+        return CsvSource(path, **kwds)
+    raise ValueError(_("""Unsupported data file type: %s""") % path)
+
+def resolve(varinfo, itemtype, varlist, pattern, stringonly):
+    """Return validated list of variables from a data source variable list
+
+    varinfo is a list of (name, isstring) duples in file order
+    itemtype identifies the input description for error message purposes
+    varlist is a sequence of variable names, which may include TO, or None
+    pattern is a regular expression or None.  Matching is caseless.
+    stringonly = True excludes numeric variables from pattern matches"""
+
+    if (varlist is None and pattern is None) or\
+       (varlist is not None and pattern is not None):
+        raise ValueError(_("Either a variable list or a pattern must be specified but not both: %s") % itemtype)
+
+    names = [name for name, isstring in varinfo]
+    lookup = dict((name.lower(), i) for i, name in enumerate(names))
+    if varlist:
+        result = []
+        i = 0
+        while i < len(varlist):
+            try:
+                if i + 2 < len(varlist) and varlist[i+1].lower() == "to":
+                    start, end = lookup[varlist[i].lower()], lookup[varlist[i+2].lower()]
+                    result.extend(names[start:end+1])
+                    i += 3
+                else:
+                    result.append(names[lookup[varlist[i].lower()]])
+                    i += 1
+            except KeyError as e:
+                raise ValueError(_("Undefined variable: %s") % e.args[0])
+        return result
+    else:
+        pat = re.compile(pattern, re.IGNORECASE)
+        return [name for name, isstring in varinfo if pat.match(name) and (isstring or not stringonly)]
+
+def checkvars(varstolabel, labelvars, isstring):
+    """Raise ValueError if the variables to label and label variables do not fit together"""
+
+    if len(varstolabel) == 0 or len(labelvars) == 0:
+        raise ValueError(_("""No variables to label or no labelling variables were specified.
+If a pattern was used, it may not have matched any variables."""))
+    if len(labelvars) > 1 and len(labelvars) != len(varstolabel):
+        raise ValueError(_("The number of label variables is different from the number of variables to label"))
+    if not min([isstring(item) for item in labelvars]):
+        raise ValueError(_("""The label variables must all have type string"""))
+
+DATAEXTENSIONS = [".sav", ".zsav", ".parquet", ".csv", ".txt", ".dat"]
+
+def datafiles(paths):
+    """Return the data files named by paths in order
+
+    A directory stands for the files in it with a data file extension, in name order."""
+
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in sorted(os.listdir(path))\
+                if os.path.splitext(name)[1].lower() in DATAEXTENSIONS)
+        else:
+            files.append(path)
+    return files
+
+@functools.lru_cache(maxsize=100)
+def resolvepairs(varinfo, variables, varpattern, lblvars, lblpattern):
+    """Return the variables to label and the label variables for a file layout
+
+    varinfo is a tuple of (name, isstring) duples.  The other arguments are as for
+    resolve, with lists as tuples.  Files in a batch usually share a layout,
+    so the result is cached.  The cache belongs to the process, so with worker
+    processes each worker resolves a layout once."""
+
+    types = dict(varinfo)
+    varstolabel = resolve(varinfo, _("variables to label"), variables, varpattern, stringonly=False)
+    labelvars = resolve(varinfo, _("label variables"), lblvars, lblpattern, stringonly=True)
+    checkvars(varstolabel, labelvars, types.__getitem__)
+    return varstolabel, labelvars
+
+def labelmapdigest(tally):
+    """Return a digest identifying the labels of a tally, so equal maps can be recognized across files"""
+
+    digest = hashlib.sha1()
+    for value, label in sorted((value, label) for value, label in tally.labels.items() if value is not None):
+        digest.update(repr((value, str(label))).encode("utf_8"))
+    return digest.hexdigest()
+
+def _batchfile(path, syntax, spec):
+    """worker process entry point: label one file of a batch and return its summary rows
+
+    path is the data file
+    syntax is the file for its VALUE LABELS syntax
+    spec is (variables, varpattern, lblvars, lblpattern) with tuples for lists"""
+
+    source = opensource(path)
+    varstolabel, labelvars = resolvepairs(tuple(source.variables()), *spec)
+    tallies = tallycases(source, varstolabel, labelvars)
+    resolvetallies(tallies)
+    with open(syntax, "w", encoding="utf_8_sig") as f:
+        for cmd in labelsyntax(tallies, source.isstring, vartype=source.vartype):
+            f.write(cmd + "\n")
+    return [(path, vname, lbl, len([v for v in tallies[vname].labels if v is not None]),
+        tallies[vname].nconflicts, tallies[vname].nduplabels, labelmapdigest(tallies[vname]))\
+        for vname, lbl in zip(varstolabel, pairlabels(varstolabel, labelvars))]
+
+def batch(paths, outdir, variables=None, varpattern=None, lblvars=None, lblpattern=None, workers=1):
+    """Derive value labels for a set of data files and return a combined summary
+
+    paths is a list of data files and directories, as for datafiles
+    outdir is the directory for the syntax files.  Each is named after its data file with .sps.
+    It is created if it does not exist.
+    The variable specifications are as for resolve and apply to every file.
+    workers is the number of files processed at once in worker processes.  0 means one per processor.
+
+    The variables are resolved once per distinct file layout in each process.  Nothing else
+    is shared: every file is read and tallied in full, since its values can differ.  A label
+    map that is identical to one from an earlier file is recognized by its digest afterwards,
+    and the summary names that file.
+    Returns a list of (file, variable, label variable, values, conflicts, duplicates, same as) tuples."""
+
+    files = datafiles(paths)
+    syntaxes = [os.path.join(outdir, os.path.splitext(os.path.basename(path))[0] + ".sps") for path in files]
+    if len(set(syntaxes)) < len(syntaxes):
+        raise ValueError(_("""Data files with the same name would overwrite each other's syntax file"""))
+    spec = (variables and tuple(variables), varpattern, lblvars and tuple(lblvars), lblpattern)
+    os.makedirs(outdir, exist_ok=True)
+    with contextlib.ExitStack() as stack:
+        if workers == 1:
+            results = map(_batchfile, files, syntaxes, itertools.repeat(spec))
+        else:
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=workers or None))
+            results = executor.map(_batchfile, files, syntaxes, itertools.repeat(spec))
+        firstseen = {}      # (variable, label variable, digest) -> first file with that label map
+        summary = []
+        for rows in results:
+            for path, vname, lbl, nvalues, nconflicts, ndups, digest in rows:
+                first = firstseen.setdefault((vname, lbl, digest), path)
+                summary.append((path, vname, lbl, nvalues, nconflicts, ndups, first != path and first or ""))
+    return summary
+
+def main(argv=None):
+    """Derive value labels from a data file and write the syntax"""
+
+    import argparse
+    parser = argparse.ArgumentParser(description=_("""Create value labels for variables from the values of other variables"""))
+    parser.add_argument("data", nargs="+", help=_("""data file: .sav, .zsav, .parquet, or .csv.
+        Several files or a directory are processed as a batch."""))
+    parser.add_argument("--variables", nargs="+", help=_("""variables to label"""))
+    parser.add_argument("--varpattern", help=_("""regular expression for the variables to label"""))
+    parser.add_argument("--lblvars", nargs="+", help=_("""label variables"""))
+    parser.add_argument("--lblpattern", help=_("""regular expression for the label variables"""))
+    parser.add_argument("--syntax", help=_("""file for the VALUE LABELS syntax.  The default is standard output."""))
+    parser.add_argument("--export", help=_("""file for the value label map with conflict and duplicate flags:
+        .jsonl, .csv, or .parquet.  It is not written for a batch."""))
+    parser.add_argument("--workers", type=int, default=1,
+        help=_("""number of worker processes.  0 means one per processor.
+        In a batch, files rather than variables are spread over the workers."""))
+    parser.add_argument("--outdir", default=".", help=_("""directory for the syntax files of a batch"""))
+    parser.add_argument("--summary", help=_("""csv file for the summary of a batch.  The default is standard error.
+        The summary names the earlier file, if any, with the same labels for a variable."""))
+    args = parser.parse_args(argv)
+
+    if len(args.data) > 1 or os.path.isdir(args.data[0]):
+        summary = batch(args.data, args.outdir, args.variables, args.varpattern, args.lblvars, args.lblpattern,
+            args.workers)
+        header = [_("File"), _("Variable"), _("Label Variable"), _("Values Labelled"), _("Label Conflicts"),
+            _("Duplicate Labels"), _("Same Labels As")]
+        if args.summary:
+            with open(args.summary, "w", newline="", encoding="utf_8_sig") as f:
+                writer = csv.writer(f)
+                writer.writerow(header)
+                writer.writerows(summary)
+        else:
+            print("\t".join(header), file=sys.stderr)
+            for row in summary:
+                print("\t".join(str(item) for item in row), file=sys.stderr)
+        return
+
+    source = opensource(args.data[0])
+    varinfo = source.variables()
+    varstolabel = resolve(varinfo, _("variables to label"), args.variables, args.varpattern, stringonly=False)
+    labelvars = resolve(varinfo, _("label variables"), args.lblvars, args.lblpattern, stringonly=True)
+    checkvars(varstolabel, labelvars, source.isstring)
+    if args.workers == 1:
+        tallies = tallycases(source, varstolabel, labelvars)
+    else:
+        tallies = tallyparallel(source, varstolabel, labelvars, workers=args.workers or None)
+    resolvetallies(tallies)
+    if args.export:
+        exportmap(args.export, tallies, source.isstring)
+    vlsyntax = labelsyntax(tallies, source.isstring, vartype=source.vartype)
+    if args.syntax:
+        with open(args.syntax, "w", encoding="utf_8_sig") as f:
+            for cmd in vlsyntax:
+                f.write(cmd + "\n")
+    else:
+        for cmd in vlsyntax:
+            print(cmd)
+    print("\t".join([_("Variable"), _("Label Conflicts"), _("Duplicate Labels")]), file=sys.stderr)
+    for vname in varstolabel:
+        print("%s\t%s\t%s" % (vname, tallies[vname].nconflicts, tallies[vname].nduplabels), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+"""Test setup for STATS VALLBLS FROMDATA
+
+The engine is imported from src, and the extension command runs against the
+SPSS stand-in in benchmarks/fakespss, so no Statistics license is needed."""
+
+import os, sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(here, "..", "benchmarks", "fakespss"), os.path.join(here, "..", "src")]
+
+import pytest
+import spss
+import STATS_VALLBLS_FROMDATA
+
+# localization is set up only when the command is run from syntax
+STATS_VALLBLS_FROMDATA._ = lambda msg: msg
+
+# a small file with numeric and string variables to label, sysmis and blank values,
+# blank labels, a conflicting label, and a duplicated label
+NAMES = ["x", "s", "lx", "ls"]
+TYPES = [0, 2, 8, 4]
+ROWS = [
+    [1.0, "a", "one", "A"],
+    [2.0, "b", "two", "B"],
+    [None, "c", "missing", ""],
+    [4.0, "a", "FOUR", "A"],
+    [4.0, "a", "four", ""],
+    [5.0, "d", "one", "D"],
+    [3.0, "b", "", "B"],
+    [3.0, "  ", "three", "x"],
+]
+
+@pytest.fixture
+def dataset():
+    """Load the small file as the active dataset and return the stand-in spss module"""
+
+    spss.reset()
+    spss.loaddataset("DataSet1", NAMES, TYPES, ROWS)
+    yield spss
+    spss.reset()
@@ -0,0 +1,60 @@
+"""Tests of the batch mode of the engine"""
+
+import csv, os
+
+import pytest
+import vallblsengine
+
+
+def writecsv(path, rows):
+    with open(path, "w", newline="", encoding="utf_8_sig") as f:
+        writer = csv.writer(f)
+        writer.writerow(["q1", "q2", "lbl1", "lbl2"])
+        writer.writerows(rows)
+
+@pytest.fixture
+def monthly(tmp_path):
+    """A directory of three monthly files.  February has the same q1 labels as January."""
+
+    folder = tmp_path / "monthly"
+    folder.mkdir()
+    writecsv(str(folder / "jan.csv"), [[1, 1, "one", "yes"], [2, 2, "two", "no"], [2, 1, "TWO", "yes"]])
+    writecsv(str(folder / "feb.csv"), [[2, 2, "two", "no"], [1, 2, "one", "no"], [2, 2, "TWO", "no"]])
+    writecsv(str(folder / "mar.csv"), [[1, 1, "uno", "si"]])
+    (folder / "notes.txt.bak").write_text("not data")
+    return folder
+
+SPEC = dict(variables=["q1", "q2"], lblvars=["lbl1", "lbl2"])
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_batch(monthly, tmp_path, workers):
+    outdir = str(tmp_path / "out" / "syntax")
+    summary = vallblsengine.batch([str(monthly)], outdir, workers=workers, **SPEC)
+    assert sorted(os.listdir(outdir)) == ["feb.sps", "jan.sps", "mar.sps"]
+    with open(os.path.join(outdir, "jan.sps"), encoding="utf_8_sig") as f:
+        assert f.read() == 'VALUE LABELS q1\n   1 "one"\n   2 "two".\nVALUE LABELS q2\n   1 "yes"\n   2 "no".\n'
+    # files are taken in name order, so January's q1 labels are the same as February's
+    feb, jan, mar = [os.path.join(str(monthly), name) for name in ["feb.csv", "jan.csv", "mar.csv"]]
+    assert summary == [
+        (feb, "q1", "lbl1", 2, 1, 0, ""), (feb, "q2", "lbl2", 1, 0, 0, ""),
+        (jan, "q1", "lbl1", 2, 1, 0, feb), (jan, "q2", "lbl2", 2, 0, 0, ""),
+        (mar, "q1", "lbl1", 1, 0, 0, ""), (mar, "q2", "lbl2", 1, 0, 0, "")]
+
+def test_batch_names_must_not_collide(monthly, tmp_path):
+    other = tmp_path / "other"
+    other.mkdir()
+    writecsv(str(other / "jan.csv"), [[1, 1, "one", "yes"]])
+    with pytest.raises(ValueError):
+        vallblsengine.batch([str(monthly), str(other / "jan.csv")], str(tmp_path / "out"), **SPEC)
+
+def test_main_writes_summary_csv(monthly, tmp_path):
+    outdir, path = str(tmp_path / "out"), str(tmp_path / "summary.csv")
+    vallblsengine.main([str(monthly / "jan.csv"), str(monthly / "mar.csv"), "--variables", "q1", "TO", "q2",
+        "--lblpattern", "lbl", "--outdir", outdir, "--summary", path])
+    with open(path, newline="", encoding="utf_8_sig") as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == ["File", "Variable", "Label Variable", "Values Labelled", "Label Conflicts",
+        "Duplicate Labels", "Same Labels As"]
+    assert [row[1:] for row in rows[1:]] == [["q1", "lbl1", "2", "1", "0", ""], ["q2", "lbl2", "2", "0", "0", ""],
+        ["q1", "lbl1", "1", "0", "0", ""], ["q2", "lbl2", "1", "0", "0", ""]]
+    assert sorted(os.listdir(outdir)) == ["jan.sps", "mar.sps"]
@@ -0,0 +1,89 @@
+"""Tests that tallying blocks of cases with NumPy gives the same tallies as case by case"""
+
+import random
+
+import pytest
+import vallblsengine
+from vallblsengine import VarTally
+
+numpy = pytest.importorskip("numpy")
+
+
+class ListSource(vallblsengine.DataSource):
+    """cases held in a list"""
+
+    def __init__(self, varinfo, cases):
+        self.varinfo = varinfo
+        self.cases = cases
+
+    def variables(self):
+        return self.varinfo
+
+    def blocks(self, names, blocksize):
+        header = [name for name, isstring in self.varinfo]
+        idx = [header.index(name) for name in names]
+        for start in range(0, len(self.cases), blocksize):
+            yield [tuple(case[i] for i in idx) for case in self.cases[start:start+blocksize]]
+
+def mkcases(ncases, card, seed):
+    """Return varinfo and cases with numeric and string values, sysmis, and blank and conflicting labels
+
+    Each variable to label has its own label variable, and lmixed labels both the numeric
+    and the string variable with no regard to their values, so nearly all of theirs conflict."""
+
+    rnd = random.Random(seed)
+    varinfo = [("num", False), ("str", True), ("wide", False), ("lnum", True), ("lstr", True), ("lwide", True),
+        ("lmixed", True)]
+    labels = ["", " ", None, "label with trailing blanks   ", "x" * 200 + "_"] + ["label %d" % i for i in range(card)]
+    cases = []
+    for c in range(ncases):
+        num = rnd.choice([None, float(rnd.randrange(card)), rnd.randrange(card) + .5])
+        string = rnd.choice(["", "  ", "s%d " % rnd.randrange(card), "s%d" % rnd.randrange(card)])
+        wide = rnd.choice([None, float(c)])
+        def label(value):
+            if rnd.random() < .2:
+                return rnd.choice(labels)
+            return "label %s" % (value.strip() if isinstance(value, str) else value)
+        cases.append((num, string, wide, label(num), label(string), label(wide), rnd.choice(labels)))
+    return varinfo, cases
+
+def tallyall(source, varstolabel, labelvars, rule, blocksize, withnumpy, monkeypatch):
+    with monkeypatch.context() as m:
+        if not withnumpy:
+            m.setattr(vallblsengine, "numpy", None)
+        tallies = dict((v, VarTally(rule=rule)) for v in varstolabel)
+        vallblsengine.tallycases(source, varstolabel, labelvars, tallies, blocksize=blocksize)
+    vallblsengine.resolvetallies(tallies)
+    return tallies
+
+def contents(tally):
+    return (list(tally.labels.items()), [type(label) for label in tally.labels.values()],
+        tally.nconflicts, tally.nduplabels, tally.conflicts, tally.duplabels, tally.counts, tally.shares)
+
+@pytest.mark.parametrize("rule", VarTally.RULES)
+@pytest.mark.parametrize("blocksize", [1, 7, 100, 10000])
+@pytest.mark.parametrize("labelvars", [["lnum", "lstr", "lwide"], ["lmixed"]])
+def test_numpy_and_scalar_tallies_are_identical(rule, blocksize, labelvars, monkeypatch):
+    varstolabel = ["num", "str", "wide"]
+    for seed in range(3):
+        source = ListSource(*mkcases(500, 6, seed))
+        scalar = tallyall(source, varstolabel, labelvars, rule, blocksize, False, monkeypatch)
+        blocked = tallyall(source, varstolabel, labelvars, rule, blocksize, True, monkeypatch)
+        for vname in varstolabel:
+            assert contents(blocked[vname]) == contents(scalar[vname]), (seed, vname)
+        assert list(vallblsengine.labelsyntax(blocked, source.isstring)) ==\
+            list(vallblsengine.labelsyntax(scalar, source.isstring))
+
+def test_data_has_what_the_comparison_needs(monkeypatch):
+    source = ListSource(*mkcases(500, 6, 0))
+    tallies = tallyall(source, ["num", "str"], ["lmixed"], "first", 100, False, monkeypatch)
+    assert None in tallies["num"].labels and "" in tallies["str"].labels
+    assert tallies["num"].nconflicts and tallies["num"].nduplabels
+    assert tallies["str"].nconflicts and tallies["str"].nduplabels
+
+def test_firstdistinct_keeps_case_order():
+    block = [(1.0, "a"), (2.0, "b"), (1.0, "a"), (1.0, "c"), (2.0, ""), (2.0, "b"), (None, "m")] * 3
+    columns = vallblsengine.BlockColumns(block)
+    assert columns.firstdistinct(0, False, 1, 1) == [0, 1, 3, 6]
+    positions, totals = columns.distinctcounts(0, False, 1)
+    assert (positions, totals) == ([0, 1, 3, 6], [6, 6, 3, 3])
@@ -0,0 +1,80 @@
+"""Tests of queueing backend commands and submitting them in batches"""
+
+import pytest
+import spss, spssdata
+import STATS_VALLBLS_FROMDATA
+from STATS_VALLBLS_FROMDATA import dolabels, CommandQueue, Diagnostics
+from conftest import NAMES, TYPES, ROWS
+
+ENGINES = ["wide", "long", "stream"]
+
+
+def test_add_terminates_commands(dataset):
+    queue = CommandQueue(Diagnostics(False))
+    queue.add("DATASET DECLARE a")
+    queue.add(["DATASET DECLARE b.", "DATASET DECLARE c  ", 'VALUE LABELS x 1 "one."\n'])
+    assert queue.pending == ["DATASET DECLARE a.", "DATASET DECLARE b.", "DATASET DECLARE c.", 'VALUE LABELS x 1 "one.".']
+    assert not spss.submitted
+    queue.flush()
+    # without the periods, the stand-in, like the backend, would read the batch as one command
+    assert spss.submitted == [["DATASET DECLARE a", "DATASET DECLARE b", "DATASET DECLARE c", 'VALUE LABELS x 1 "one."']]
+    assert (queue.pending, queue.size) == ([], 0)
+
+def test_flush_without_commands_does_not_submit(dataset):
+    queue = CommandQueue(Diagnostics(False))
+    queue.flush()
+    assert spss.submitted == []
+
+def test_one_submit_per_pass(dataset):
+    # a WIDE run in two passes needs a Submit for each aggregate and one to clean up
+    dolabels(variables=["x", "s"], lblvars=["lx", "ls"], varsperpass=1)
+    aggr = [c for c in spss.submitted[0] if c.startswith("DATASET DECLARE")][0].split()[-1]
+    def batch(var):
+        return ["DATASET ACTIVATE DataSet1", "DATASET DECLARE %s" % aggr, "AGGREGATE", "DATASET ACTIVATE %s" % aggr,
+            "BREAK %s" % var]
+    def described(commands):
+        # the AGGREGATE command names random variables, so only its BREAK variable is compared
+        return [c.split(" /")[0] for c in commands] + [c.split("/")[2] for c in commands if c.startswith("AGGREGATE")]
+    assert [described(s) for s in spss.submitted] == [batch("x"), ["DATASET CLOSE %s" % aggr] + batch("s"),
+        ["DATASET CLOSE %s" % aggr, "DATASET ACTIVATE DataSet1"]]
+    assert spss.activedata().valuelabels["x"][1.0] == "one"
+
+def test_submits_do_not_grow_with_commands(dataset):
+    # the labels go in the last batch with syntax, so ten passes take eleven Submits
+    names = ["v%d" % i for i in range(10)] + ["lbl"]
+    rows = [[float(i % 3)] * 10 + ["L%d" % (i % 3)] for i in range(30)]
+    spss.reset()
+    spss.loaddataset("DataSet1", names, [0] * 10 + [4], rows)
+    dolabels(variables=["v0", "TO", "v9"], lblvars=["lbl"], varsperpass=1, apply="syntax")
+    assert len(spss.submitted) == 11
+    assert all(len(s) == 5 for s in spss.submitted[1:-1])
+    assert [c.split()[0] for c in spss.submitted[-1]] == ["DATASET", "DATASET", "VALUE"]
+    assert spss.activedata().valuelabels["v9"] == {0.0: "L0", 1.0: "L1", 2.0: "L2"}
+
+@pytest.mark.parametrize("apply", ["datastep", "syntax"])
+@pytest.mark.parametrize("engine", ENGINES)
+def test_queue_is_empty_when_results_are_needed(engine, apply, tmp_path, monkeypatch):
+    # cursors, case counts, and data steps all see the backend state, so nothing may still be queued
+    queues = []
+    class RecordedQueue(CommandQueue):
+        def __init__(self, diagnostics):
+            CommandQueue.__init__(self, diagnostics)
+            queues.append(self)
+    needed = []
+    def checked(name, func):
+        def call(*args, **kwds):
+            assert not any(q.pending for q in queues), name
+            needed.append(name)
+            return func(*args, **kwds)
+        return call
+    monkeypatch.setattr(STATS_VALLBLS_FROMDATA, "CommandQueue", RecordedQueue)
+    monkeypatch.setattr(spssdata, "Spssdata", checked("cursor", spssdata.Spssdata))
+    monkeypatch.setattr(spss, "GetCaseCount", checked("case count", spss.GetCaseCount))
+    monkeypatch.setattr(spss, "StartDataStep", checked("data step", spss.StartDataStep))
+    spss.reset()
+    spss.loaddataset("DataSet1", NAMES, TYPES, ROWS, datafile="/data/survey.sav")
+    dolabels(variables=["x", "s"], lblvars=["lx", "ls"], engine=engine, varsperpass=1, apply=apply,
+        plan="adaptive" if engine == "wide" else "fixed", checkpoint=str(tmp_path / "run.ckpt"))
+    assert queues and "cursor" in needed and "case count" in needed
+    assert ("data step" in needed) == (apply == "datastep")
+    assert spss.activedata().valuelabels["x"][4.0] == "four"
@@ -0,0 +1,193 @@
+"""Tests of the extension command run against the SPSS stand-in"""
+
+import os
+
+import pytest
+import spss
+import vallblsengine
+from STATS_VALLBLS_FROMDATA import dolabels
+from conftest import NAMES, TYPES, ROWS
+
+ENGINES = ["wide", "long", "stream"]
+LABELS = {"x": {1.0: "one", 2.0: "two", 3.0: "three", 4.0: "four", 5.0: "one"},
+    "s": {"": "x", "a": "A", "b": "B", "d": "D"}, "lx": {}, "ls": {}}
+
+def table(title):
+    """Return the cell values of the pivot table with title"""
+
+    cells = [t.cells for t in spss.output if t.title == title][0]
+    return [[getattr(cell, "value", cell) for cell in row] for row in cells]
+
+@pytest.mark.parametrize("apply", ["datastep", "syntax"])
+@pytest.mark.parametrize("engine", ENGINES)
+def test_labels(dataset, engine, apply):
+    dolabels(variables=["x", "s"], lblvars=["lx", "ls"], engine=engine, apply=apply)
+    assert spss.activedata().valuelabels == LABELS
+    assert table("Value Label Generation") == [["lx", 1, 1], ["ls", 0, 0]]
+    assert table("Label Conflicts") == [["x", "4", "four", "FOUR"]]
+    assert table("Duplicate Labels") == [["x", "one", "1", "5"]]
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_one_variable_per_pass(dataset, engine):
+    dolabels(variables=["x", "s"], lblvars=["lx", "ls"], engine=engine, varsperpass=1)
+    assert spss.activedata().valuelabels == LABELS
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_single_label_variable(dataset, engine):
+    dolabels(variables=["x"], lblvars=["lx"], engine=engine)
+    assert spss.activedata().valuelabels["x"] == LABELS["x"]
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_syntax_file_without_execute(dataset, engine, tmp_path):
+    path = str(tmp_path / "labels.sps")
+    dolabels(variables=["x", "s"], lblvars=["lx", "ls"], engine=engine, syntax=path, execute=False)
+    assert spss.activedata().valuelabels["x"] == {}
+    with open(path, encoding="utf_8_sig") as f:
+        text = f.read()
+    assert 'VALUE LABELS x\n   1 "one"\n   2 "two"\n   3 "three"\n   4 "four"\n   5 "one".' in text
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_cache_with_appended_cases(engine, tmp_path):
+    cache = str(tmp_path / "cache.json")
+    spec = dict(variables=["x", "s"], lblvars=["lx", "ls"], engine=engine, cache=cache, apply="syntax")
+    spss.reset()
+    spss.loaddataset("DataSet1", NAMES, TYPES, ROWS[:4], datafile="/data/survey.sav")
+    dolabels(**spec)
+    assert os.path.exists(cache)
+    labels = spss.activedata().valuelabels
+    spss.reset()
+    spss.loaddataset("DataSet1", NAMES, TYPES, ROWS, labels, datafile="/data/survey.sav")
+    dolabels(**spec)
+    assert spss.activedata().valuelabels == LABELS
+    commands = [c for s in spss.submitted for c in s if "VALUE LABELS" in c.upper()]
+    assert commands and all(c.startswith("ADD VALUE LABELS") for c in commands)
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_cache_is_not_used_for_other_data(engine, tmp_path):
+    cache = str(tmp_path / "cache.json")
+    spec = dict(variables=["x", "s"], lblvars=["lx", "ls"], engine=engine, cache=cache, apply="syntax")
+    spss.reset()
+    spss.loaddataset("DataSet1", NAMES, TYPES, [[9.0, "z", "nine", "Z"]])
+    dolabels(**spec)
+    spss.reset()
+    spss.loaddataset("DataSet1", NAMES, TYPES, ROWS)
+    dolabels(**spec)
+    assert spss.activedata().valuelabels == LABELS
+    commands = [c for s in spss.submitted for c in s if "VALUE LABELS" in c.upper()]
+    assert not any(c.startswith("ADD") for c in commands)
+
+def test_numeric_label_variable_is_an_error(dataset):
+    with pytest.raises(ValueError):
+        dolabels(variables=["s"], lblvars=["x"])
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_memorybudget_spills(engine):
+    # about 5000 values fit in one MB, so the tallies spill, and WIDE reads more than one block
+    rows = [[float(i), "s%d" % i, "label %d" % i, "label s%d" % i] for i in range(60000)]
+    spss.reset()
+    spss.loaddataset("DataSet1", NAMES, TYPES, rows)
+    dolabels(variables=["x", "s"], lblvars=["lx", "ls"], engine=engine, memorybudget=1, apply="syntax")
+    caption = [t.caption for t in spss.output if t.title == "Value Label Generation"][0]
+    assert "moved to disk" in caption
+    labels = spss.activedata().valuelabels
+    assert len(labels["x"]) == len(labels["s"]) == 60000
+    assert labels["x"][59999.0] == "label 59999" and labels["s"]["s0"] == "label s0"
+
+def test_patterns_see_dictionary_changes():
+    # the same dataset name and variable count, but z has become q2
+    rows = [[1.0, 2.0, "one"], [2.0, 1.0, "two"]]
+    spss.reset()
+    spss.loaddataset("DataSet1", ["q1", "z", "lbl"], [0, 0, 8], rows)
+    dolabels(varpattern="q", lblvars=["lbl"])
+    assert spss.activedata().valuelabels["z"] == {}
+    spss.reset()
+    spss.loaddataset("DataSet1", ["q1", "q2", "lbl"], [0, 0, 8], rows)
+    dolabels(varpattern="q", lblvars=["lbl"])
+    assert spss.activedata().valuelabels["q2"] == {1.0: "two", 2.0: "one"}
+
+@pytest.mark.parametrize("syntax", [False, True])
+def test_datastep_streams_spilled_labels(syntax, tmp_path, monkeypatch):
+    # each label must be set as it is read from disk, not after the whole set is collected
+    items = vallblsengine.SpillTally.items
+    def checkeditems(self):
+        for i, (value, label) in enumerate(items(self)):
+            if spss._datastep:
+                assert len(spss.activedata().valuelabels["x"]) == i
+            yield value, label
+    monkeypatch.setattr(vallblsengine.SpillTally, "items", checkeditems)
+    rows = [[float(i), "s", "label %d" % i, "S"] for i in range(6000)]
+    spss.reset()
+    spss.loaddataset("DataSet1", NAMES, TYPES, rows, {"x": {-1.0: "old"}})
+    path = syntax and str(tmp_path / "labels.sps") or None
+    dolabels(variables=["x"], lblvars=["lx"], engine="stream", memorybudget=1, syntax=path)
+    assert "moved to disk" in [t.caption for t in spss.output if t.title == "Value Label Generation"][0]
+    labels = spss.activedata().valuelabels["x"]
+    assert len(labels) == 6000 and labels[5999.0] == "label 5999"
+    if syntax:
+        with open(path, encoding="utf_8_sig") as f:
+            text = f.read()
+        assert text.startswith('VALUE LABELS x\n   0 "label 0"\n') and text.count("\n") == 6001
+
+@pytest.mark.parametrize("apply", ["datastep", "syntax"])
+def test_strings_of_different_widths_are_not_grouped(apply, tmp_path):
+    path = str(tmp_path / "labels.sps")
+    spss.reset()
+    spss.loaddataset("DataSet1", ["s1", "s2", "s3", "lbl"], [4, 8, 4, 8], [["a", "a", "a", "A"], ["b", "b", "b", "B"]])
+    dolabels(variables=["s1", "TO", "s3"], lblvars=["lbl"], apply=apply, syntax=path)
+    with open(path, encoding="utf_8_sig") as f:
+        commands = f.read().splitlines()
+    assert [line for line in commands if line.startswith("VALUE LABELS")] == ["VALUE LABELS s1 s3", "VALUE LABELS s2"]
+    assert spss.activedata().valuelabels["s2"] == {"a": "A", "b": "B"}
+
+@pytest.mark.parametrize("apply", ["datastep", "syntax"])
+@pytest.mark.parametrize("engine", ENGINES)
+def test_delta_keeps_existing_and_hand_edited_labels(engine, apply, tmp_path):
+    # 1 already has its label, 2 has a different one, 9 was labelled by hand and is not in the data,
+    # and s already has exactly the generated labels
+    path = str(tmp_path / "labels.sps")
+    existing = {"x": {1.0: "one", 2.0: "deux", 9.0: "nine"}, "s": dict(LABELS["s"])}
+    spss.reset()
+    spss.loaddataset("DataSet1", NAMES, TYPES, ROWS, existing)
+    dolabels(variables=["x", "s"], lblvars=["lx", "ls"], engine=engine, apply=apply, delta=True, syntax=path)
+    assert spss.activedata().valuelabels["x"] == dict(list(LABELS["x"].items()) + [(9.0, "nine")])
+    assert spss.activedata().valuelabels["s"] == LABELS["s"]
+    with open(path, encoding="utf_8_sig") as f:
+        assert f.read() == 'ADD VALUE LABELS x\n   2 "two"\n   3 "three"\n   4 "four"\n   5 "one".\n'
+    caption = [t.caption for t in spss.output if t.title == "Value Label Generation"][0]
+    assert "1 variables needed no changes" in caption
+
+def highcarddata():
+    """Load a file in which h has 200 distinct values and a and c have 2, each with its own label variable"""
+
+    rows = [[float(i % 2), float(i), float(i % 2), "A%d" % (i % 2), "H%d" % i, "C%d" % (i % 2)] for i in range(200)]
+    spss.reset()
+    spss.loaddataset("DataSet1", ["a", "h", "c", "la", "lh", "lc"], [0, 0, 0, 4, 8, 4], rows)
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_highcard_skip(engine):
+    highcarddata()
+    dolabels(variables=["a", "h", "c"], lblvars=["la", "lh", "lc"], engine=engine, maxdistinct=50)
+    labels = spss.activedata().valuelabels
+    # the label variables stay paired with their variables when h is dropped
+    assert labels["a"] == {0.0: "A0", 1.0: "A1"} and labels["c"] == {0.0: "C0", 1.0: "C1"}
+    assert labels["h"] == {}
+    estimates = table("Estimated Distinct Values")
+    assert [row[2] for row in estimates[:3]] == ["", "Skipped", ""]
+    assert estimates[0][1] == 2 and abs(estimates[1][1] - 200) <= 4
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_highcard_isolate(engine):
+    highcarddata()
+    dolabels(variables=["a", "h", "c"], lblvars=["la", "lh", "lc"], engine=engine, maxdistinct=50, highcard="isolate")
+    labels = spss.activedata().valuelabels
+    assert labels["a"] == {0.0: "A0", 1.0: "A1"} and labels["c"] == {0.0: "C0", 1.0: "C1"}
+    assert len(labels["h"]) == 200 and labels["h"][199.0] == "H199"
+    assert [row[2] for row in table("Estimated Distinct Values")[:3]] == ["", "Isolated", ""]
+
+def test_highcard_all_variables_too_high():
+    highcarddata()
+    with pytest.raises(ValueError, match="MAXDISTINCT"):
+        dolabels(variables=["h"], lblvars=["lh"], maxdistinct=50)
+    # isolating them is still allowed
+    dolabels(variables=["h"], lblvars=["lh"], maxdistinct=50, highcard="isolate")
+    assert len(spss.activedata().valuelabels["h"]) == 200
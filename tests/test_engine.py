@@ -0,0 +1,310 @@
+"""Tests of the value label derivation engine"""
+
+import csv, json
+
+import pytest
+import vallblsengine
+from vallblsengine import VarTally
+
+
+def tally(triples, **kwds):
+    t = VarTally(**kwds)
+    for triple in triples:
+        t.add(*triple)
+    return t
+
+# ---- VarTally
+
+def test_tally_labels_and_blanks():
+    t = tally([(1.0, "one", "one"), (2.0, "two", "two"), (3.0, "", ""), (None, "missing", "missing"),
+        (1.0, None, None)])
+    assert t.labels == {1.0: "one", 2.0: "two", None: "missing"}
+    assert (t.nconflicts, t.nduplabels) == (0, 0)
+
+def test_tally_conflict_keeps_largest_label():
+    t = tally([(4.0, "FOUR", "FOUR"), (4.0, "four", "four"), (4.0, "Four", "Four")])
+    assert t.labels[4.0] == "four"
+    assert t.nconflicts == 1
+    assert t.conflicts == [(4.0, "FOUR", "four")]
+    t.resolve()
+    assert t.conflicts == [(4.0, "four", "FOUR")]
+    assert [item for item in t.flaggeditems()] == [(4.0, "four", True, False)]
+
+def test_tally_conflict_from_min_and_max():
+    t = tally([(1.0, "a", "b")])
+    assert t.labels[1.0] == "b"
+    assert (t.nconflicts, t.conflicts) == (1, [(1.0, "b", "a")])
+
+def test_tally_duplicates():
+    t = tally([(1.0, "one", "one"), (5.0, "one", "one"), (6.0, "one", "one"), (2.0, "two", "two")])
+    assert t.nduplabels == 1
+    assert t.duplabels == [("one", 1.0, 5.0)]
+    assert [dup for value, label, conflict, dup in t.flaggeditems()] == [True, False, True, True]
+
+def test_tally_without_duplicate_check():
+    t = tally([(1.0, "one", "one"), (5.0, "one", "one")], maxdups=None)
+    assert (t.nduplabels, t.duplabels) == (0, [])
+    assert [dup for value, label, conflict, dup in t.flaggeditems()] == [True, True]
+
+def test_tally_example_limits():
+    t = tally([(float(i), "a", "b") for i in range(5)] + [(float(i + 10), "a", "a") for i in range(5)],
+        maxconflicts=2, maxdups=1)
+    assert (t.nconflicts, len(t.conflicts)) == (5, 2)
+    # b labels the first five values and a the next five
+    assert (t.nduplabels, len(t.duplabels)) == (2, 1)
+
+def test_resolve_recounts_duplicates():
+    # 1 is first labelled dup, then wins with zzz, so dup is no longer duplicated
+    t = tally([(1.0, "dup", "dup"), (2.0, "dup", "dup"), (1.0, "zzz", "zzz")])
+    assert t.nduplabels == 1
+    t.resolve()
+    assert t.labels == {1.0: "zzz", 2.0: "dup"}
+    assert (t.nduplabels, t.duplabels) == (0, [])
+
+def test_resolve_mostfrequent():
+    t = tally([(1.0, "a", "a", 3), (1.0, "b", "b", 5), (1.0, "c", "c", 1), (2.0, "x", "x", 2)], rule="mostfrequent")
+    t.resolve()
+    assert t.labels == {1.0: "b", 2.0: "x"}
+    assert t.conflicts == [(1.0, "b", "a")]
+    assert t.shares == {1.0: 5 / 9}
+
+def test_resolve_longest():
+    t = tally([(1.0, "abc", "abc", 1), (1.0, "ab", "ab", 9), (1.0, "abd", "abd", 1)], rule="longest")
+    t.resolve()
+    # a tie in length goes to the label that sorts first
+    assert t.labels[1.0] == "abc"
+    assert t.conflicts[0][:2] == (1.0, "abc")
+
+def test_resolve_does_not_depend_on_case_order():
+    triples = [(1.0, "a", "a", 2), (1.0, "b", "b", 2), (2.0, "c", "c", 1), (2.0, "d", "d", 1)]
+    for rule in VarTally.RULES:
+        forward, backward = tally(triples, rule=rule), tally(reversed(triples), rule=rule)
+        forward.resolve()
+        backward.resolve()
+        assert forward.labels == backward.labels
+
+@pytest.mark.parametrize("rule", VarTally.RULES)
+def test_todict_fromdict(rule):
+    t = tally([(1.0, "one", "one", 2), (5.0, "one", "one", 1), (4.0, "FOUR", "FOUR", 1), (4.0, "four", "four", 3),
+        (None, "missing", "missing", 1)], rule=rule)
+    d = json.loads(json.dumps(t.todict()))
+    back = VarTally.fromdict(d, rule=rule)
+    assert back.labels == t.labels
+    assert [value for value, label in back.labels.items() if isinstance(label, vallblsengine._Conflicted)] == [4.0]
+    assert (back.nconflicts, back.nduplabels) == (t.nconflicts, t.nduplabels)
+    assert back.conflicts == t.conflicts and back.duplabels == t.duplabels
+    assert back.counts == t.counts
+    # tallying continues as if it had never been saved
+    t.add(5.0, "five", "five", 1)
+    back.add(5.0, "five", "five", 1)
+    t.resolve()
+    back.resolve()
+    assert back.labels == t.labels and back.conflicts == t.conflicts
+
+def test_fromdict_applies_limits():
+    t = tally([(float(i), "a", "b") for i in range(5)])
+    back = VarTally.fromdict(t.todict(), maxconflicts=2)
+    assert (back.nconflicts, len(back.conflicts)) == (5, 2)
+
+# ---- syntax
+
+def test_makevls():
+    assert vallblsengine.makevls(["x", "y"], [(1.0, "one"), (2.5, 'say "two"'), (None, "missing")], False) ==\
+        'VALUE LABELS x y\n   1 "one"\n   2.5 "say ""two""".'
+    assert vallblsengine.makevls(["s"], [("a", "A")], True, "ADD VALUE LABELS") ==\
+        'ADD VALUE LABELS s\n   "a" "A".'
+
+def test_makevls_wraps_long_variable_lists():
+    names = ["variable%02d" % i for i in range(20)]
+    header = vallblsengine.makevls(names, [(1.0, "one")], False).split("\n   ")
+    assert all(len(line) <= len("VALUE LABELS ") + 70 for line in header[:-1])
+    assert " ".join(header[:-1]).split()[2:] == names
+
+def test_labelsets_groups_identical_variables():
+    tallies = {"b": tally([(1.0, "one", "one")]), "a": tally([(1.0, "one", "one")]),
+        "c": tally([(1.0, "uno", "uno")]), "d": tally([(None, "missing", "missing")])}
+    sets = [(varnames, list(pairs), command) for varnames, pairs, command in vallblsengine.labelsets(tallies)]
+    assert sets == [(["a", "b"], [(1.0, "one")], "VALUE LABELS"), (["c"], [(1.0, "uno")], "VALUE LABELS")]
+
+def test_labelsets_groups_only_the_same_type():
+    tallies = dict((v, tally([("a", "A", "A")])) for v in ["s1", "s2", "s3"])
+    widths = {"s1": 4, "s2": 8, "s3": 4}
+    sets = list(vallblsengine.labelsets(tallies, vartype=widths.get))
+    assert sets == [(["s1", "s3"], (("a", "A"),), "VALUE LABELS"), (["s2"], (("a", "A"),), "VALUE LABELS")]
+
+def test_labelsets_baseline_and_existing():
+    tallies = {"x": tally([(1.0, "one", "one"), (2.0, "two", "two"), (3.0, "three", "three")]),
+        "y": tally([(1.0, "one", "one")])}
+    sets = list(vallblsengine.labelsets(tallies, baseline={"x": {1.0: "one", 2.0: "deux"}}, existing={"y": {1.0: "one"}}))
+    assert sets == [(["x"], ((2.0, "two"), (3.0, "three")), "ADD VALUE LABELS")]
+
+def test_labelsyntax():
+    tallies = {"x": tally([(2.0, "two", "two"), (1.0, "one", "one")]), "s": tally([("b", "B", "B")])}
+    assert list(vallblsengine.labelsyntax(tallies, lambda name: name == "s")) ==\
+        ['VALUE LABELS s\n   "b" "B".', 'VALUE LABELS x\n   1 "one"\n   2 "two".']
+
+# ---- export
+
+def exporttallies():
+    tallies = {"x": tally([(1.0, "one", "one"), (5.0, "one", "one"), (4.0, "FOUR", "FOUR"), (4.0, "four", "four"),
+        (2.5, "half", "half"), (None, "missing", "missing")]), "s": tally([("a", "A", "A")])}
+    vallblsengine.resolvetallies(tallies)
+    return tallies
+
+EXPORTED = [["s", "a", "A", False, False], ["x", 1, "one", False, True], ["x", 2.5, "half", False, False],
+    ["x", 4, "four", True, False], ["x", 5, "one", False, True]]
+
+def test_exportmap_jsonl(tmp_path):
+    path = str(tmp_path / "map.jsonl")
+    assert vallblsengine.exportmap(path, exporttallies(), lambda name: name == "s") == 5
+    with open(path, encoding="utf_8") as f:
+        rows = [json.loads(line) for line in f]
+    assert [list(row.values()) for row in rows] == EXPORTED
+    assert list(rows[0]) == ["variable", "value", "label", "conflict", "duplicate"]
+
+def test_exportmap_csv(tmp_path):
+    path = str(tmp_path / "map.csv")
+    assert vallblsengine.exportmap(path, exporttallies(), lambda name: name == "s") == 5
+    with open(path, newline="", encoding="utf_8_sig") as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == ["variable", "value", "label", "conflict", "duplicate"]
+    assert rows[1:] == [[str(item) if not isinstance(item, bool) else str(int(item)) for item in row]
+        for row in EXPORTED]
+
+def test_exportmap_parquet(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    path = str(tmp_path / "map.parquet")
+    assert vallblsengine.exportmap(path, exporttallies(), lambda name: name == "s") == 5
+    table = pq.read_table(path).to_pydict()
+    assert table["value"] == [str(row[1]) for row in EXPORTED]
+    assert table["conflict"] == [row[3] for row in EXPORTED]
+
+def test_exportformat():
+    assert vallblsengine.exportformat("a.NDJSON") == "jsonl"
+    with pytest.raises(ValueError):
+        vallblsengine.exportformat("a.txt")
+
+# ---- label cache
+
+def test_cache_round_trip(tmp_path):
+    path = str(tmp_path / "cache.json")
+    assert vallblsengine.loadcache(path, "data") == (0, {})
+    tallies = exporttallies()
+    vallblsengine.savecache(path, "data", 6, dict((v, ("print " + v, t)) for v, t in tallies.items()))
+    vallblsengine.savecache(path, "other", 1, {"x": ("print x", tally([(9.0, "nine", "nine")]))})
+    cases, cached = vallblsengine.loadcache(path, "data")
+    assert cases == 6
+    assert sorted(cached) == ["s", "x"]
+    for vname, (fingerprint, t) in cached.items():
+        assert fingerprint == "print " + vname
+        assert t.labels == tallies[vname].labels
+        assert t.conflicts == tallies[vname].conflicts and t.duplabels == tallies[vname].duplabels
+    assert vallblsengine.loadcache(path, "other")[1]["x"][1].labels == {9.0: "nine"}
+    assert vallblsengine.loadcache(path, "missing") == (0, {})
+
+def test_cache_other_version_is_ignored(tmp_path):
+    path = str(tmp_path / "cache.json")
+    with open(path, "w", encoding="utf_8") as f:
+        json.dump({"version": -1, "datasets": {"data": {"cases": 1, "variables": {}}}}, f)
+    assert vallblsengine.loadcache(path, "data") == (0, {})
+    vallblsengine.savecache(path, "data", 2, {})
+    assert vallblsengine.loadcache(path, "data") == (2, {})
+
+# ---- data sources
+
+def test_csvsource_end_to_end(tmp_path):
+    path = str(tmp_path / "data.csv")
+    with open(path, "w", newline="", encoding="utf_8_sig") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "x", "s", "lx", "ls"])
+        writer.writerows([["1", "1", "a", "one", "A"], ["2", "2", "b ", "two", "B"], ["3", "", "c", "missing", ""],
+            ["4", "4", "a", "FOUR", "A"], ["5", "4", "a", "four", ""], ["6", "5", "d", "one", "D"]])
+    source = vallblsengine.opensource(path)
+    assert source.variables() == [("id", False), ("x", False), ("s", True), ("lx", True), ("ls", True)]
+    varstolabel = vallblsengine.resolve(source.variables(), "variables", ["x", "TO", "s"], None, False)
+    labelvars = vallblsengine.resolve(source.variables(), "labels", None, "l", True)
+    assert (varstolabel, labelvars) == (["x", "s"], ["lx", "ls"])
+    tallies = vallblsengine.tallycases(source, varstolabel, labelvars, blocksize=2)
+    vallblsengine.resolvetallies(tallies)
+    assert list(vallblsengine.labelsyntax(tallies, source.isstring)) == [
+        'VALUE LABELS s\n   "a" "A"\n   "b" "B"\n   "d" "D".',
+        'VALUE LABELS x\n   1 "one"\n   2 "two"\n   4 "four"\n   5 "one".']
+    assert (tallies["x"].nconflicts, tallies["x"].nduplabels) == (1, 1)
+
+def test_resolve_errors():
+    varinfo = [("x", False), ("lx", True)]
+    with pytest.raises(ValueError):
+        vallblsengine.resolve(varinfo, "variables", ["x"], "x", False)
+    with pytest.raises(ValueError):
+        vallblsengine.resolve(varinfo, "variables", ["y"], None, False)
+    with pytest.raises(ValueError):
+        vallblsengine.checkvars(["x"], ["x"], dict(varinfo).__getitem__)
+
+def test_signature_changes_with_every_new_label():
+    t = tally([(1.0, "a", "a"), (1.0, "b", "b")])
+    before = t.signature()
+    t.add(1.0, "c", "c")
+    assert t.labels[1.0] == "c" and t.signature() != before
+    # a label sorting before the current one cannot change the result
+    before = t.signature()
+    t.add(1.0, "a", "a")
+    assert t.signature() == before
+    # but when counting, every new (value, label) pair matters
+    counted = tally([(1.0, "c", "c"), (1.0, "b", "b")], rule="mostfrequent")
+    before = counted.signature()
+    counted.add(1.0, "a", "a")
+    assert counted.signature() != before
+    counted.add(1.0, "a", "a")
+    assert counted.signature() == before + 1
+
+def test_sample_waits_for_label_changes():
+    tallies = {"x": VarTally()}
+    sample = vallblsengine.Sample(tallies, ["x"], stablecases=2)
+    for label in ["a", "b", "c", "d"]:
+        tallies["x"].add(1.0, label, label)
+        assert not sample.update(1)
+    assert not sample.update(1)
+    assert sample.update(1)
+    assert sample.decidedearly() == ["x"]
+
+# ---- distinct value estimates
+
+@pytest.mark.parametrize("n", [0, 1, 10, 1000, 20000, 300000])
+def test_hyperloglog_accuracy(n):
+    # numbers hash the same in every process, so these estimates are fixed
+    sketch = vallblsengine.HyperLogLog()
+    sketch.update(float(i) for i in range(n))
+    assert abs(sketch.estimate() - n) <= max(.02 * n, 1)
+
+def test_hyperloglog_is_unbiased():
+    # the standard error is about 1.6%, so single sketches may be off by more than 2%, but not on average
+    errors = []
+    for offset in range(20):
+        sketch = vallblsengine.HyperLogLog()
+        sketch.update(float(offset * 10**6 + i) for i in range(5000))
+        errors.append(sketch.estimate() / 5000. - 1)
+    assert all(abs(e) <= .05 for e in errors)
+    assert abs(sum(errors) / len(errors)) <= .01
+
+def test_hyperloglog_ignores_repeats_and_takes_strings():
+    sketch = vallblsengine.HyperLogLog()
+    for repeat in range(3):
+        sketch.update("value %d" % i for i in range(5000))
+    assert abs(sketch.estimate() - 5000) <= .05 * 5000
+
+def test_hyperloglog_precision():
+    sketch = vallblsengine.HyperLogLog(precision=14)
+    sketch.update(float(i) for i in range(50000))
+    assert len(sketch.registers) == 2**14
+    assert abs(sketch.estimate() - 50000) <= .02 * 50000
+
+def test_estimatedistinct(tmp_path):
+    path = str(tmp_path / "data.csv")
+    with open(path, "w", newline="", encoding="utf_8_sig") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "small", "lbl"])
+        for i in range(5000):
+            writer.writerow([i, i % 7, "label"])
+    estimates = vallblsengine.estimatedistinct(vallblsengine.CsvSource(path), ["id", "small", "lbl"], blocksize=300)
+    assert abs(estimates["id"] - 5000) <= .05 * 5000
+    assert (estimates["small"], estimates["lbl"]) == (7, 1)
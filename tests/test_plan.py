@@ -0,0 +1,53 @@
+"""Tests of packing variables into data passes"""
+
+import pytest
+import spss
+from STATS_VALLBLS_FROMDATA import dolabels, packpasses
+
+
+def test_packs_within_budget():
+    # 4*5 = 20 fits, 20*3 = 60 does not
+    assert packpasses([4, 5, 3, 2, 10], 20) == [(0, 2, 20), (2, 2, 6), (4, 1, 10)]
+
+def test_budget_is_inclusive():
+    assert packpasses([2, 5, 2], 20) == [(0, 3, 20)]
+
+def test_variable_over_budget_gets_its_own_pass():
+    assert packpasses([2, 50, 3], 20) == [(0, 1, 2), (1, 1, 50), (2, 1, 3)]
+    assert packpasses([50], 20) == [(0, 1, 50)]
+
+def test_maxvars_caps_a_pass():
+    assert packpasses([1] * 7, 1000, maxvars=3) == [(0, 3, 1), (3, 3, 1), (6, 1, 1)]
+
+def test_case_count_caps_cells():
+    # the aggregate can never have more cases than the file, so any number of variables fit
+    assert packpasses([100, 100, 100], 1000) == [(0, 1, 100), (1, 1, 100), (2, 1, 100)]
+    assert packpasses([100, 100, 100], 1000, ncases=500) == [(0, 3, 500)]
+    # a variable over the budget on its own is capped too
+    assert packpasses([5000, 2], 1000, ncases=800) == [(0, 2, 800)]
+    assert packpasses([5000, 2], 100, ncases=800) == [(0, 1, 800), (1, 1, 2)]
+
+def test_no_variables():
+    assert packpasses([], 1000) == []
+
+def test_passes_cover_every_variable_in_order():
+    cards = [3, 1, 70, 12, 5, 5, 200, 1, 1, 9]
+    for budget in [1, 10, 100, 1000]:
+        for maxvars in [None, 1, 2, 4]:
+            passes = packpasses(cards, budget, maxvars)
+            assert [i for start, count, cells in passes for i in range(start, start + count)] == list(range(len(cards)))
+            assert all(count == 1 or cells <= budget for start, count, cells in passes)
+            assert all(maxvars is None or count <= maxvars for start, count, cells in passes)
+
+def test_isolated_variables_split_the_plan():
+    # h has many more distinct values than MAXDISTINCT, so it gets a pass of its own,
+    # and the variables on either side of it are packed separately
+    names = ["a", "b", "h", "c", "d", "lbl"]
+    rows = [[float(i % 2), float(i % 3), float(i), float(i % 2), float(i % 3), "L"] for i in range(200)]
+    spss.reset()
+    spss.loaddataset("DataSet1", names, [0, 0, 0, 0, 0, 8], rows)
+    dolabels(variables=["a", "TO", "d"], lblvars=["lbl"], plan="adaptive", maxdistinct=50, highcard="isolate")
+    plan = [[getattr(cell, "value", cell) for cell in row] for t in spss.output if t.title == "Data Pass Plan"
+        for row in t.cells]
+    assert [row[:3] for row in plan] == [["a", "b", 2], ["h", "h", 1], ["c", "d", 2]]
+    assert spss.activedata().valuelabels["h"][199.0] == "L"
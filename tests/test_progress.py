@@ -0,0 +1,79 @@
+"""Tests of progress reporting, cancellation, and resuming from a checkpoint"""
+
+import os
+
+import pytest
+import spss
+from STATS_VALLBLS_FROMDATA import dolabels, Cancelled
+from conftest import NAMES, TYPES, ROWS
+
+ENGINES = ["wide", "long", "stream"]
+LABELS = {"x": {1.0: "one", 2.0: "two", 3.0: "three", 4.0: "four", 5.0: "one"},
+    "s": {"": "x", "a": "A", "b": "B", "d": "D"}, "lx": {}, "ls": {}}
+KEYS = set(["event", "variablesdone", "variables", "rows", "passrows", "elapsed", "remaining"])
+
+def caption():
+    return [t.caption for t in spss.output if t.title == "Value Label Generation"][0]
+
+def assertrestored():
+    """the cancelled run left no cursor, no extra dataset, and no labels"""
+
+    assert spss.cursors == 0
+    assert spss.ActiveDataset() == "DataSet1" and list(spss._datasets) == ["DataSet1"]
+    assert spss.activedata().valuelabels["x"] == {} and spss.activedata().valuelabels["s"] == {}
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_callback_events(dataset, engine):
+    events = []
+    dolabels(variables=["x", "s"], lblvars=["lx", "ls"], engine=engine, varsperpass=1, progress=events.append)
+    assert spss.activedata().valuelabels == LABELS
+    assert events and all(set(e) == KEYS for e in events)
+    passes = [e for e in events if e["event"] == "pass"]
+    assert passes[-1]["variablesdone"] == passes[-1]["variables"] == 2
+    assert passes[-1]["remaining"] == 0
+    if engine != "stream":
+        assert [e["variablesdone"] for e in passes] == [1, 2]
+
+def test_progress_file(dataset, tmp_path):
+    path = str(tmp_path / "progress.txt")
+    dolabels(variables=["x", "s"], lblvars=["lx", "ls"], varsperpass=1, progress=path)
+    with open(path, encoding="utf_8") as f:
+        lines = f.read().splitlines()
+    assert lines and "2 of 2 variables done" in lines[-1]
+
+@pytest.mark.parametrize("how", ["false", "raise"])
+@pytest.mark.parametrize("engine", ENGINES)
+def test_cancel_restores_active_dataset(dataset, engine, how):
+    def cancel(event):
+        if how == "raise":
+            raise Cancelled("stop")
+        return False
+    with pytest.raises(Cancelled):
+        dolabels(variables=["x", "s"], lblvars=["lx", "ls"], engine=engine, progress=cancel)
+    assertrestored()
+    # the next run is not disturbed
+    dolabels(variables=["x", "s"], lblvars=["lx", "ls"], engine=engine)
+    assert spss.activedata().valuelabels == LABELS
+
+def test_returning_none_does_not_cancel(dataset):
+    dolabels(variables=["x", "s"], lblvars=["lx", "ls"], progress=lambda event: None)
+    assert spss.activedata().valuelabels == LABELS
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_checkpoint_resumes_cancelled_run(dataset, engine, tmp_path):
+    checkpoint = str(tmp_path / "run.ckpt")
+    spec = dict(variables=["x", "s"], lblvars=["lx", "ls"], engine=engine, varsperpass=1, checkpoint=checkpoint)
+    with pytest.raises(Cancelled):
+        dolabels(progress=lambda event: event["event"] != "pass", **spec)
+    assertrestored()
+    assert os.path.exists(checkpoint)
+
+    events = []
+    dolabels(progress=events.append, **spec)
+    assert spss.activedata().valuelabels == LABELS
+    # the stream engine reads every variable in one pass, so it had finished them all
+    finished = 2 if engine == "stream" else 1
+    assert "%s variables finished by an earlier run were restored" % finished in caption()
+    # only the variables left are read again
+    assert [e["variables"] for e in events if e["event"] == "pass"] == ([] if engine == "stream" else [1])
+    assert not os.path.exists(checkpoint)
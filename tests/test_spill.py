@@ -0,0 +1,110 @@
+"""Tests that tallies spilled to disk give the same results as tallies kept in memory"""
+
+import csv, random
+
+import pytest
+import vallblsengine
+from vallblsengine import VarTally, SpillStore, SpillTally
+
+
+@pytest.fixture
+def store():
+    """A store with no budget, so every tally with a value is spilled when checked"""
+
+    store = SpillStore(0)
+    yield store
+    store.close()
+
+def mktriples(rnd):
+    """Return random (value, min label, max label) triples with sysmis, blank and conflicting labels"""
+
+    isstring = rnd.random() < .4
+    nvalues = rnd.randint(1, 30)
+    values = [None] + (["v%d" % i for i in range(nvalues)] if isstring else [float(i) for i in range(nvalues)])
+    labels = ["", None] + ["L%d" % i for i in range(rnd.randint(1, 8))]
+    triples = []
+    for i in range(rnd.randint(0, 300)):
+        value, minlbl = rnd.choice(values), rnd.choice(labels)
+        maxlbl = rnd.choice(labels) if rnd.random() < .3 else minlbl
+        if minlbl and maxlbl and minlbl > maxlbl:
+            minlbl, maxlbl = maxlbl, minlbl
+        triples.append((value, minlbl, maxlbl))
+    return triples
+
+def results(tally):
+    """Return what the labels, syntax, and reports use from a finished tally"""
+
+    items = list(tally.items()) if isinstance(tally, SpillTally) else\
+        sorted((value, str(label)) for value, label in tally.labels.items() if value is not None)
+    return (items, list(tally.flaggeditems()), tally.nconflicts, tally.nduplabels,
+        [tuple(map(str, c)) for c in tally.conflicts], tally.duplabels)
+
+@pytest.mark.parametrize("batch", [1, 7, 10000])
+def test_spilled_tally_matches_vartally(batch, store, monkeypatch):
+    monkeypatch.setattr(SpillTally, "BATCH", batch)
+    spilled = 0
+    for trial in range(150):
+        rnd = random.Random(trial)
+        triples = mktriples(rnd)
+        maxconflicts, maxdups = rnd.choice([0, 2, 100]), rnd.choice([None, 0, 3, 100])
+        reference = VarTally(maxconflicts, maxdups)
+        for triple in triples:
+            reference.add(*triple)
+        reference.resolve()
+
+        # spill part way through, after some conflicts and duplicates may already have been found
+        name = "x%d" % trial
+        tallies = {name: VarTally(maxconflicts, maxdups)}
+        cut = rnd.randint(0, len(triples))
+        for triple in triples[:cut]:
+            tallies[name].add(*triple)
+        store.check(tallies)
+        for triple in triples[cut:]:
+            tallies[name].add(*triple)
+        store.finish(tallies)
+        vallblsengine.resolvetallies(tallies)
+        spilled += isinstance(tallies[name], SpillTally)
+        assert results(tallies[name]) == results(reference), trial
+    # a tally is spilled unless it had no values when checked
+    assert spilled > 100
+
+def test_spilled_syntax_and_export_match(store, tmp_path):
+    rnd = random.Random(20)
+    path = str(tmp_path / "data.csv")
+    with open(path, "w", newline="", encoding="utf_8_sig") as f:
+        writer = csv.writer(f)
+        writer.writerow(["n1", "n2", "s1", "l1", "l2", "ls"])
+        for case in range(2000):
+            n1, n2, s1 = rnd.randrange(40), rnd.choice(["", rnd.randrange(500)]), "s%d" % rnd.randrange(60)
+            writer.writerow([n1, n2, s1, rnd.choice(["c%d" % n1, "c%d" % n1, "C%d" % n1, "", "same"]),
+                "c%s" % n2 if rnd.random() < .9 else "", rnd.choice(["l" + s1, "L" + s1, "same"])])
+    source = vallblsengine.CsvSource(path)
+    varstolabel, labelvars = ["n1", "n2", "s1"], ["l1", "l2", "ls"]
+    reference = vallblsengine.tallycases(source, varstolabel, labelvars)
+    vallblsengine.resolvetallies(reference)
+    tallies = dict((v, VarTally()) for v in varstolabel)
+    vallblsengine.tallycases(source, varstolabel, labelvars, tallies, blocksize=100, store=store)
+    store.finish(tallies)
+    vallblsengine.resolvetallies(tallies)
+
+    assert sorted(store.spilled) == sorted(varstolabel)
+    for vname in varstolabel:
+        assert results(tallies[vname]) == results(reference[vname]), vname
+    for vname in ["n1", "s1"]:
+        assert tallies[vname].nconflicts and tallies[vname].nduplabels
+    assert list(vallblsengine.labelsyntax(tallies, source.isstring)) ==\
+        list(vallblsengine.labelsyntax(reference, source.isstring))
+    assert list(vallblsengine.maprows(tallies, source.isstring)) ==\
+        list(vallblsengine.maprows(reference, source.isstring))
+
+def test_budget_spills_largest_first(store):
+    store.budget = 3 * vallblsengine.ENTRYBYTES
+    tallies = {"small": VarTally(), "large": VarTally()}
+    for i in range(3):
+        tallies["small"].add(float(i), "a", "a")
+    for i in range(10):
+        tallies["large"].add(float(i), "b", "b")
+    assert store.check(tallies)
+    assert store.spilled == ["large"]
+    assert isinstance(tallies["small"], VarTally)
+    assert not store.check(tallies)